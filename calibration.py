@@ -4,9 +4,12 @@ from math import pi
 import os
 import sys
 import numpy as np
-from outcar_parser import Parser
-from configuration import Configuration
+from outcar_parser import load_parser
+from configuration import Configuration, batch_descriptors
 import kernel
+import parallel
+from model_file import save_calibration
+from reference import select_reference
 
 
 def load_data(u_conf: dict, offset=0) ->  (int, int, np.array, list):
@@ -15,7 +18,13 @@ def load_data(u_conf: dict, offset=0) ->  (int, int, np.array, list):
     simulation as (N_conf, N_ion, lattice vectors, list of configurations).
     '''
     # load parser and save nr of ions and lattice vectors
-    parser = Parser(u_conf['file_in'])
+    # uses the binary cache of the outcar file, if there is one
+    parser = load_parser(
+        u_conf['file_in'],
+        stream=u_conf.get('stream', False),
+        index=u_conf.get('index', False),
+        cache=u_conf.get('cache', False)
+    )
     lattice_vectors = parser.find_lattice_vectors()
     lat_consts = np.diag(lattice_vectors.dot(lattice_vectors.T))
 
@@ -37,64 +46,312 @@ def init_configurations(u_conf: dict, configurations: list, q: np.array, C: np.a
     Initializes the nearest neighbors and descriptors. Writes values into the C array.
     Choosen this way, to only have sideeffects and no return.
     '''
-    n_conf = u_conf['N_conf']
-    # calculate the nearest neighbors and the descriptors
+    # calculate the descriptors of all configurations at once, the nearest neighbour tables for the force matrices
+    # are set from the same distances
     t_0 = time()
+    print('calculating descriptors and NN ...', end='\r')
+    positions = np.array([config.positions for config in configurations])
+    batch_descriptors(positions, u_conf['cutoff'], u_conf['lattice_vectors'], q, C, configurations=configurations)
     for (alpha, config) in enumerate(configurations):
-        config.init_nn(u_conf['cutoff'], u_conf['lattice_vectors'])
-        config.init_descriptor(q)
-        C[alpha, :, :] = config.descriptors
-        print(f'calculating NN and descriptors: {alpha+1}/{n_conf}', end='\r')
-    print(f'calculating NN and descriptors: finished after {time()-t_0:.3} s')
+        config.descriptors = C[alpha, :, :]
+    print(f'calculating descriptors and NN: finished after {time()-t_0:.3} s')
 
 
-def build_linear(u_conf: dict, configurations: list, C: np.array, q: np.array) -> (np.array, np.array, np.array, np.array):
+def build_linear(u_conf: dict, configurations: list, C: np.array, q: np.array, C_ref=None) -> (np.array, np.array, np.array, np.array):
     '''
     Intializes the kernel and then builds the linear system with the kernel matrices according to kernel.
     Already normalizes the data to <E> = 0.
+    By default all descriptors in C are the reference points, a smaller reference set can be given as C_ref.
     '''
-    kern = kernel.Kernel(*u_conf['kernel'])
+    kern = kernel.Kernel(
+        *u_conf['kernel'], force_mode=u_conf.get('force_mode', 'broadcast'), precision=u_conf.get('precision', 'float64')
+    )
     n_conf = u_conf['N_conf']
     n_ion = u_conf['N_ion']
-    nc_ni = n_conf*n_ion
+
+    # reshape descriptors
+    descr = C.reshape(n_conf * n_ion, len(q))
+    if C_ref is None:
+        C_ref = descr
+    n_ref = np.shape(C_ref)[0]
+
+    workers = u_conf.get('workers', 1)
+
     # will be the super vectors
     E = np.zeros(n_conf)
     # Holds forces flattened
     F = np.zeros(n_conf * n_ion * 3)
-    # The Matrix that is used for fitting the forces
-    T = np.zeros((n_conf * n_ion * 3, nc_ni))
-
-    # reshape descriptors
-    descr = C.reshape(n_conf * n_ion, len(q))
+    # The Matrix that is used for fitting the forces, in shared memory if it is built by several processes
+    T = np.zeros((n_conf * n_ion * 3, n_ref)) if workers == 1 else parallel.shared_array((n_conf * n_ion * 3, n_ref))
 
     t_0 = time()
     print('Building K:', end='\r')
     # das erste Argument ist die aktuelle Konfiguration, das zweite die Referenz-Konfiguration
-    K = kern.kernel_mat(descr, descr)
+    K = kern.kernel_mat(descr, C_ref)
     K = np.sum(
-        K.reshape(n_conf, n_ion, nc_ni),
-        axis=1
+        K.reshape(n_conf, n_ion, n_ref),
+        axis=1, dtype=np.float64
     )
     print(f'Building K: finished after {time()-t_0:.3} s')
 
     t_0 = time()
     for alpha in range(n_conf):
-        print(f'Building [E, F, T]: {alpha+1}/{n_conf}', end='\r')
         E[alpha] = configurations[alpha].energy
         F[alpha*n_ion*3: (alpha+1)*n_ion*3] = configurations[alpha].forces.flatten()
-        T[alpha*n_ion*3:(alpha+1)*n_ion*3] = kern.force_submat(q, configurations[alpha], descr)
+
+    # the blocks of rows of T are independent, every worker builds the blocks of its configurations
+    def build_T(worker, alphas):
+        for alpha in alphas:
+            if worker == 0:
+                print(f'Building [E, F, T]: {alpha+1}/{n_conf}', end='\r')
+            T[alpha*n_ion*3:(alpha+1)*n_ion*3] = kern.force_submat(q, configurations[alpha], C_ref)
+
+    parallel.run(build_T, n_conf, workers)
     print(f'Building [E, F, T]: finished after {time()-t_0:.3} s')
 
     return (E, F, K, T)
 
+
+def add_gram(X: np.array, A: np.array, locks=None, first=0) -> None:
+    '''
+    Adds A^T A to X in place. The product is formed for len(A) rows of X at a time, so that besides X no
+    temporary is bigger than A. With locks (see parallel.locks) the k-th block of rows is added under
+    locks[k % len(locks)], so that several workers can add into one shared X; every worker should start at
+    another block (first), so that they rarely wait for each other.
+    '''
+    rows = max(1, len(A))
+    starts = list(range(0, np.shape(X)[0], rows))
+    first = first % max(1, len(starts))
+    for start in starts[first:] + starts[:first]:
+        block = A[:, start:start+rows].T @ A
+        if locks is None:
+            X[start:start+rows] += block
+        else:
+            with locks[(start // rows) % len(locks)]:
+                X[start:start+rows] += block
+
+
+def build_normal(u_conf: dict, configurations: list, C: np.array, q: np.array, C_ref=None) -> (np.array, np.array, float, np.array):
+    '''
+    Builds the normal equations X = K^T K + T^T T and y = K^T (E - <E>) + T^T F of the linear system one
+    configuration at a time, so that K and T are never held in full. Returns (X, y, <E>, K^T 1), the column sums of K
+    are needed to store the sums of an updatable calibration (see accumulators).
+    The reference points are chosen as in build_linear.
+    '''
+    kern = kernel.Kernel(
+        *u_conf['kernel'], force_mode=u_conf.get('force_mode', 'broadcast'), precision=u_conf.get('precision', 'float64')
+    )
+    n_conf = u_conf['N_conf']
+    n_ion = u_conf['N_ion']
+
+    # reshape descriptors
+    descr = C.reshape(n_conf * n_ion, len(q))
+    if C_ref is None:
+        C_ref = descr
+    n_ref = np.shape(C_ref)[0]
+    E_ave = np.mean([config.energy for config in configurations])
+    workers = u_conf.get('workers', 1)
+
+    # all workers add into one shared X, every block of len(A_alpha) rows of X and y with K_sum have their own lock,
+    # so the memory stays N x N for any number of workers
+    X = np.zeros((n_ref, n_ref)) if workers == 1 else parallel.shared_array((n_ref, n_ref))
+    y = np.zeros(n_ref) if workers == 1 else parallel.shared_array(n_ref)
+    K_sum = np.zeros(n_ref) if workers == 1 else parallel.shared_array(n_ref)
+    n_blocks = -(-n_ref // (1 + n_ion * 3))
+    locks = parallel.locks(n_blocks + 1, workers)
+
+    def accumulate(worker, alphas):
+        for alpha in alphas:
+            if worker == 0:
+                print(f'Building X, y: {alpha+1}/{n_conf}', end='\r')
+            # A_alpha = [K_alpha; T_alpha] are the row of K and the block of rows of T of the configuration alpha,
+            # with a float32 kernel the products are accumulated in float64
+            A_alpha = np.empty((1 + n_ion * 3, n_ref))
+            A_alpha[0] = np.sum(kern.kernel_mat(C[alpha], C_ref), axis=0, dtype=np.float64)
+            A_alpha[1:] = kern.force_submat(q, configurations[alpha], C_ref)
+            add_gram(X, A_alpha, locks[:n_blocks], worker * n_blocks // max(1, workers))
+            y_alpha = A_alpha.T @ np.append(configurations[alpha].energy - E_ave, configurations[alpha].forces.flatten())
+            with locks[n_blocks]:
+                y[:] += y_alpha
+                K_sum[:] += A_alpha[0]
+
+    t_0 = time()
+    parallel.run(accumulate, n_conf, workers)
+    print(f'Building X, y: finished after {time()-t_0:.3} s')
+
+    return (X, y, E_ave, K_sum)
+
+
+def reference_descriptors(u_conf: dict, C: np.array) -> np.array:
+    '''
+    Returns the reference points of the model. If u_conf sets 'n_reference', these are n_reference descriptors
+    selected with u_conf['reference_method'] (default fps), otherwise all descriptors of C.
+    '''
+    descr = C.reshape(-1, np.shape(C)[-1])
+    if u_conf.get('n_reference') is None:
+        return descr
+
+    t_0 = time()
+    print('Selecting reference points ...', end='\r')
+    indices = select_reference(descr, u_conf['n_reference'], u_conf.get('reference_method', 'fps'))
+    print(f'Selecting reference points: {len(indices)} of {len(descr)}, finished after {time()-t_0:.3} s')
+    return descr[indices]
+
+
+# the solvers that can be chosen with the key 'solver' in the json-file
+SOLVERS = ('normal', 'cholesky', 'qr', 'svd')
+# the solvers, that only need the normal equations, e.g. of the assembly 'streaming'
+NORMAL_SOLVERS = ('normal', 'cholesky')
+# block size of the substitution in solve_triangular
+TRIANGULAR_BLOCK = 256
+
+
+def check_config(u_conf: dict) -> None:
+    '''
+    Raises a ValueError for a combination of keys in the json-file, that cannot be calibrated, before the data is read.
+    '''
+    solver = u_conf.get('solver', 'normal')
+    if solver not in SOLVERS:
+        raise ValueError(f'solver {solver} is not supported, choose one of {SOLVERS}')
+    if u_conf.get('assembly', 'dense') == 'streaming' and solver not in NORMAL_SOLVERS:
+        raise ValueError(f'the assembly streaming only builds the normal equations, choose a solver of {NORMAL_SOLVERS}')
+
+
 ##### ##### Reference: Equation (24) ##### #####
-def ridge_regression(K, E, lamb):
-    X = np.matmul(np.transpose(K), K)
-    y = np.matmul(np.transpose(K), E)
-    # (X+lamb*I) * w - y = 0
-    N = np.shape(K)[1]
-    w = np.linalg.solve(X + lamb * np.eye(N), y)
-    return w
+def ridge_regression(K, E, lamb, solver='normal'):
+    '''
+    Solves the ridge regression min |K w - E|^2 + lamb |w|^2 with the given solver:
+    normal: solves the normal equations (K^T K + lamb I) w = K^T E with np.linalg.solve
+    cholesky: solves the normal equations with a Cholesky factorization
+    qr: QR factorization of the stacked [K; sqrt(lamb) I], does not square the condition number of K
+    svd: SVD of K, see ridge_path
+    '''
+    if solver in ('normal', 'cholesky'):
+        X = np.matmul(np.transpose(K), K)
+        y = np.matmul(np.transpose(K), E)
+        return solve_normal(X, y, lamb, solver)
+    elif solver == 'qr':
+        N = np.shape(K)[1]
+        Q, R = np.linalg.qr(np.append(K, np.sqrt(lamb) * np.eye(N), axis=0))
+        return solve_triangular(R, Q[:np.shape(K)[0]].T @ E, lower=False)
+    elif solver == 'svd':
+        return ridge_path(K, E, [lamb], 'svd')[0]
+    raise ValueError(f'solver {solver} is not supported, choose one of {SOLVERS}')
+
+
+def solve_normal(X, y, lamb, solver='normal'):
+    '''
+    Solves the normal equations (X + lamb I) w = y, where X = K^T K and y = K^T E.
+    '''
+    N = np.shape(X)[0]
+    if solver == 'normal':
+        # (X+lamb*I) * w - y = 0
+        return np.linalg.solve(X + lamb * np.eye(N), y)
+    elif solver == 'cholesky':
+        return cholesky_solve(cholesky_factor(X, lamb), y)
+    raise ValueError(f'solver {solver} cannot solve the normal equations')
+
+
+def cholesky_factor(X, lamb):
+    '''
+    Returns the lower triangular Cholesky factor L of X + lamb I. It can be reused with cholesky_solve
+    for any number of right hand sides.
+    '''
+    return np.linalg.cholesky(X + lamb * np.eye(np.shape(X)[0]))
+
+
+def cholesky_update(L, W):
+    '''
+    Returns the Cholesky factor of L L^T + W W^T for the lower triangular L (N x N) and W (N x r), e.g. the factor of
+    X + lamb I after r rows U = W^T were added to K and T. Every column of L is rotated with the rows of W by one
+    Householder reflection, which costs O(N^2 r) instead of the O(N^3) of a new factorization.
+    '''
+    L = np.array(L, dtype=float)
+    W = np.array(W, dtype=float).reshape(np.shape(L)[0], -1)
+    for k in range(np.shape(L)[0]):
+        w = W[k]
+        w2 = w @ w
+        if w2 == 0:
+            continue
+        # the reflection maps [L_kk, w] to [-alpha, 0], the sign of the column is flipped afterwards
+        alpha = np.sqrt(L[k, k]**2 + w2)
+        u0 = L[k, k] + alpha
+        s = (u0 * L[k:, k] + W[k:] @ w) / (alpha * u0)
+        L[k:, k] = s * u0 - L[k:, k]
+        W[k:] -= np.outer(s, w)
+    return L
+
+
+def accumulators(X, y, K_sum, E_sum, n_conf, lamb) -> dict:
+    '''
+    Returns the sums of the normal equations, that an updatable calibration stores in its model file (see update.py):
+    X = K^T K + T^T T, y = K^T E + T^T F with the energies not centered, K_sum = K^T 1, the sum of the energies, the
+    number of configurations and the Cholesky factor L of X + lamb I (None, if X + lamb I is not numerically positive
+    definite).
+    '''
+    try:
+        L = cholesky_factor(X, lamb)
+    except np.linalg.LinAlgError:
+        L = None
+    return {'X': X, 'y': y, 'K_sum': K_sum, 'E_sum': float(E_sum), 'n_conf': int(n_conf), 'L': L}
+
+
+def cholesky_solve(L, y):
+    '''
+    Solves L L^T w = y for the Cholesky factor L by two triangular substitutions.
+    '''
+    return solve_triangular(L.T, solve_triangular(L, y), lower=False)
+
+
+def solve_triangular(L, b, lower=True):
+    '''
+    Solves L x = b for a lower (or upper) triangular L by blocked substitution in O(N^2),
+    instead of the O(N^3) of np.linalg.solve. b can be a vector or a matrix of right hand sides.
+    '''
+    N = np.shape(L)[0]
+    x = np.array(b, dtype=float)
+    blocks = range(0, N, TRIANGULAR_BLOCK)
+    for start in (blocks if lower else reversed(blocks)):
+        stop = min(start + TRIANGULAR_BLOCK, N)
+        if lower:
+            x[start:stop] -= L[start:stop, :start] @ x[:start]
+        else:
+            x[start:stop] -= L[start:stop, stop:] @ x[stop:]
+        x[start:stop] = np.linalg.solve(L[start:stop, start:stop], x[start:stop])
+    return x
+
+
+def ridge_path(K, E, lambdas, solver='svd'):
+    '''
+    Returns the weights of the ridge regression for every lambda in lambdas as array of shape (len(lambdas), N).
+    With solver='svd' the whole path costs one SVD of K: w(lamb) = V diag(s / (s^2 + lamb)) U^T E.
+    With the normal equation solvers K^T K and K^T E are only built once. A Cholesky factor of X + lamb I cannot be
+    reused for another lambda, so solver='cholesky' takes the path from one eigendecomposition of X instead (see
+    solve_normal_path); normal solves and qr factorizes for every lambda.
+    '''
+    if solver == 'svd':
+        U, s, Vt = np.linalg.svd(K, full_matrices=False)
+        UtE = U.T @ E
+        return np.array([Vt.T @ (s / (s**2 + lamb) * UtE) for lamb in lambdas])
+    elif solver in ('normal', 'cholesky'):
+        X = np.matmul(np.transpose(K), K)
+        y = np.matmul(np.transpose(K), E)
+        if solver == 'cholesky':
+            return solve_normal_path(X, y, lambdas)
+        return np.array([solve_normal(X, y, lamb) for lamb in lambdas])
+    return np.array([ridge_regression(K, E, lamb, solver) for lamb in lambdas])
+
+
+def solve_normal_path(X, y, lambdas):
+    '''
+    Returns the solutions of the normal equations (X + lamb I) w = y for every lambda in lambdas as array of shape
+    (len(lambdas), N). The whole path costs one eigendecomposition of X: w(lamb) = V diag(1 / (s + lamb)) V^T y.
+    '''
+    s, V = np.linalg.eigh(X)
+    # X is positive semidefinite, negative eigenvalues are rounding errors
+    s = np.maximum(s, 0)
+    Vty = V.T @ y
+    return np.array([V @ (Vty / (s + lamb)) for lamb in lambdas])
 
 
 def main():
@@ -102,6 +359,7 @@ def main():
     config_path = sys.argv[1] if len(sys.argv) > 1 else 'user_config.json'
     with open(config_path, 'r') as u_conf:
         user_config = json.load(u_conf)
+    check_config(user_config)
 
     # make a list of the allowed qs
     qs = np.arange(1, user_config['nr_modi']+1) * pi / user_config['cutoff']
@@ -114,28 +372,49 @@ def main():
     # compute the nn and configurations and fill them in C
     init_configurations(user_config, configurations, qs, C)
 
-    # build the linear system
-    (E, F, K, T) = build_linear(user_config, configurations, C, qs)
+    # choose the reference points, by default all descriptors
+    C_ref = reference_descriptors(user_config, C)
 
-    # centering the energy for (probably) more precise results
-    E_ave = np.mean(E)
-    E = E - E_ave
+    if user_config.get('assembly', 'dense') == 'streaming':
+        # build the normal equations directly, without holding T
+        (X, y, E_ave, K_sum) = build_normal(user_config, configurations, C, qs, C_ref)
 
-    t_0 = time()
-    # calculate the weights using ridge regression
-    print('Solving linear system ... ', end='\r')
-    w = ridge_regression(np.append(K,T, axis=0), np.append(E,F, axis=0), user_config['lambda'])
-    print(f'Solving linear system: finished after {time()-t_0:.3} s')
+        t_0 = time()
+        print('Solving linear system ... ', end='\r')
+        w = solve_normal(X, y, user_config['lambda'], user_config.get('solver', 'normal'))
+        print(f'Solving linear system: finished after {time()-t_0:.3} s')
+
+        if user_config.get('updatable', False):
+            # y is centered, the stored y is not: y + <E> K^T 1
+            sums = accumulators(X, y + E_ave * K_sum, K_sum, E_ave * len(C), len(C), user_config['lambda'])
+    else:
+        # build the linear system
+        (E, F, K, T) = build_linear(user_config, configurations, C, qs, C_ref)
+
+        # centering the energy for (probably) more precise results
+        E_ave = np.mean(E)
+        E = E - E_ave
+
+        t_0 = time()
+        # calculate the weights using ridge regression
+        print('Solving linear system ... ', end='\r')
+        w = ridge_regression(np.append(K,T, axis=0), np.append(E,F, axis=0), user_config['lambda'], user_config.get('solver', 'normal'))
+        print(f'Solving linear system: finished after {time()-t_0:.3} s')
+
+        if user_config.get('updatable', False):
+            A = np.append(K, T, axis=0)
+            K_sum = np.sum(K, axis=0)
+            sums = accumulators(A.T @ A, A.T @ np.append(E + E_ave, F), K_sum, np.sum(E + E_ave), len(E), user_config['lambda'])
 
     # make a data directory
     directory = user_config['file_out']
     if not os.path.exists(directory):
         os.makedirs(directory)
-    # save calibration (file content will be overwritten if file already exists)
-    np.savetxt(directory + '/calibration_w.out', w)
-    np.savetxt(directory + '/calibration_C.out', np.reshape(C, (user_config['N_conf'] * user_config['N_ion'], user_config['nr_modi'])))
-    np.savetxt(directory + '/calibration_E.out', [E_ave, E_ave])
-    # loading: C_cal = np.reshape(np.loadtxt('calibration.out'), (N_conf, N_ion, user_config['nr_modi']))
+    # save calibration as model file and, if wished, as text (file content will be overwritten if file already exists)
+    save_calibration(
+        directory, user_config, C_ref, w, E_ave, qs, text=user_config.get('text_output', True),
+        sums=sums if user_config.get('updatable', False) else None
+    )
 
 
 if __name__ == '__main__':
@@ -5,6 +5,8 @@
 # Durch die klasseneigene Methode init_descriptor können unter Angabe eines q-Vektors (dieser bestimmt die
 # Koeffizienten in den Basis-Sinusfunktionen) danach die descriptor coefficients erstellt werden.
 
+from collections import namedtuple
+from itertools import product
 import numpy as np
 
 def dist(r1, r2, a=1):
@@ -12,9 +14,191 @@ def dist(r1, r2, a=1):
     dr = dr - a * np.rint(dr/a) # rint = rounding to nearest integer (up or down)
     return dr
 
+# Berechnet alle Paare (i < j), deren Abstand nach der minimal image convention kleiner als rcut ist.
+# Dafür werden die Atome in Zellen mit Kantenlänge >= rcut einsortiert (linked-cell / binning), sodass nur Atome aus
+# benachbarten Zellen verglichen werden müssen. Für festes rcut skaliert die Suche damit wie O(N).
+# a ist der Vektor der Gitterkonstanten. Zurückgegeben werden die Indizes i und j (lexikographisch sortiert, wie in
+# der alten Doppelschleife), die Differenzvektoren r_j - r_i und die Abstände.
+def neighbour_pairs(positions, rcut, a):
+    n, dim = np.shape(positions)
+    a = np.broadcast_to(np.asarray(a, dtype=float), (dim,))
+    ncells = np.floor(a / rcut).astype(int)
+
+    if n < 2:
+        i = j = np.zeros(0, dtype=int)
+    elif np.any(ncells < 3):
+        # bei weniger als 3 Zellen pro Richtung sind die Nachbarzellen nicht mehr verschieden: alle Paare testen
+        i, j = np.triu_indices(n, 1)
+    else:
+        i, j = _cell_candidates(positions, a, ncells)
+        order = np.lexsort((j, i))
+        i, j = i[order], j[order]
+
+    rj_ri = dist(positions[i], positions[j], a)
+    dr = _norms(rj_ri)
+    mask = dr < rcut
+    return (i[mask], j[mask], rj_ri[mask], dr[mask])
+
+# Hilfsfunktion, die die Längen einer Liste von Vektoren berechnet. Es wird wie bei vec.dot(vec) gerechnet, damit
+# die Abstände bitgenau mit der paarweisen Berechnung übereinstimmen
+def _norms(vecs):
+    return np.sqrt(np.matmul(vecs[:, np.newaxis, :], vecs[:, :, np.newaxis]).reshape(-1))
+
+# Hilfsfunktion für neighbour_pairs: liefert alle Kandidaten-Paare (i < j) aus benachbarten Zellen
+def _cell_candidates(positions, a, ncells):
+    n, dim = np.shape(positions)
+    nr_cells = np.prod(ncells)
+
+    # Zellindex jedes Atoms, die Positionen werden dafür in die Einheitszelle zurückgefaltet
+    frac = positions / a
+    frac = frac - np.floor(frac)
+    cell = np.minimum((frac * ncells).astype(int), ncells - 1)
+    flat = np.ravel_multi_index(cell.T, ncells)
+
+    # Tabelle (Zelle x maximale Besetzung) mit den Atomindizes, -1 falls der Platz leer ist
+    order = np.argsort(flat, kind='stable')
+    counts = np.bincount(flat, minlength=nr_cells)
+    starts = np.cumsum(counts) - counts
+    slot = np.arange(n) - starts[flat[order]]
+    table = -np.ones((nr_cells, counts.max()), dtype=int)
+    table[flat[order], slot] = order
+
+    cells = np.array(np.unravel_index(np.arange(nr_cells), ncells)).T
+    i_list = []
+    j_list = []
+    for shift in product((-1, 0, 1), repeat=dim):
+        neighbour = np.ravel_multi_index(((cells + shift) % ncells).T, ncells)
+        ii, jj = np.broadcast_arrays(table[:, :, np.newaxis], table[neighbour][:, np.newaxis, :])
+        # leere Plätze sind -1 und damit automatisch durch ii < jj oder ii >= 0 ausgeschlossen
+        mask = (ii >= 0) & (ii < jj)
+        i_list.append(ii[mask])
+        j_list.append(jj[mask])
+
+    return (np.concatenate(i_list), np.concatenate(j_list))
+
+
+# Berechnet die descriptor coefficients für einen ganzen Stapel von Konfigurationen in wenigen vektorisierten Schritten.
+# positions hat die shape (n_conf, n_ion, dim), das Ergebnis mit shape (n_conf, n_ion, len(q)) wird in C geschrieben,
+# falls ein array übergeben wird. Um den Speicherbedarf zu begrenzen, werden jeweils nur so viele Konfigurationen
+# zusammen verarbeitet, dass die Zwischenergebnisse höchstens chunk_size Elemente haben. Ist schon eine Konfiguration
+# zu groß, werden ihre Zentralatome in Blöcken von Zeilen verarbeitet.
+# Mit der Liste configurations (zu positions) werden deren Nachbartabellen und NeighbourList aus denselben Abständen
+# gesetzt (wie init_nn mit dense=True), sodass die Abstände nur einmal berechnet werden.
+# Es wird wie in init_nn und init_descriptor gerechnet, die Ergebnisse stimmen daher mit diesen überein.
+##### ##### Reference: Equation (1) ##### #####
+def batch_descriptors(positions, rcut, lattice, q, C=None, chunk_size=2**23, configurations=None):
+    n_conf, n, dim = np.shape(positions)
+    nq = len(q)
+    if C is None:
+        C = np.zeros((n_conf, n, nq))
+
+    a = lattice.diagonal()
+    width = n * max(dim, nq)
+    rows = min(n, max(1, chunk_size // width))
+    block = max(1, chunk_size // (n * width)) if rows == n else 1
+    for start in range(0, n_conf, block):
+        pos = positions[start:start+block]
+        if configurations is not None:
+            tables = [(np.zeros((n, n)), np.zeros((n, n, dim))) for _ in range(len(pos))]
+        for row in range(0, n, rows):
+            # rj_ri.shape = (block, rows, n, dim), distances.shape = (block, rows, n)
+            rj_ri = dist(pos[:, row:row+rows, np.newaxis, :], pos[:, np.newaxis, :, :], a)
+            distances = np.sqrt(np.matmul(rj_ri[..., np.newaxis, :], rj_ri[..., :, np.newaxis]).reshape(rj_ri.shape[:-1]))
+            # 0 if self atom or not NN, as in the nn-tables
+            distances[distances >= rcut] = 0
+            C[start:start+block, row:row+rows] = np.sum(np.sin(np.multiply.outer(distances, q)), axis=2)
+            if configurations is not None:
+                nn = distances > 0
+                for (k, (nndistances, nndisplace_norm)) in enumerate(tables):
+                    nndistances[row:row+rows] = distances[k]
+                    nndisplace_norm[row:row+rows][nn[k]] = rj_ri[k][nn[k]] / distances[k][nn[k]][:, np.newaxis]
+        if configurations is not None:
+            for (config, (nndistances, nndisplace_norm)) in zip(configurations[start:start+block], tables):
+                config.set_nn_tables(nndistances, nndisplace_norm)
+
+    return C
+
+# Kompakte Nachbarliste im CSR-Format: die Nachbarn des Atoms i stehen in j[indptr[i]:indptr[i+1]], r enthält die
+# zugehörigen Abstände und rhat die normierten Differenzvektoren (r_j - r_i) / r. Speicher und Aufwand skalieren so
+# mit der Anzahl der Paare statt mit N^2.
+NeighbourList = namedtuple('NeighbourList', ['indptr', 'j', 'r', 'rhat'])
+
+# Baut aus den Paaren (i < j) von neighbour_pairs die NeighbourList für n Atome, in der jedes Paar in beide
+# Richtungen eingetragen ist
+def build_neighbour_list(n, i, j, rj_ri, dr):
+    rhat = rj_ri / dr[:, np.newaxis]
+    central = np.concatenate((i, j))
+    neighbour = np.concatenate((j, i))
+    order = np.lexsort((neighbour, central))
+    indptr = np.zeros(n + 1, dtype=int)
+    indptr[1:] = np.cumsum(np.bincount(central, minlength=n))
+    return NeighbourList(indptr, neighbour[order], np.concatenate((dr, dr))[order], np.concatenate((rhat, -rhat))[order])
+
+# Gibt zu jedem Paar der NeighbourList den Index des zentralen Atoms zurück
+def pair_rows(indptr):
+    return np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+
+# Summiert die Werte (erste Achse = Paare) für jedes zentrale Atom auf, Ergebnis hat die shape (n, ...)
+def segment_sum(values, indptr):
+    out = np.zeros((len(indptr) - 1,) + np.shape(values)[1:])
+    nonempty = indptr[1:] > indptr[:-1]
+    if np.any(nonempty):
+        out[nonempty] = np.add.reduceat(values, indptr[:-1][nonempty], axis=0)
+    return out
+
+# Hängt die NeighbourLists mehrerer Konfigurationen zu einer zusammen, als wären alle Atome in einer Konfiguration.
+# Die Indizes der Nachbarn werden dafür um die Zahl der Atome der vorherigen Konfigurationen verschoben.
+def stack_neighbour_lists(nn_lists):
+    n_atoms = np.cumsum([0] + [len(nn_list.indptr) - 1 for nn_list in nn_lists])
+    n_pairs = np.cumsum([0] + [nn_list.indptr[-1] for nn_list in nn_lists])
+    indptr = np.concatenate([[0]] + [nn_list.indptr[1:] + offset for (nn_list, offset) in zip(nn_lists, n_pairs)])
+    return NeighbourList(
+        indptr,
+        np.concatenate([nn_list.j + offset for (nn_list, offset) in zip(nn_lists, n_atoms)]),
+        np.concatenate([nn_list.r for nn_list in nn_lists]),
+        np.concatenate([nn_list.rhat for nn_list in nn_lists])
+    )
+
+
+# Verlet-Liste mit skin: die Kandidaten-Paare werden mit dem Radius rcut + skin bestimmt und erst dann neu berechnet,
+# wenn sich ein Atom seit dem letzten Aufbau um mehr als skin/2 bewegt hat. Bis dahin müssen pro Aufruf nur die
+# Abstände der Kandidaten neu berechnet werden. Es wird vorausgesetzt, dass rcut + skin kleiner als die halbe
+# Gitterkonstante ist.
+class VerletList(object):
+
+    def __init__(self, rcut, skin):
+        self.rcut = rcut
+        self.skin = skin
+        self.reference = None # Positionen beim letzten Aufbau
+        self.a = None # Gitterkonstanten beim letzten Aufbau
+        self.i = None
+        self.j = None
+        self.rebuilds = 0
+
+    # Gibt zurück, ob die Kandidaten-Liste für die gegebenen Positionen neu aufgebaut werden muss
+    def needs_rebuild(self, positions, a):
+        if self.reference is None or np.shape(self.reference) != np.shape(positions) or not np.array_equal(self.a, a):
+            return True
+        moved = dist(self.reference, positions, a)
+        return np.max(np.einsum('id,id->i', moved, moved)) > (self.skin / 2)**2
+
+    # Gibt die Paare innerhalb von rcut im gleichen Format wie neighbour_pairs zurück
+    def pairs(self, positions, lattice):
+        a = lattice.diagonal()
+        if self.needs_rebuild(positions, a):
+            self.i, self.j, _, _ = neighbour_pairs(positions, self.rcut + self.skin, a)
+            self.reference = np.array(positions, copy=True)
+            self.a = np.array(a, copy=True)
+            self.rebuilds += 1
+
+        rj_ri = dist(positions[self.i], positions[self.j], a)
+        dr = _norms(rj_ri)
+        mask = dr < self.rcut
+        return (self.i[mask], self.j[mask], rj_ri[mask], dr[mask])
+
 class Configuration(object):
 
-    def __init__(self, positions, energy=None, forces=None, nndisplace_norm=None, nndistances=None, descriptors=None, velocities=None):
+    def __init__(self, positions, energy=None, forces=None, nndisplace_norm=None, nndistances=None, descriptors=None, velocities=None, nnpairs=None):
         self.positions = positions
         self.energy = energy
         self.forces = forces
@@ -22,37 +206,61 @@ class Configuration(object):
         self.nndistances = nndistances # distances (scalar) with 0 if not NN or self
         self.descriptors = descriptors
         self.velocities = velocities
+        self.nnpairs = nnpairs # NeighbourList of all NN pairs (sparse alternative to the tables above)
 
     # Diese Funktion erstellt die nearest-neighbour-tables für die Positionen und die Abstände.
     # Dafür muss die float-Variable rcut in Angström übergeben werden.
-    def init_nn(self, rcut, lattice):
+    # Optional kann eine VerletList übergeben werden, deren Kandidaten-Paare dann wiederverwendet werden.
+    # Die Nachbarn werden immer auch als NeighbourList in nnpairs gespeichert. Mit dense=False werden die dichten
+    # n x n Tabellen nicht angelegt (None), dann rechnen init_descriptor und die Kernel nur mit nnpairs.
+    def init_nn(self, rcut, lattice, nn_list=None, dense=True):
         n, dim = np.shape(self.positions) # nr of atoms, nr of dimensions
+
+        if nn_list is None:
+            # get a vector of all lattice constants (primitive orthorhombic or cubic cell)
+            i, j, rj_ri, dr = neighbour_pairs(self.positions, rcut, lattice.diagonal())
+        elif nn_list.rcut != rcut:
+            raise ValueError(f'cutoff of the Verlet list ({nn_list.rcut}) does not match rcut ({rcut})')
+        else:
+            i, j, rj_ri, dr = nn_list.pairs(self.positions, lattice)
+
+        self.nnpairs = build_neighbour_list(n, i, j, rj_ri, dr)
+        if not dense:
+            self.nndisplace_norm = None
+            self.nndistances = None
+            return
+
         # n x n x dim numpy.array of normalized NN-displacement table
         self.nndisplace_norm = np.zeros((n, n, dim)) # 0 if self atom or not NN
         # n x n numpy.array of NN-distances table
         self.nndistances = np.zeros((n, n)) # 0 if self atom or not NN
 
-        # get a vector of all lattice constants (primitive orthorhombic or cubic cell)
-        a = lattice.diagonal()
+        self.nndisplace_norm[i, j, :] = rj_ri / dr[:, np.newaxis] # NN atom - central atom
+        self.nndisplace_norm[j, i, :] = - rj_ri / dr[:, np.newaxis] # NN atom - central atom
+        self.nndistances[i, j] = dr
+        self.nndistances[j, i] = dr
 
-        for i in range(n): # loop over central atoms
-            for j in range(i+1,n): # loop over possible nearest neighbours
-                rj_ri = dist(self.positions[i,:], self.positions[j,:], a)
-                dr = np.sqrt(rj_ri.dot(rj_ri))
-                if dr < rcut:
-                    self.nndisplace_norm[i,j,:] = rj_ri / dr # NN atom - central atom
-                    self.nndisplace_norm[j,i,:] = - rj_ri / dr # NN atom - central atom
-                    self.nndistances[i,j] = dr
-                    self.nndistances[j,i] = dr
+    # Setzt die dichten Nachbartabellen (wie von init_nn berechnet, z.B. von batch_descriptors) und baut daraus die
+    # NeighbourList nnpairs. Die Nachbarn jedes Atoms stehen in der Tabelle schon aufsteigend sortiert.
+    def set_nn_tables(self, nndistances, nndisplace_norm):
+        self.nndistances = nndistances
+        self.nndisplace_norm = nndisplace_norm
+        central, neighbour = np.nonzero(nndistances)
+        indptr = np.zeros(len(nndistances) + 1, dtype=int)
+        indptr[1:] = np.cumsum(np.bincount(central, minlength=len(nndistances)))
+        self.nnpairs = NeighbourList(indptr, neighbour, nndistances[central, neighbour], nndisplace_norm[central, neighbour])
 
     # Diese Funktion erstellt die descriptor coefficients der configuration.
     # Dafür muss ein float-Vektor q übergeben werden.
     # Dass dieser mit rcut zusammenpasst wird vorausgesetzt und nicht weiter überprüft.
     ##### ##### Reference: Equation (1) ##### #####
     def init_descriptor(self, q):
-        if self.nndistances is None:
+        if self.nndistances is None and self.nnpairs is None:
             print("Execute Configuration.init_nn(rcut,lattice) before calculating descriptor coefficients!")
             return
+        elif self.nndistances is None:
+            # n x len(q) numpy.array of Descriptor coefficients, summed over the pairs of each atom
+            self.descriptors = segment_sum(np.sin(np.multiply.outer(self.nnpairs.r, q)), self.nnpairs.indptr)
         else:
             # n x len(q) numpy.array of Descriptor coefficients
             self.descriptors = np.sum(np.sin(np.multiply.outer(self.nndistances, q)), axis=1)
@@ -0,0 +1,240 @@
+import argparse
+import json
+from math import pi
+from time import time
+import numpy as np
+import calibration
+import kernel
+
+# the ways to split the configurations into folds, see folds
+SPLITS = ('block', 'interleaved')
+METHODS = ('downdate', 'refit')
+# above this condition number of I - H the leave-out formula is replaced by a solve of the downdated normal equations
+COND_LIMIT = 1e8
+
+
+def folds(n_conf: int, k: int, split='block') -> list:
+    '''
+    Splits the configurations 0, ..., n_conf-1 into k folds. With split='block' the folds are k contiguous blocks
+    (leave-block-out, the configurations of an MD run are correlated in time), with split='interleaved' every k-th
+    configuration is in the same fold. k = n_conf is leave-one-out.
+    '''
+    if not 1 < k <= n_conf:
+        raise ValueError(f'the number of folds has to be between 2 and the number of configurations ({n_conf})')
+    if split == 'block':
+        return np.array_split(np.arange(n_conf), k)
+    elif split == 'interleaved':
+        return [np.arange(i, n_conf, k) for i in range(k)]
+    raise ValueError(f'split {split} is not supported, choose one of {SPLITS}')
+
+
+def fold_rows(fold: np.array, n_conf: int, n_ion: int) -> np.array:
+    '''
+    Returns the rows of the stacked linear system [K; T], that belong to the configurations in fold.
+    '''
+    force_rows = (n_conf + fold.reshape(-1, 1) * n_ion * 3 + np.arange(n_ion * 3)).flatten()
+    return np.append(fold, force_rows)
+
+
+# Cross-validation with the reference points fixed for all folds, e.g. all descriptors or the n_reference selected
+# ones. The linear system [K; T] w = [E - <E>; F] of all configurations is factorized once by an eigendecomposition
+# of X = K^T K + T^T T. The residuals of the rows U of a left out fold follow from the residuals e of the fit to all
+# configurations by the leave-out formula
+#   e_out = (I - H)^-1 e,   H = U (X + lamb I)^-1 U^T,
+# without fitting the remaining folds again. Every fold is centered by the mean energy of its training
+# configurations, as in a separate calibration of them.
+# The whole system A = [K; T] is kept in memory, (n_conf (1 + 3 n_ion)) x N floats, besides X and V (N x N). For
+# more configurations than fit into memory use the refit method, which accumulates X per configuration.
+class CrossValidation(object):
+    def __init__(self, E: np.array, F: np.array, K: np.array, T: np.array):
+        self.n_conf = len(E)
+        self.n_ion = len(F) // (3 * self.n_conf)
+        self.E = E
+        self.A = np.append(K, T, axis=0)
+        # the right hand side with the energies not centered
+        self.b = np.append(E, F)
+        self.X = self.A.T @ self.A
+        (s, self.V) = np.linalg.eigh(self.X)
+        # X is positive semidefinite, negative eigenvalues are rounding errors
+        self.s = np.maximum(s, 0)
+        # A^T b = V g, the centering by c subtracts c K^T 1 = c V h
+        self.g = self.V.T @ (self.A.T @ self.b)
+        self.h = self.V.T @ np.sum(K, axis=0)
+
+    def residuals(self, fold: np.array, lambdas: list) -> np.array:
+        '''
+        Returns the residuals (len(lambdas), rows) of the energies and forces of the configurations in fold, predicted
+        by the models fitted to all other configurations. The first len(fold) columns are the energies.
+        '''
+        rows = fold_rows(fold, self.n_conf, self.n_ion)
+        c = np.mean(np.delete(self.E, fold))
+        U = self.A[rows]
+        UV = U @ self.V
+        b_k = np.array(self.b[rows])
+        b_k[:len(fold)] -= c
+
+        residuals = np.zeros((len(lambdas), len(rows)))
+        for (k, lamb) in enumerate(lambdas):
+            d = 1 / (self.s + lamb)
+            # residuals of the fit to all configurations, I - H = I - W W^T
+            e = b_k - UV @ (d * (self.g - c * self.h))
+            W = UV * np.sqrt(d)
+            # with more rows than reference points (I - W W^T)^-1 e = e + W (I - W^T W)^-1 W^T e (Woodbury) is
+            # solved in the N-space, both matrices have the same condition number
+            woodbury = len(rows) > len(d)
+            L = leave_out_factor(np.eye(len(d)) - W.T @ W if woodbury else np.eye(len(rows)) - W @ W.T)
+            if L is not None and woodbury:
+                residuals[k] = e + W @ calibration.cholesky_solve(L, W.T @ e)
+            elif L is not None:
+                residuals[k] = calibration.cholesky_solve(L, e)
+            else:
+                # the fold is (almost) only fitted by itself, the formula loses its precision: solve the normal
+                # equations without the rows of the fold instead (K and T are not built again)
+                y = self.V @ (self.g - c * self.h) - U.T @ b_k
+                residuals[k] = b_k - U @ calibration.solve_normal(self.X - U.T @ U, y, lamb)
+        return residuals
+
+
+def leave_out_factor(M: np.array):
+    '''
+    Returns the Cholesky factor L of M = I - W W^T (or I - W^T W) or None, if M is not positive definite or its
+    condition number, estimated by (max L_ii / min L_ii)^2, is above COND_LIMIT. The estimate replaces the SVD of
+    np.linalg.cond.
+    '''
+    try:
+        L = np.linalg.cholesky(M)
+    except np.linalg.LinAlgError:
+        return None
+    diag = np.abs(np.diagonal(L))
+    if np.min(diag) == 0 or (np.max(diag) / np.min(diag))**2 >= COND_LIMIT:
+        return None
+    return L
+
+
+def rmse(residuals: np.array, n_fold: int) -> (np.array, np.array):
+    '''
+    Returns the energy and force RMSE of residuals (see CrossValidation.residuals) for every lambda.
+    '''
+    return (np.sqrt(np.mean(residuals[:, :n_fold]**2, axis=1)), np.sqrt(np.mean(residuals[:, n_fold:]**2, axis=1)))
+
+
+def cross_validate(u_conf: dict, configurations: list, C: np.array, q: np.array, k: int, lambdas: list,
+                   split='block', method='downdate') -> np.array:
+    '''
+    Returns the energy and force RMSE of every fold for every lambda as array of shape (len(lambdas), k, 2).
+    With method='downdate' the reference points (see calibration.reference_descriptors) are chosen once from all
+    configurations and the folds are left out of one factorization (see CrossValidation). With method='refit' every
+    fold is calibrated from scratch with reference points of its training configurations only, and the left out
+    configurations are predicted with Kernel.predict_batch.
+    '''
+    n_conf = len(configurations)
+    results = np.zeros((len(lambdas), k, 2))
+    if method == 'downdate':
+        C_ref = calibration.reference_descriptors(u_conf, C)
+        cv = CrossValidation(*calibration.build_linear(u_conf, configurations, C, q, C_ref))
+        for (i, fold) in enumerate(folds(n_conf, k, split)):
+            results[:, i] = np.transpose(rmse(cv.residuals(fold, lambdas), len(fold)))
+    elif method == 'refit':
+        # the prediction uses the same kernel as the fit in build_normal
+        kern = kernel.Kernel(
+            *u_conf['kernel'], force_mode=u_conf.get('force_mode', 'broadcast'), precision=u_conf.get('precision', 'float64')
+        )
+        for (i, fold) in enumerate(folds(n_conf, k, split)):
+            train = np.delete(np.arange(n_conf), fold)
+            u_train = dict(u_conf, N_conf=len(train))
+            C_ref = calibration.reference_descriptors(u_train, C[train])
+            (X, y, E_ave, _) = calibration.build_normal(u_train, [configurations[a] for a in train], C[train], q, C_ref)
+            test = [configurations[a] for a in fold]
+            E_test = np.array([config.energy for config in test])
+            F_test = np.array([config.forces for config in test])
+            for (j, w) in enumerate(calibration.solve_normal_path(X, y, lambdas)):
+                (E, F) = kern.predict_batch(q, test, C_ref, w, E_ave)
+                results[j, i] = (np.sqrt(np.mean((E - E_test)**2)), np.sqrt(np.mean((F - F_test)**2)))
+    else:
+        raise ValueError(f'method {method} is not supported, choose one of {METHODS}')
+    return results
+
+
+def learning_curve(E, F, K, T, E_test, F_test, K_test, T_test, sizes: list, lamb: float, seed=0) -> np.array:
+    '''
+    Fits the model to the first n of the training configurations (in a random order) for every n in sizes and
+    returns the rows (n, E_rmse, F_rmse) of the prediction of the test configurations. The columns of K, T and
+    K_test, T_test have to be the same reference points. The normal equations grow by the rows of the added
+    configurations, so the training set is only built once.
+    '''
+    n_conf = len(E)
+    n_ion = len(F) // (3 * n_conf)
+    if max(sizes) > n_conf:
+        raise ValueError(f'the learning curve cannot use more than the {n_conf} training configurations')
+    order = np.random.default_rng(seed).permutation(n_conf)
+    A = np.append(K, T, axis=0)
+    b = np.append(E, F)
+    N = np.shape(K)[1]
+    X = np.zeros((N, N))
+    # y without the centering, which subtracts <E> K^T 1
+    y = np.zeros(N)
+    K_sum = np.zeros(N)
+
+    results = []
+    n = 0
+    for size in sorted(sizes):
+        rows = fold_rows(order[n:size], n_conf, n_ion)
+        X += A[rows].T @ A[rows]
+        y += A[rows].T @ b[rows]
+        K_sum += np.sum(K[order[n:size]], axis=0)
+        n = size
+        E_ave = np.mean(E[order[:n]])
+        w = calibration.solve_normal(X, y - E_ave * K_sum, lamb)
+        results.append([n, np.sqrt(np.mean((K_test @ w + E_ave - E_test)**2)), np.sqrt(np.mean((T_test @ w - F_test)**2))])
+    return np.array(results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Cross-validates the calibration without user interaction.')
+    parser.add_argument('config', nargs='?', default='user_config.json', help='json-file of the calibration')
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--split', choices=SPLITS, default='block')
+    parser.add_argument('--method', choices=METHODS, default='downdate')
+    parser.add_argument('--lambdas', nargs='+', type=float, help='default: lambda of the json-file')
+    parser.add_argument('--learning-curve', nargs='+', type=int, default=None,
+                        help='numbers of training configurations of the learning curve, predicted at stepsize // 2')
+    parser.add_argument('--output', default='cross_validation.dat')
+    parser.add_argument('--curve-output', default='learning_curve.dat')
+    args = parser.parse_args(argv)
+
+    with open(args.config, 'r') as u_conf:
+        user_config = json.load(u_conf)
+    lambdas = args.lambdas or [user_config['lambda']]
+    # the learning curve predicts the configurations in between the training configurations, for stepsize 1 the
+    # offset stepsize // 2 would be the training set itself
+    if args.learning_curve is not None and user_config['stepsize'] < 2:
+        parser.error('--learning-curve needs a stepsize of at least 2 in the json-file')
+    qs = np.arange(1, user_config['nr_modi']+1) * pi / user_config['cutoff']
+
+    # the configurations and descriptors are held in memory for all folds
+    sets = []
+    for offset in ([0] if args.learning_curve is None else [0, user_config['stepsize'] // 2]):
+        u_conf = dict(user_config)
+        (u_conf['N_conf'], u_conf['N_ion'], u_conf['lattice_vectors'], configurations) = calibration.load_data(u_conf, offset)
+        C = np.zeros([u_conf['N_conf'], u_conf['N_ion'], u_conf['nr_modi']])
+        calibration.init_configurations(u_conf, configurations, qs, C)
+        sets.append((u_conf, configurations, C))
+
+    t_0 = time()
+    results = cross_validate(*sets[0], qs, args.folds, lambdas, args.split, args.method)
+    print(f'cross-validation: finished after {time()-t_0:.3} s')
+    # mean and spread of the RMSE of the folds
+    summary = np.concatenate((np.reshape(lambdas, (-1, 1)), np.mean(results, axis=1), np.std(results, axis=1)), axis=1)
+    for (lamb, E_rmse, F_rmse, E_std, F_std) in summary:
+        print(f'lambda = {lamb:.3g}: E rmse {E_rmse:.5f} +- {E_std:.5f}, F rmse {F_rmse:.5f} +- {F_std:.5f}')
+    np.savetxt(args.output, summary, header=f'{args.folds} folds ({args.split}, {args.method}): lambda E_rmse F_rmse E_rmse_std F_rmse_std')
+
+    if args.learning_curve is not None:
+        C_ref = calibration.reference_descriptors(sets[0][0], sets[0][2])
+        systems = [calibration.build_linear(*data, qs, C_ref) for data in sets]
+        curve = learning_curve(*systems[0], *systems[1], args.learning_curve, lambdas[0])
+        np.savetxt(args.curve_output, curve, header=f'lambda = {lambdas[0]}: N_conf E_rmse_prediction F_rmse_prediction')
+
+
+if __name__ == '__main__':
+    main()
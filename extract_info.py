@@ -1,42 +1,171 @@
-directory = "Gauss_hot"
-header = "Gaussian Kernel at high T with OUTCAR starting conditions"
-
-def main():
-    
-    # open vv.out in read-mode and save its content
-    file_in = open(directory + '/vv.out', 'r')
-    raw = file_in.readlines()
-    nr_lines = len(raw)
-    file_in.close()
-    
-    # create (or overwrite if it exists) the vv_extracted.out file and open it
-    file_out = open(directory + '/vv_extracted.csv', 'w')
-    file_out.write(header + "\n")
-    file_out.write("temperature (K);total energy (eV);Ion 1 x-position (A);Ion 1 x-velocity (A/fs);Ion 1 x-force;\n")
-    
-    # extract info line by line and write essential content
-    for i in range(nr_lines):
-        if "temperature" in raw[i]:
-            i += 1
-            file_out.write(raw[i].strip() + ";")
-        elif "total energy" in raw[i]:
-            i += 1
-            file_out.write(raw[i].strip() + ";")
-        elif "POSITIONS" in raw[i]:
-            i += 1
-            file_out.write(((raw[i].replace("[[", "")).strip()).split(" ")[0] + ";")
-        elif "VELOCITIES" in raw[i]:
-            i += 1
-            file_out.write(((raw[i].replace("[[", "")).strip()).split(" ")[0] + ";")
-        elif "FORCES" in raw[i]:
-            i += 1
-            file_out.write(((raw[i].replace("[[", "")).strip()).split(" ")[0] + "\n")
-        
-    
-    # close the output-file
-    file_out.close()
-    
+import argparse
+import os
+import numpy as np
+from trajectory import TRAJECTORY_FILE, iter_chunks
+
+# the observables, that can be extracted. frame is the index of the frame (the iteration block of vv.out), positions,
+# velocities and forces are extracted per ion and component, com_drift is the center of mass minus the one of the
+# first frame (per component)
+FIELDS = ('frame', 'temperature', 'kinetic_energy', 'potential_energy', 'total_energy', 'com_drift', 'positions', 'velocities', 'forces')
+PER_ION = ('positions', 'velocities', 'forces')
+COMPONENTS = 'xyz'
+# the lines of a block in vv.out, after which the value of a field follows
+TEXT_KEYS = {
+    'temperature (K):': 'temperature',
+    'kinetic energy (eV):': 'kinetic_energy',
+    'potential energy (eV):': 'potential_energy',
+    '--------------- POSITIONS ---------------': 'positions',
+    '--------------- VELOCITIES ---------------': 'velocities',
+    '--------------- FORCES ---------------': 'forces',
+}
+
+
+# Reads the frames of a vv.out file line by line and yields them in chunks of chunk_size frames as dicts
+# field -> array with the frames as first axis
+def iter_text_chunks(path: str, chunk_size=1000):
+    frames = []
+    frame = None
+    field = None
+    rows = []
+    with open(path, 'r') as vv_in:
+        for line in vv_in:
+            line = line.strip()
+            if line.startswith('***** Iteration block'):
+                if frame is not None:
+                    frames.append(frame)
+                if len(frames) == chunk_size:
+                    yield _stack_frames(frames)
+                    frames = []
+                frame = {'frame': int(line.split('(')[1].split(')')[0])}
+            elif line in TEXT_KEYS:
+                field = TEXT_KEYS[line]
+            elif field in PER_ION:
+                # the rows of the array as printed by numpy, the last one ends with ]]
+                if '...' in line:
+                    raise ValueError(f'{path} holds a shortened array, the full {field} were not written')
+                rows.append(line.replace('[', ' ').replace(']', ' ').split())
+                if line.endswith(']]'):
+                    frame[field] = np.array(rows, dtype=float)
+                    rows = []
+                    field = None
+            elif field is not None:
+                frame[field] = float(line)
+                field = None
+    if frame is not None:
+        frames.append(frame)
+    if frames:
+        yield _stack_frames(frames)
+
+
+# older vv.out files do not hold the temperature and energies, missing values are nan
+def _stack_frames(frames):
+    chunk = {field: np.array([frame[field] for frame in frames]) for field in PER_ION if field in frames[0]}
+    for field in ('frame', 'temperature', 'kinetic_energy', 'potential_energy'):
+        chunk[field] = np.array([frame.get(field, np.nan) for frame in frames])
+    return chunk
+
+
+# Yields the chunks of the binary trajectory file with the same fields as iter_text_chunks
+def iter_binary_chunks(path: str):
+    frames = 0
+    for chunk in iter_chunks(path):
+        n_frames = len(chunk['step'])
+        frames += n_frames
+        yield {
+            'frame': np.arange(frames - n_frames, frames),
+            'temperature': chunk['temperature'],
+            'kinetic_energy': chunk['kinetic_energy'],
+            'potential_energy': chunk['energy'],
+            'positions': chunk['positions'],
+            'velocities': chunk['velocities'],
+            'forces': chunk['forces'],
+        }
+
+
+def extract(chunks, fields: list, ions=(1, ), components='x', lattice=None) -> (list, np.array):
+    '''
+    Extracts the fields from the chunks (see iter_text_chunks / iter_binary_chunks) in one pass and returns the
+    column names and the columns as array of shape (frames, columns). The ions are counted from 1. With the lattice
+    constant the positions are unwrapped between the frames for com_drift, otherwise the wrapped positions are used.
+    '''
+    for field in fields:
+        if field not in FIELDS:
+            raise ValueError(f'field {field} is not supported, choose from {FIELDS}')
+    ion_index = np.array(ions) - 1
+    comp_index = np.array([COMPONENTS.index(c) for c in components])
+
+    names = []
+    for field in fields:
+        if field in PER_ION:
+            names += [f'{field}_{ion}_{c}' for ion in ions for c in components]
+        elif field == 'com_drift':
+            names += [f'com_drift_{c}' for c in COMPONENTS]
+        else:
+            names.append(field)
+
+    columns = []
+    # positions of the previous frame and the center of mass of the first frame for com_drift
+    previous = None
+    com_0 = None
+    for chunk in chunks:
+        block = []
+        for field in fields:
+            if field in PER_ION:
+                values = chunk[field][:, ion_index][:, :, comp_index]
+                block.append(values.reshape(len(values), -1))
+            elif field == 'com_drift':
+                positions = chunk['positions']
+                if lattice is not None:
+                    # unwrap the jumps over the boundaries, the ions move less than half a lattice constant per frame
+                    start = positions[:1] if previous is None else previous
+                    jumps = np.diff(np.concatenate((start, positions)), axis=0)
+                    positions = start + np.cumsum(jumps - lattice * np.round(jumps / lattice), axis=0)
+                    previous = positions[-1:]
+                com = np.mean(positions, axis=1)
+                if com_0 is None:
+                    com_0 = com[0]
+                block.append(com - com_0)
+            elif field == 'total_energy':
+                block.append((chunk['kinetic_energy'] + chunk['potential_energy']).reshape(-1, 1))
+            else:
+                block.append(np.reshape(chunk[field], (-1, 1)))
+        columns.append(np.concatenate(block, axis=1))
+
+    if not columns:
+        return (names, np.zeros((0, len(names))))
+    return (names, np.concatenate(columns))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Extracts observables of an MD run from vv.out or trajectory.bin.')
+    parser.add_argument('directory', help='folder of the MD run')
+    parser.add_argument('--fields', nargs='+', default=['temperature', 'total_energy', 'positions', 'velocities', 'forces'],
+                        choices=FIELDS, help='observables to extract')
+    parser.add_argument('--ions', nargs='+', type=int, default=[1], help='ions (counted from 1) of positions, velocities and forces')
+    parser.add_argument('--components', default='x', help='components of positions, velocities and forces, e.g. xyz')
+    parser.add_argument('--lattice', type=float, default=None, help='lattice constant to unwrap the positions for com_drift')
+    parser.add_argument('--source', choices=['auto', 'text', 'binary'], default='auto',
+                        help='read vv.out or trajectory.bin (auto: trajectory.bin if it exists)')
+    parser.add_argument('--format', choices=['csv', 'npz'], default='csv')
+    parser.add_argument('--output', default=None, help='output file, default vv_extracted.csv / .npz in the directory')
+    parser.add_argument('--header', default='', help='first line of the csv file')
+    args = parser.parse_args(argv)
+
+    binary_path = os.path.join(args.directory, TRAJECTORY_FILE)
+    if args.source == 'binary' or (args.source == 'auto' and os.path.isfile(binary_path)):
+        chunks = iter_binary_chunks(binary_path)
+    else:
+        chunks = iter_text_chunks(os.path.join(args.directory, 'vv.out'))
+
+    (names, columns) = extract(chunks, args.fields, args.ions, args.components, args.lattice)
+
+    output = args.output or os.path.join(args.directory, 'vv_extracted.' + args.format)
+    if args.format == 'csv':
+        header = (args.header + '\n' if args.header else '') + ';'.join(names)
+        np.savetxt(output, columns, fmt='%.16g', delimiter=';', header=header, comments='')
+    else:
+        np.savez(output, **{name: columns[:, k] for (k, name) in enumerate(names)})
+
 
 if __name__ == '__main__':
     main()
-
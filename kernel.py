@@ -1,6 +1,14 @@
+from collections import namedtuple
 import numpy as np
 import configuration
 
+# upper bound for the number of elements of the pair intermediates in gaussian_force_mat_sparse
+PAIR_BLOCK_SIZE = 2**22
+# eigenvalues of the kernel matrix of the reference points below this fraction of the largest are dropped in Uncertainty
+NYSTROEM_CUTOFF = 1e-10
+# the floating point types, in which Kernel can evaluate the kernel and force matrices
+PRECISIONS = {'float64': np.float64, 'float32': np.float32}
+
 # descr_list1 ist die aktuelle Konfiguration, descr_list2 die Referenz-Konfiguration!
 def linear_kernel(descr_list1: np.array, descr_list2: np.array) -> np.array:
     shape1 = np.shape(descr_list1)
@@ -15,13 +23,15 @@ def linear_kernel(descr_list1: np.array, descr_list2: np.array) -> np.array:
     return np.matmul(descr_list1, descr_list2.T) # it says in the documentation that matmul is preferred over dot
 
 # descr_list1 ist die aktuelle Konfiguration, descr_list2 die Referenz-Konfiguration!
-def gaussian_kernel(descr_list1: np.array, descr_list2: np.array, sigma: float) -> np.array:
+# abs2 are the squared norms of descr_list2, they can be passed if descr_list2 is used for many calls
+def gaussian_kernel(descr_list1: np.array, descr_list2: np.array, sigma: float, abs2=None) -> np.array:
 
     nbnj, nq = np.shape(descr_list1)
     nani, _ = np.shape(descr_list2)
 
     abs1 = np.sum(descr_list1 ** 2, axis=1)
-    abs2 = np.sum(descr_list2 ** 2, axis=1)
+    if abs2 is None:
+        abs2 = np.sum(descr_list2 ** 2, axis=1)
 
     coeffs = linear_kernel(descr_list1, descr_list2)
     
@@ -45,6 +55,17 @@ def linear_force_submat(q: np.array, config1: configuration, descriptors_array:
     if not nq == modi_config == modi_desc:
         raise ValueError('The nr of q\'s does not match')
 
+    q2 = -2 * q
+    # the product with the reference descriptors is done in their precision (see Kernel)
+    dtype = descriptors_array.dtype
+    if config1.nndistances is None:
+        # sparse neighbour list: sum over the pairs of each central atom
+        indptr, _, r, rhat = config1.nnpairs
+        # cosrq_R.shape = (npairs, dim, nq)
+        cosrq_R = np.cos(np.multiply.outer(r, q)).reshape(-1, 1, nq) * rhat.reshape(-1, dim, 1)
+        qcosrq_R = q2 * configuration.segment_sum(cosrq_R, indptr)
+        return (qcosrq_R.astype(dtype, copy=False) @ descriptors_array.T).reshape(nj * dim, nani)
+
     dist = config1.nndistances
     # R_over_r.shape = (nj', ni', dim)
     R_over_r = config1.nndisplace_norm
@@ -53,16 +74,19 @@ def linear_force_submat(q: np.array, config1: configuration, descriptors_array:
     # cosrq.shape = (nj', ni', nq)
     cosrq = np.cos(rq)
 
-    q2 = -2 * q
     # qcosrq_R.shape = (nj, dim, nq)
     qcosrq_R = q2 * np.sum(cosrq.reshape(nj, nj, 1, nq) * R_over_r.reshape(nj, nj, dim, 1), axis=1)
 
-    return (qcosrq_R @ descriptors_array.T).reshape(nj * dim, nani)
+    return (qcosrq_R.astype(dtype, copy=False) @ descriptors_array.T).reshape(nj * dim, nani)
 
 
 # builds part of the row for the force kernel matrix given a configuration and a set of descriptors
+# abs2 (squared norms of descriptors_array) and q_sig_Cia (-q/sigma^2 * descriptors_array) only depend on the
+# reference descriptors and can be passed, if they are used for many calls (see Kernel.bind)
+# All Gaussian force matrices are evaluated in the precision of descriptors_array, the geometry of config1 is
+# converted to it (see Kernel with precision='float32')
 ##### ##### Reference: Equation (21) ##### #####
-def gaussian_force_mat(q: np.array, config1: configuration, descriptors_array: np.array, sigma: float) -> np.array:
+def gaussian_force_mat(q: np.array, config1: configuration, descriptors_array: np.array, sigma: float, abs2=None, q_sig_Cia=None) -> np.array:
     nq = len(q)
     nj, modi_config = np.shape(config1.descriptors)
     _, dim = np.shape(config1.positions)
@@ -71,22 +95,28 @@ def gaussian_force_mat(q: np.array, config1: configuration, descriptors_array: n
     if not nq == modi_config == modi_desc:
         raise ValueError('The nr of q\'s does not match')
 
+    if config1.nndistances is None:
+        return gaussian_force_mat_sparse(q, config1, descriptors_array, sigma, abs2, q_sig_Cia)
+
+    dtype = descriptors_array.dtype
     dist = config1.nndistances
     # R_over_r.shape = (nj', ni', dim)
-    R_over_r = config1.nndisplace_norm
+    R_over_r = config1.nndisplace_norm.astype(dtype, copy=False)
 
     rq = dist.reshape(nj, nj, 1) * q.reshape(1, 1, nq)
     # cosrq.shape = (nj', ni', nq)
-    cosrq = np.cos(rq)
+    cosrq = np.cos(rq).astype(dtype, copy=False)
+    C_j = config1.descriptors.astype(dtype, copy=False)
 
     # kern.shape = (nj, nani)
-    kern = gaussian_kernel(config1.descriptors, descriptors_array, sigma)
+    kern = gaussian_kernel(C_j, descriptors_array, sigma, abs2)
 
-    q_sig = (-1/(sigma**2) * q)
+    q_sig = (-1/(sigma**2) * q).astype(dtype, copy=False)
     # q_sig_Cia.shape = (nani, nq)
-    q_sig_Cia = q_sig.reshape(1, nq) * descriptors_array
+    if q_sig_Cia is None:
+        q_sig_Cia = q_sig.reshape(1, nq) * descriptors_array
     # q_sig_Cj1.shape = (nj, nq)
-    q_sig_Cj1 = q_sig.reshape(1, nq) * config1.descriptors
+    q_sig_Cj1 = q_sig.reshape(1, nq) * C_j
     # cosrq_Ror.shape = (nj', ni', dim, nq)
     cosrq_Ror = cosrq.reshape(nj, nj, 1, nq) * R_over_r.reshape(nj, nj, dim, 1)
     # sumi_cosrq_Ror.shape = (nj', dim, nq)
@@ -102,23 +132,409 @@ def gaussian_force_mat(q: np.array, config1: configuration, descriptors_array: n
 
     return submat
 
+# Same as gaussian_force_mat, but the sums over the neighbours i and the modes q are done as matrix products
+# (one per mode) instead of broadcasting into a (nj, nj, dim, nani, nq) array. Apart from the (nj, nj, dim)
+# geometry tables no intermediate is bigger than the result (nj * dim, nani).
+##### ##### Reference: Equation (21) ##### #####
+def gaussian_force_mat_contracted(q: np.array, config1: configuration, descriptors_array: np.array, sigma: float, abs2=None, q_sig_Cia=None) -> np.array:
+    nq = len(q)
+    nj, modi_config = np.shape(config1.descriptors)
+    _, dim = np.shape(config1.positions)
+    nani, modi_desc = np.shape(descriptors_array)
+
+    if not nq == modi_config == modi_desc:
+        raise ValueError('The nr of q\'s does not match')
+
+    if config1.nndistances is None:
+        return gaussian_force_mat_sparse(q, config1, descriptors_array, sigma, abs2, q_sig_Cia)
+
+    dtype = descriptors_array.dtype
+    dist = config1.nndistances
+    # R_over_r.shape = (nj', ni', dim)
+    R_over_r = config1.nndisplace_norm.astype(dtype, copy=False)
+
+    rq = dist.reshape(nj, nj, 1) * q.reshape(1, 1, nq)
+    # cosrq.shape = (nj', ni', nq)
+    cosrq = np.cos(rq).astype(dtype, copy=False)
+    C_j = config1.descriptors.astype(dtype, copy=False)
+
+    # kern.shape = (nj, nani)
+    kern = gaussian_kernel(C_j, descriptors_array, sigma, abs2)
+
+    q_sig = (-1/(sigma**2) * q).astype(dtype, copy=False)
+    # q_sig_Cia.shape = (nani, nq)
+    if q_sig_Cia is None:
+        q_sig_Cia = q_sig.reshape(1, nq) * descriptors_array
+    # q_sig_Cj1.shape = (nj, nq)
+    q_sig_Cj1 = q_sig.reshape(1, nq) * C_j
+    # Ror_T.shape = (nj', dim, ni')
+    Ror_T = np.transpose(R_over_r, (0, 2, 1))
+    # sumi_cosrq_Ror.shape = (nj', dim, nq)
+    sumi_cosrq_Ror = np.matmul(Ror_T, cosrq)
+
+    # M_Ciai1 - M_Ci1i1, summed over i by one matrix product per mode
+    cosrq_Cj1 = np.sum(cosrq * q_sig_Cj1.reshape(1, nj, nq), axis=2)
+    submat = -((cosrq_Cj1.reshape(nj, 1, nj) * Ror_T).reshape(nj * dim, nj) @ kern)
+    for k in range(nq):
+        submat += ((cosrq[:, :, k].reshape(nj, 1, nj) * Ror_T).reshape(nj * dim, nj) @ kern) * q_sig_Cia[:, k]
+
+    submat = submat.reshape(nj, dim, nani)
+    # M_Ciaj1 - M_Cj1j1
+    submat += (
+        (sumi_cosrq_Ror.reshape(nj * dim, nq) @ q_sig_Cia.T).reshape(nj, dim, nani)
+        - np.sum(sumi_cosrq_Ror * q_sig_Cj1.reshape(nj, 1, nq), axis=2).reshape(nj, dim, 1)
+    ) * kern.reshape(nj, 1, nani)
+
+    return submat.reshape(nj*dim, nani)
+
+
+# Same as gaussian_force_mat, but works on the sparse neighbour list config1.nnpairs instead of the dense tables,
+# so memory and work scale with the number of pairs instead of nj^2.
+# If the kernel matrix kern of config1.descriptors and descriptors_array is already known (e.g. in sweep.py), it can
+# be passed as well.
+##### ##### Reference: Equation (21) ##### #####
+def gaussian_force_mat_sparse(q: np.array, config1: configuration, descriptors_array: np.array, sigma: float, abs2=None, q_sig_Cia=None, kern=None) -> np.array:
+    nq = len(q)
+    nj, modi_config = np.shape(config1.descriptors)
+    _, dim = np.shape(config1.positions)
+    nani, modi_desc = np.shape(descriptors_array)
+
+    if not nq == modi_config == modi_desc:
+        raise ValueError('The nr of q\'s does not match')
+
+    dtype = descriptors_array.dtype
+    indptr, neighbours, r, rhat = config1.nnpairs
+    rhat = rhat.astype(dtype, copy=False)
+
+    # cosrq.shape = (npairs, nq)
+    cosrq = np.cos(np.multiply.outer(r, q)).astype(dtype, copy=False)
+    C_j = config1.descriptors.astype(dtype, copy=False)
+
+    # kern.shape = (nj, nani)
+    if kern is None:
+        kern = gaussian_kernel(C_j, descriptors_array, sigma, abs2)
+
+    q_sig = (-1/(sigma**2) * q).astype(dtype, copy=False)
+    # q_sig_Cia.shape = (nani, nq)
+    if q_sig_Cia is None:
+        q_sig_Cia = q_sig.reshape(1, nq) * descriptors_array
+    # q_sig_Cj1.shape = (nj, nq)
+    q_sig_Cj1 = q_sig.reshape(1, nq) * C_j
+    # cosrq_Ror.shape = (npairs, dim, nq)
+    cosrq_Ror = cosrq.reshape(-1, 1, nq) * rhat.reshape(-1, dim, 1)
+    # sumi_cosrq_Ror.shape = (nj', dim, nq)
+    sumi_cosrq_Ror = configuration.segment_sum(cosrq_Ror, indptr).astype(dtype, copy=False)
+    # cosrq_Cj1.shape = (npairs, )
+    cosrq_Cj1 = np.sum(cosrq * q_sig_Cj1[neighbours], axis=1)
+
+    # M_Ciai1 - M_Ci1i1 are summed over the pairs of a block of central atoms at a time to bound the memory
+    submat = np.empty((nj, dim, nani), dtype=dtype)
+    pairs_per_atom = max(1, indptr[-1] // max(1, nj))
+    block = max(1, PAIR_BLOCK_SIZE // (pairs_per_atom * dim * nani))
+    for start in range(0, nj, block):
+        stop = min(start + block, nj)
+        p0, p1 = indptr[start], indptr[stop]
+        # pair_terms.shape = (p1-p0, dim, nani)
+        pair_terms = (cosrq_Ror[p0:p1].reshape(-1, nq) @ q_sig_Cia.T).reshape(p1 - p0, dim, nani)
+        pair_terms -= (cosrq_Cj1[p0:p1].reshape(-1, 1) * rhat[p0:p1]).reshape(p1 - p0, dim, 1)
+        pair_terms *= kern[neighbours[p0:p1]].reshape(p1 - p0, 1, nani)
+        submat[start:stop] = configuration.segment_sum(pair_terms, indptr[start:stop+1] - p0)
+
+    M_Ciaj1 = (sumi_cosrq_Ror.reshape(nj * dim, nq) @ q_sig_Cia.T).reshape(nj, dim, nani) * kern.reshape(nj, 1, nani)
+    M_Cj1j1 = (np.sum(sumi_cosrq_Ror * q_sig_Cj1.reshape(nj, 1, nq), axis=2)).reshape(nj, dim, 1) * kern.reshape(nj, 1, nani)
+
+    submat += M_Ciaj1 - M_Cj1j1
+
+    return submat.reshape(nj*dim, nani)
+
+# For a prediction only T @ w is needed, so the weights are contracted with the reference descriptors before the
+# sums over the neighbours. Both functions take the descriptors (n, nq) and the NeighbourList of n atoms, which can
+# belong to several configurations (see configuration.stack_neighbour_lists), and return the contributions of the
+# atoms to the energy (n, ) and their forces (n, dim). The (n * dim, nani) matrix T is never built.
+##### ##### Reference: Equation (22) ##### #####
+def linear_energy_forces(q: np.array, descriptors: np.array, nnpairs: tuple, Cw_sum: np.array) -> (np.array, np.array):
+    '''
+    Cw_sum = C^T w (nq, ) is the sum of the reference descriptors weighted with the weights.
+    '''
+    indptr, _, r, rhat = nnpairs
+    # every pair contributes to the force on its central atom with -2 sum_q q cos(rq) (C^T w)_q
+    pair_terms = np.cos(np.multiply.outer(r, q)) @ (-2 * q * Cw_sum)
+    forces = configuration.segment_sum(pair_terms.reshape(-1, 1) * rhat, indptr)
+    return (descriptors @ Cw_sum, forces)
+
+
+##### ##### Reference: Equation (22) ##### #####
+def gaussian_energy_forces(q: np.array, descriptors: np.array, nnpairs: tuple, descriptors_array: np.array, weights: np.array,
+                           sigma: float, abs2=None, Cw=None) -> (np.array, np.array):
+    '''
+    abs2 are the squared norms of the reference descriptors_array and Cw = weights * descriptors_array,
+    both are computed if they are not given. The kernel matrix is evaluated in the precision of descriptors_array,
+    the sums over the pairs in float64.
+    '''
+    indptr, neighbours, r, rhat = nnpairs
+    if Cw is None:
+        Cw = weights.reshape(-1, 1) * descriptors_array
+
+    # kern.shape = (n, nani)
+    kern = gaussian_kernel(descriptors, descriptors_array, sigma, abs2)
+    q_sig = (-1/(sigma**2) * q)
+    # kern_w.shape = (n, ), the energy contributions
+    kern_w = kern @ weights
+    # G.shape = (n, nq): sum_a k(C_j, C_a) w_a q_sig (C_a - C_j), the derivative of the energy of atom j with
+    # respect to its descriptors
+    G = q_sig * (kern @ Cw - descriptors * kern_w.reshape(-1, 1))
+
+    # a pair (j, i) changes the descriptors of both atoms, i.e. it contributes the derivatives of both energies
+    cosrq = np.cos(np.multiply.outer(r, q))
+    pair_terms = np.sum(cosrq * (G[neighbours] + G[configuration.pair_rows(indptr)]), axis=1)
+    forces = configuration.segment_sum(pair_terms.reshape(-1, 1) * rhat, indptr)
+    return (kern_w, forces)
+
+# The arrays, that only depend on the reference descriptors (and weights), and are the same for every call
+# of the kernel with these reference descriptors. abs2, q_sig_C and Cw are only needed for the Gaussian kernel,
+# Cw and Cw_sum only if the weights are known.
+# descriptors and weights are the arrays the reference was made for (compared by identity), C and w the same
+# in the precision of the kernel, in which abs2, q_sig_C and Cw are stored as well (for float64 C is descriptors).
+Reference = namedtuple('Reference', ['q', 'descriptors', 'weights', 'abs2', 'q_sig_C', 'Cw', 'Cw_sum', 'C', 'w'])
+
+
+def reference_cache(q: np.array, descriptors_array: np.array, weights=None, sigma=None, dtype=np.float64) -> Reference:
+    '''
+    Precomputes the squared norms |C_a|^2 and -q/sigma^2 * C_a of the reference descriptors (if sigma is given)
+    and the sum of the weighted descriptors C^T w and, with sigma, the weighted descriptors w_a * C_a themselves
+    (if the weights are given). They are computed in float64 and stored in dtype, C^T w always in float64.
+    '''
+    abs2 = q_sig_C = Cw = Cw_sum = w = None
+    if sigma is not None:
+        abs2 = np.sum(descriptors_array**2, axis=1).astype(dtype, copy=False)
+        q_sig_C = ((-1/(sigma**2) * q).reshape(1, -1) * descriptors_array).astype(dtype, copy=False)
+    if weights is not None:
+        Cw_sum = descriptors_array.T @ weights
+        w = weights.astype(dtype, copy=False)
+        if sigma is not None:
+            Cw = (weights.reshape(-1, 1) * descriptors_array).astype(dtype, copy=False)
+    C = descriptors_array.astype(dtype, copy=False)
+    return Reference(q, descriptors_array, weights, abs2, q_sig_C, Cw, Cw_sum, C, w)
+
+# the implementations of the Gaussian force matrix, that can be chosen with force_mode
+GAUSSIAN_FORCE_MODES = {
+    'broadcast': gaussian_force_mat,
+    'contracted': gaussian_force_mat_contracted,
+}
+
+# With precision='float32' the kernel and force matrices are evaluated in float32, which halves the memory and
+# bandwidth of the (n * dim, nani) products. The geometry (distances, cos(rq)) and the reference arrays are computed
+# in float64 and then converted, the sums over the atoms of a configuration (K, the energies and the forces of
+# predict_batch and Predictor) are accumulated in float64 and the solve of the calibration stays in float64.
+# The arrays returned by kernel_mat and force_submat have the dtype of the precision.
 class Kernel:
-    def __init__(self, mode, *args):
+    def __init__(self, mode, *args, force_mode='broadcast', precision='float64'):
+        self.mode = mode
+        self.sigma = args[0] if mode == 'gaussian' and args else None
+        if precision not in PRECISIONS:
+            raise ValueError(f'precision {precision} is not supported, choose one of {tuple(PRECISIONS)}')
+        self.precision = precision
+        self.dtype = PRECISIONS[precision]
         if mode == 'linear':
-            self.kernel_mat = linear_kernel
-            self.force_submat = linear_force_submat
+            # in float64 the functions are used as they are
+            self.kernel_mat = linear_kernel if precision == 'float64' else self.linear_kernel_mat
+            self.force_submat = linear_force_submat if precision == 'float64' else self.linear_force_submat
         elif mode == 'gaussian':
             if not args:
                 raise ValueError('For the Gaussian Kernel a sigma has to be supplied')
-            self.kernel_mat = lambda x, y: gaussian_kernel(x, y, args[0])
-            self.force_submat = lambda x, y, z: gaussian_force_mat(x, y, z, args[0])
+            if force_mode not in GAUSSIAN_FORCE_MODES:
+                raise ValueError(f'force mode {force_mode} is not supported')
+            self.force_mat = GAUSSIAN_FORCE_MODES[force_mode]
+            self.kernel_mat = self.gaussian_kernel_mat
+            self.force_submat = self.gaussian_force_submat
         else:
             raise ValueError(f'kernel {mode} is not supported')
+        # the reference set, the kernel is bound to
+        self.reference = None
+
+    # Binds the kernel to a fixed set of reference descriptors (and weights), e.g. the calibration in an MD run.
+    # The arrays derived from them are computed once and used by every later call with the same descriptors
+    # object (and weights), so that these calls only pay for the terms of the current configuration.
+    def bind(self, qs: np.array, descriptors: np.array, weights=None) -> None:
+        self.reference = reference_cache(qs, descriptors, weights, self.sigma, self.dtype)
+
+    # returns the bound reference, if it belongs to these descriptors (and weights), otherwise a new one
+    def cached_reference(self, qs: np.array, descriptors: np.array, weights=None) -> Reference:
+        ref = self.reference
+        if (
+            ref is not None and ref.descriptors is descriptors and np.array_equal(ref.q, qs)
+            and (weights is None or ref.weights is weights)
+        ):
+            return ref
+        return reference_cache(qs, descriptors, weights, self.sigma, self.dtype)
+
+    # the reference descriptors in the precision of the kernel, from the bound reference if it belongs to them
+    def cast_reference(self, descriptors: np.array) -> np.array:
+        ref = self.reference
+        if ref is not None and ref.descriptors is descriptors:
+            return ref.C
+        return descriptors.astype(self.dtype, copy=False)
+
+    def linear_kernel_mat(self, descr_list1: np.array, descr_list2: np.array) -> np.array:
+        return linear_kernel(descr_list1.astype(self.dtype, copy=False), self.cast_reference(descr_list2))
+
+    def linear_force_submat(self, q: np.array, config1: configuration, descriptors_array: np.array) -> np.array:
+        return linear_force_submat(q, config1, self.cast_reference(descriptors_array))
+
+    def gaussian_kernel_mat(self, descr_list1: np.array, descr_list2: np.array) -> np.array:
+        ref = self.reference
+        abs2 = ref.abs2 if ref is not None and ref.descriptors is descr_list2 else None
+        return gaussian_kernel(descr_list1.astype(self.dtype, copy=False), self.cast_reference(descr_list2), self.sigma, abs2)
+
+    def gaussian_force_submat(self, q: np.array, config1: configuration, descriptors_array: np.array) -> np.array:
+        ref = self.reference
+        if ref is not None and ref.descriptors is descriptors_array and np.array_equal(ref.q, q):
+            return self.force_mat(q, config1, ref.C, self.sigma, ref.abs2, ref.q_sig_C)
+        return self.force_mat(q, config1, descriptors_array.astype(self.dtype, copy=False), self.sigma)
 
     def predict(self, qs: np.array, config: configuration, descriptors: np.array, weights: np.array, E_ave: float) -> (float, np.array):
-        ni, _ = config.nndistances.shape
-        K = np.sum(self.kernel_mat(config.descriptors, descriptors), axis=0)
+        ni, _ = config.positions.shape
+        K = np.sum(self.kernel_mat(config.descriptors, descriptors), axis=0, dtype=np.float64)
         E = K @ weights + E_ave
         F_reg = self.force_submat(qs, config, descriptors) @ weights
         F_reg = F_reg.reshape(ni, 3)
         return (E, F_reg)
+
+    def predict_batch(self, qs: np.array, configurations: list, descriptors: np.array, weights: np.array, E_ave: float) -> (np.array, np.array):
+        '''
+        Predicts the energies (n_conf, ) and forces (n_conf, n_ion, dim) of many configurations with the same number
+        of ions, which have to be initialized with init_nn and init_descriptor. The weights are contracted with the
+        reference descriptors once for the whole batch and T is never built. The configurations are evaluated in
+        blocks, so that the kernel matrix of a block has at most PAIR_BLOCK_SIZE elements.
+        '''
+        n_conf = len(configurations)
+        n_ion, dim = np.shape(configurations[0].positions)
+        nani, _ = np.shape(descriptors)
+
+        # the reference side is the same for all configurations (and already prepared, if the kernel is bound to it)
+        ref = self.cached_reference(qs, descriptors, weights)
+        if self.mode == 'linear':
+            energy_forces = lambda C, pairs: linear_energy_forces(qs, C, pairs, ref.Cw_sum)
+        else:
+            energy_forces = lambda C, pairs: gaussian_energy_forces(
+                qs, C.astype(self.dtype, copy=False), pairs, ref.C, ref.w, self.sigma, ref.abs2, ref.Cw
+            )
+
+        E = np.zeros(n_conf)
+        F = np.zeros((n_conf, n_ion, dim))
+        block = max(1, PAIR_BLOCK_SIZE // (n_ion * nani))
+        for start in range(0, n_conf, block):
+            stop = min(start + block, n_conf)
+            C = np.concatenate([config.descriptors for config in configurations[start:stop]])
+            pairs = configuration.stack_neighbour_lists([config.nnpairs for config in configurations[start:stop]])
+            (E_atoms, F_atoms) = energy_forces(C, pairs)
+            E[start:stop] = np.sum(E_atoms.reshape(stop - start, n_ion), axis=1, dtype=np.float64) + E_ave
+            F[start:stop] = F_atoms.reshape(stop - start, n_ion, dim)
+        return (E, F)
+
+
+# Production path for prediction, e.g. in an MD run: the kernel is bound to the calibration once and the energy
+# and forces of a configuration are evaluated in the weight-contracted form (see linear_energy_forces and
+# gaussian_energy_forces) instead of building T. For the linear kernel only the nq-vector C^T w is kept, so a
+# prediction costs O(n_pairs * nq), independent of the size of the training set. With a float32 kernel the Gaussian
+# kernel matrix of the atoms and the reference points is evaluated in float32 (see Kernel).
+class Predictor:
+    def __init__(self, kern: Kernel, qs: np.array, descriptors: np.array, weights: np.array, E_ave: float):
+        self.kernel = kern
+        self.qs = qs
+        self.E_ave = E_ave
+        if kern.mode == 'linear':
+            # only the nq-vector C^T w is used, which is kept in float64
+            self.reference = reference_cache(qs, descriptors, weights)
+        else:
+            kern.bind(qs, descriptors, weights)
+            self.reference = kern.reference
+
+    # returns the energy contributions (n, ) and forces (n, dim) of the atoms with these descriptors and NeighbourList
+    def energy_forces(self, descriptors: np.array, nnpairs: tuple) -> (np.array, np.array):
+        ref = self.reference
+        if self.kernel.mode == 'linear':
+            return linear_energy_forces(self.qs, descriptors, nnpairs, ref.Cw_sum)
+        return gaussian_energy_forces(
+            self.qs, descriptors.astype(self.kernel.dtype, copy=False), nnpairs, ref.C, ref.w, self.kernel.sigma, ref.abs2, ref.Cw
+        )
+
+    # predicts the energy and forces of a configuration, that is initialized with init_nn and init_descriptor
+    def predict(self, config: configuration) -> (float, np.array):
+        (E_atoms, forces) = self.energy_forces(config.descriptors, config.nnpairs)
+        return (np.sum(E_atoms, dtype=np.float64) + self.E_ave, forces)
+
+
+def low_rank_eigh(X: np.array, rank: int, n_iter=4, oversampling=10, rng=None) -> (np.array, np.array):
+    '''
+    Returns the rank largest eigenvalues (ascending) and eigenvectors (N, rank) of the symmetric positive semidefinite
+    X. For rank < N / 2 they are found by a randomized subspace iteration with n_iter power iterations, which costs
+    O(N^2 rank) instead of the O(N^3) of np.linalg.eigh.
+    '''
+    N = np.shape(X)[0]
+    if 2 * rank >= N:
+        (s, V) = np.linalg.eigh(X)
+        return (s[-rank:], V[:, -rank:])
+    rng = np.random.default_rng(0) if rng is None else rng
+    Q = np.linalg.qr(X @ rng.normal(size=(N, rank + oversampling)))[0]
+    for _ in range(n_iter):
+        Q = np.linalg.qr(X @ Q)[0]
+    (s, W) = np.linalg.eigh(Q.T @ X @ Q)
+    return (s[-rank:], Q @ W[:, -rank:])
+
+
+# Predictive variance of the energy contributions of atoms, e.g. to find the frames of an MD run, that are far outside
+# of the training data. It is the sum of two terms:
+#   - the variance of the fit: in the Bayesian view of the ridge regression the weights have the covariance
+#     (X + lamb I)^-1 (in units of the noise), where X = K^T K + T^T T, so the energy of an atom with the kernel row
+#     k = k(C_i, C_ref) has the variance k^T (X + lamb I)^-1 k. Only the rank largest eigenpairs (s, V) of X are kept,
+#     the eigenvalues of the rest of the spectrum are bounded below by 0, so the variance is bounded above by
+#       k^T (X + lamb I)^-1 k <= sum_k (v_k^T k)^2 / (s_k + lamb) + (|k|^2 - sum_k (v_k^T k)^2) / lamb
+#     a conservative estimate, that does not hide the part of k outside of the kept eigenvectors
+#   - for the Gaussian kernel the part of the environment, that the reference points cannot represent (Nystroem):
+#     k(C_i, C_i) - k^T K_ref^-1 k with the kernel matrix K_ref of the reference points, again from its rank largest
+#     eigenpairs. It is 1 far away from all reference points, where the kernel row and with it the first term vanish.
+# A step costs one kernel row per atom and its products with the eigenvectors (for the linear kernel only nq x rank
+# products).
+class Uncertainty:
+    def __init__(self, kern: Kernel, qs: np.array, descriptors: np.array, X: np.array, lamb: float, rank=256):
+        self.kernel = kern
+        self.lamb = lamb
+        (s, V) = low_rank_eigh(X, min(rank, len(X)))
+        self.s = np.maximum(s, 0)
+        if kern.mode == 'linear':
+            # k = C C_ref^T, so k V = C (C_ref^T V) and |k|^2 = C (C_ref^T C_ref) C^T
+            self.CV = descriptors.T @ V
+            self.CC = descriptors.T @ descriptors
+        else:
+            self.V = V
+            self.reference = reference_cache(qs, descriptors, sigma=kern.sigma)
+            K_ref = gaussian_kernel(descriptors, descriptors, kern.sigma, self.reference.abs2)
+            (mu, U) = low_rank_eigh(K_ref, min(rank, len(K_ref)))
+            # the eigenvalues at the rounding level of K_ref are dropped, U is scaled so that k^T K_ref^-1 k = |k U|^2
+            keep = mu > NYSTROEM_CUTOFF * mu[-1]
+            self.U = U[:, keep] / np.sqrt(mu[keep])
+
+    # the uncertainty of a calibration, whose model file holds the normal matrix X (saved with 'updatable')
+    @classmethod
+    def from_model(cls, kern: Kernel, qs: np.array, model: dict, rank=256):
+        if 'X' not in model:
+            raise ValueError('the model file holds no normal matrix X, calibrate with the key updatable')
+        return cls(kern, qs, model['C'], model['X'], model['lambda'], rank)
+
+    # returns the predictive variance (n, ) of the energy of the atoms with these descriptors
+    def variance(self, descriptors: np.array) -> np.array:
+        if self.kernel.mode == 'linear':
+            P = descriptors @ self.CV
+            norm2 = np.sum((descriptors @ self.CC) * descriptors, axis=1)
+            residual = 0
+        else:
+            ref = self.reference
+            kern = gaussian_kernel(descriptors, ref.descriptors, self.kernel.sigma, ref.abs2)
+            P = kern @ self.V
+            norm2 = np.sum(kern**2, axis=1)
+            # k(C_i, C_i) = 1
+            residual = np.maximum(1 - np.sum((kern @ self.U)**2, axis=1), 0)
+        P2 = P**2
+        rest = np.maximum(norm2 - np.sum(P2, axis=1), 0)
+        return P2 @ (1 / (self.s + self.lamb)) + rest / self.lamb + residual
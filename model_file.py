@@ -0,0 +1,142 @@
+import json
+import os
+import struct
+import numpy as np
+
+# Binary format of a calibration ("model file"):
+# The file starts with MAGIC, the format version and the length of a json header. The header holds the scalar
+# parameters of the calibration and, for every array, its dtype, shape and byte offset in the file.
+# The arrays follow the header, each aligned to ALIGNMENT bytes, so that they can be memory mapped. Several
+# processes that map the same file then share one copy of the descriptors in memory.
+MAGIC = b'LPMLMODL'
+VERSION = 1
+ALIGNMENT = 64
+PREFIX = struct.Struct('<8sII') # magic, version, length of the header
+MODEL_FILE = 'calibration.model'
+# the parameters of the model file, that have to match the json-file of a run using the calibration
+CHECKED_PARAMS = ('kernel', 'cutoff', 'nr_modi')
+
+
+def save_model(path: str, arrays: dict, params: dict) -> None:
+    '''
+    Writes the arrays (name -> np.array) and the json serializable parameters into a model file.
+    The file is written next to path and then moved onto it, so that processes, which have the old file memory
+    mapped (e.g. MD runs during update.py), keep reading the old version instead of a truncated file.
+    '''
+    entries = {}
+    offset = 0
+    for (name, values) in arrays.items():
+        values = np.ascontiguousarray(values)
+        entries[name] = {'dtype': values.dtype.str, 'shape': list(values.shape), 'offset': offset}
+        offset += -(-values.nbytes // ALIGNMENT) * ALIGNMENT
+
+    header = json.dumps({'params': params, 'arrays': entries}).encode()
+    # the arrays start at the first aligned byte after the header
+    start = -(-(PREFIX.size + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as model_out:
+            model_out.write(PREFIX.pack(MAGIC, VERSION, len(header)))
+            model_out.write(header)
+            for (name, values) in arrays.items():
+                model_out.seek(start + entries[name]['offset'])
+                model_out.write(np.ascontiguousarray(values).tobytes())
+            model_out.truncate(start + offset)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_model(path: str, mmap=True) -> dict:
+    '''
+    Loads a model file and returns its parameters and arrays in one dict.
+    With mmap=True the arrays are read-only memory maps of the file, otherwise they are read into memory.
+    '''
+    with open(path, 'rb') as model_in:
+        magic, version, header_len = PREFIX.unpack(model_in.read(PREFIX.size))
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a model file')
+        if version != VERSION:
+            raise ValueError(f'model file version {version} is not supported (expected {VERSION})')
+        header = json.loads(model_in.read(header_len).decode())
+    start = -(-(PREFIX.size + header_len) // ALIGNMENT) * ALIGNMENT
+
+    model = dict(header['params'])
+    for (name, entry) in header['arrays'].items():
+        dtype = np.dtype(entry['dtype'])
+        shape = tuple(entry['shape'])
+        if mmap and np.prod(shape) > 0:
+            model[name] = np.memmap(path, dtype=dtype, mode='r', offset=start + entry['offset'], shape=shape)
+        else:
+            model[name] = np.fromfile(
+                path, dtype=dtype, count=int(np.prod(shape)), offset=start + entry['offset']
+            ).reshape(shape)
+    return model
+
+
+def save_calibration(directory: str, u_conf: dict, C: np.array, w: np.array, E_ave: float, q: np.array, text=True, sums=None) -> None:
+    '''
+    Saves the result of a calibration as model file into the directory. With text=True the
+    calibration_{w,C,E}.out text files are written as well. The sums of the normal equations of an updatable
+    calibration (see calibration.accumulators) are stored in the model file as well.
+    '''
+    kern = u_conf['kernel']
+    params = {
+        'kernel': kern,
+        'sigma': kern[1] if kern[0] == 'gaussian' else None,
+        'cutoff': u_conf['cutoff'],
+        'nr_modi': u_conf['nr_modi'],
+        'lambda': u_conf['lambda'],
+        'E_ave': float(E_ave),
+    }
+    descriptors = np.reshape(C, (-1, np.shape(C)[-1]))
+    arrays = {'w': w, 'C': descriptors, 'q': q}
+    if sums is not None:
+        params.update(updatable=True, E_sum=sums['E_sum'], n_conf=sums['n_conf'])
+        arrays.update({name: sums[name] for name in ('X', 'y', 'K_sum', 'L') if sums[name] is not None})
+    save_model(os.path.join(directory, MODEL_FILE), arrays, params)
+
+    if text:
+        np.savetxt(directory + '/calibration_w.out', w)
+        np.savetxt(directory + '/calibration_C.out', descriptors)
+        np.savetxt(directory + '/calibration_E.out', [E_ave, E_ave])
+
+
+def check_params(model: dict, u_conf: dict) -> None:
+    '''
+    Raises a ValueError, if kernel, cutoff or nr_modi of the model file differ from the json-file u_conf,
+    which would give wrong energies and forces with the calibration.
+    '''
+    differ = [
+        f'{name}: {model[name]} (model file) != {u_conf[name]} (json-file)' for name in CHECKED_PARAMS
+        if name in model and name in u_conf and (
+            list(model[name]) != list(u_conf[name]) if name == 'kernel' else not np.isclose(model[name], u_conf[name])
+        )
+    ]
+    if differ:
+        raise ValueError('the json-file does not match the calibration, ' + ', '.join(differ))
+
+
+def load_calibration(directory: str, mmap=True, u_conf=None) -> dict:
+    '''
+    Loads the calibration from the model file in the directory, if there is one, and from the
+    calibration_{w,C,E}.out text files otherwise. Always contains the keys 'C', 'w' and 'E_ave'.
+    With the json-file u_conf the parameters of the model file are checked against it (see check_params),
+    the text files hold no parameters to check.
+    '''
+    path = os.path.join(directory, MODEL_FILE)
+    if os.path.isfile(path):
+        model = load_model(path, mmap)
+        if u_conf is not None:
+            check_params(model, u_conf)
+        return model
+
+    E_ave, _ = np.array(np.loadtxt(directory + '/calibration_E.out'), dtype=float)
+    return {
+        'C': np.array(np.loadtxt(directory + '/calibration_C.out'), dtype=float),
+        'w': np.array(np.loadtxt(directory + '/calibration_w.out'), dtype=float),
+        'E_ave': E_ave,
+    }
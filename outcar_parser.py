@@ -1,5 +1,9 @@
-from re import match, search, IGNORECASE
-from numpy import array, shape, fromstring, array_equal, diag
+from collections import namedtuple
+from mmap import mmap, ACCESS_READ
+from os import stat
+from re import match, search, compile as re_compile, IGNORECASE
+from sys import argv
+from numpy import array, shape, fromstring, array_equal, diag, load, savez, nan, isnan, int64
 
 
 # Hier werden die patterns und Textbausteine gespeichert, nach denen später das File durchsucht oder aufgespalten wird
@@ -8,44 +12,66 @@ SPLIT_POS = ' ' + 83*'-'
 ION_PATTERN = r'number of ions\s*nions\s*=\s*(\d+)'
 LATTICE_PATTERN = r'direct\s*lattice\s*vectors.*\n\s*((?:\d+.\d+\s*){3}).*\n\s*((?:\d+.\d+\s*){3}).*\n\s*((?:\d+.\d+\s*){3}).*'
 ENERGY_PATTERN = r'free\s*energy\s*toten\s*=\s*(-?\d+.\d+)'
+# Endung der Index-Datei, die neben dem OUTCAR-file abgelegt wird
+INDEX_SUFFIX = '.idx.npz'
+
+# Endung des binären Caches (siehe write_cache), der neben dem OUTCAR-file abgelegt wird
+CACHE_SUFFIX = '.cache.npz'
+
+# Index eines OUTCAR-files: für jede Konfiguration der Byte-Offset direkt hinter der SPLIT_CONFIGS Zeile und das Ende
+# ihres Textes, sowie Energie und Anzahl der Ionen. Damit kann jede Konfiguration direkt gelesen werden.
+OutcarIndex = namedtuple('OutcarIndex', ['offsets', 'ends', 'energies', 'ion_numbers'])
 
 '''
 Hauptobjekt des packages. Es dient dazu die datei zu laden, den Inhalt zentral abzuspeichern und zu verarbeiten.
 Dabei lassen sich nur files öffnen, die mit "outcar.digit" *enden*!
+Mit stream=True wird der Inhalt nicht geladen (outcar_content ist dann None), sondern die Datei bei Bedarf über mmap
+durchsucht bzw. zeilenweise gelesen, sodass auch sehr große OUTCAR-files verarbeitet werden können.
+Mit index=True wird der Inhalt ebenfalls nicht geladen, sondern über einen Index (siehe OutcarIndex) direkt auf die
+einzelnen Konfigurationen zugegriffen. Der Index wird beim ersten Zugriff erstellt und neben dem OUTCAR-file
+gespeichert. Ändern sich Größe oder Änderungszeit des OUTCAR-files, wird er automatisch neu erstellt.
 '''
 class Parser:
     # initializiert das Objekt und lädt den Inhalt der Datei, falls es ein OUTCAR-file ist.
-    def __init__(self, filepath: str):
+    def __init__(self, filepath: str, stream=False, index=False):
         self.filepath = filepath
         if not search(r'outcar\.\d+', self.filepath, IGNORECASE):
             raise ValueError(f'expected outcar file, got {self.filepath}')
 
-        with open(self.filepath, 'r') as outcar_in:
-            self.outcar_content = outcar_in.read()
+        self.stream = stream
+        self.use_index = index
+        self.__index = None
+        if stream or index:
+            # wirft wie open einen FileNotFoundError, falls die Datei nicht existiert
+            stat(self.filepath)
+            self.outcar_content = None
+        else:
+            with open(self.filepath, 'r') as outcar_in:
+                self.outcar_content = outcar_in.read()
 
     # Durchsucht den Inhalt nach dem oben angegebenen Muster, sprich nach der Zeile, in der die Ionen stehen
     # Falls die entsprechende Zeile nicht auffindbar ist, bricht das Programm ab
     def find_ion_nr(self) -> int:
-        ion_match = search(ION_PATTERN,
-                            self.outcar_content,
-                            IGNORECASE)
+        # Mit Index wird die Ionenzahl der ersten Konfiguration aus dem Index genommen
+        if self.use_index and len(self.index().ion_numbers) > 0:
+            return int(self.index().ion_numbers[0])
+
+        ion_match = self.__search(ION_PATTERN)
         if not ion_match:
             raise RuntimeError(f'could not find match for ions')
 
-        return int(ion_match.group(1))
+        return int(ion_match[0])
 
 
     # Durchsucht den Inhalt nach dem Muster, dass den direkten lattice Vektoren vorangestellt ist.
     # Falls die entsprechende Zeile nicht auffindbar ist, bricht das Programm ab
     def find_lattice_vectors(self) -> array:
-        lattice_match = search(LATTICE_PATTERN,
-                                self.outcar_content,
-                                IGNORECASE)
+        lattice_match = self.__search(LATTICE_PATTERN)
 
         if not lattice_match:
             raise RuntimeError(f'could not find match for lattice vectors')
 
-        matches = lattice_match.groups()
+        matches = lattice_match
         lattice_string = list(map(lambda vec_string: vec_string.strip().split(), matches))
         lattice_float = array(list(map(lambda list_vecs: self.__convert_list(list_vecs), lattice_string)))
 
@@ -62,35 +88,219 @@ class Parser:
     # Teilt den Inhalt erst in Konfigurationen und findet die Energien, Positionen sowie Kräfte
     # und baut daraus einen Iterator
     def build_configurations(self, step_size: int, offset=0) -> (float, array, array):
+        if self.use_index:
+            for k in range(offset, len(self.index().offsets), step_size):
+                yield self.read_configuration(k)
+            return
+
+        if self.stream:
+            yield from self.__stream_configurations(step_size, offset)
+            return
+
         # Teilt den Inhalt an den in SPLIT_CONFIGS angegebenen Zeilen, die recht zuverlässig die einzelnen
         # Konfigurationen trennen sollten, wählt anschließend jede step_size-te Konfiguration aus
         configs = self.outcar_content.split(SPLIT_CONFIGS)[1+offset::step_size]
         for (i, config) in enumerate(configs):
-            # Sucht nach der Zeile, die die Energie enthalten sollte. Falls diese nicht gefunden werden kann, abbruch
-            energy_match = search(ENERGY_PATTERN, config, IGNORECASE)
-            if not energy_match:
-                raise RuntimeError(f'Could not find energy in config {i*step_size}')
-            else:
-                energy: float = float(energy_match.group(1))
-
-            # Teilt anhand der Abtrennungen die aus "---" bestehen und wählt den Teil aus, der Pos + Kräfte enthält
-            vecs_as_string: str = config.split(SPLIT_POS)[1]
-            vecs_as_str_list = list(filter(lambda line: line, vecs_as_string.split('\n')))
-            vecs = array(list(map(lambda line: fromstring(line.strip(), sep='\t'), vecs_as_str_list)))
-
-            positions: array = vecs[:, 0:3]
-            forces: array = vecs[:, 3:]
-
-            if shape(positions) != shape(forces):
-                raise RuntimeError(f'Shape {shape(positions)} of positions does not match shape {shape(forces)} of forces')
-            else:
-                yield (energy, positions, forces)
+            yield self.__parse_config(config, i * step_size)
+
+    # Wie build_configurations, liest die Datei aber zeilenweise und hält immer nur den Text der aktuellen
+    # Konfiguration im Speicher. Nicht ausgewählte Konfigurationen werden nur überlesen.
+    def __stream_configurations(self, step_size: int, offset=0) -> (float, array, array):
+        with open(self.filepath, 'r') as outcar_in:
+            block = -1 # Index der aktuellen Konfiguration
+            lines = None # Zeilen der aktuellen Konfiguration, None falls diese nicht ausgewählt ist
+            i = 0 # Anzahl der bisher ausgegebenen Konfigurationen
+            for line in outcar_in:
+                if SPLIT_CONFIGS in line:
+                    if lines is not None:
+                        yield self.__parse_config(''.join(lines), i * step_size)
+                        i += 1
+                    block += 1
+                    selected = block >= offset and (block - offset) % step_size == 0
+                    # der Rest der Zeile gehört wie bei str.split zur neuen Konfiguration
+                    lines = [line.split(SPLIT_CONFIGS, 1)[1]] if selected else None
+                elif lines is not None:
+                    lines.append(line)
+
+            if lines is not None:
+                yield self.__parse_config(''.join(lines), i * step_size)
+
+    # Gibt den Index des OUTCAR-files zurück. Dieser wird aus der Index-Datei geladen, falls sie zum aktuellen Stand
+    # des OUTCAR-files passt, sonst wird er durch einmaliges Lesen der Datei erstellt und gespeichert.
+    def index(self) -> OutcarIndex:
+        if self.__index is not None:
+            return self.__index
+
+        source = stat(self.filepath)
+        index_path = self.filepath + INDEX_SUFFIX
+        try:
+            with load(index_path) as stored:
+                if list(stored['source']) == [source.st_size, source.st_mtime_ns]:
+                    self.__index = OutcarIndex(*(stored[field] for field in OutcarIndex._fields))
+                    return self.__index
+        except (OSError, KeyError, ValueError):
+            pass
+
+        self.__index = self.__build_index()
+        try:
+            savez(index_path, source=array([source.st_size, source.st_mtime_ns], dtype=int64), **self.__index._asdict())
+        except OSError:
+            # ohne Schreibrechte wird der Index nur im Speicher gehalten
+            pass
+        return self.__index
+
+    # Liest die k-te Konfiguration über den Index direkt aus der Datei, ohne die Datei zu durchsuchen. Die Energie
+    # wird aus dem Index genommen, nur die Positionen und Kräfte werden geparst
+    def read_configuration(self, k: int) -> (float, array, array):
+        index = self.index()
+        if isnan(index.energies[k]):
+            raise RuntimeError(f'Could not find energy in config {k}')
+        with open(self.filepath, 'rb') as outcar_in:
+            outcar_in.seek(index.offsets[k])
+            config = outcar_in.read(index.ends[k] - index.offsets[k]).decode()
+        return (float(index.energies[k]), *self.__parse_vectors(config))
+
+    # Liest die Datei einmal zeilenweise und bestimmt für jede Konfiguration die Einträge des Index
+    def __build_index(self) -> OutcarIndex:
+        split_configs = SPLIT_CONFIGS.encode()
+        split_pos = SPLIT_POS.encode()
+        energy_pattern = re_compile(ENERGY_PATTERN.encode(), IGNORECASE)
+
+        offsets, ends, energies, ion_numbers = [], [], [], []
+        position = 0 # Byte-Offset des Anfangs der aktuellen Zeile
+        with open(self.filepath, 'rb') as outcar_in:
+            for line in outcar_in:
+                if split_configs in line:
+                    if offsets:
+                        ends.append(position)
+                    offsets.append(position + line.index(split_configs) + len(split_configs))
+                    energies.append(nan)
+                    ion_numbers.append(0)
+                    nr_splits = 0
+                elif offsets:
+                    if split_pos in line:
+                        nr_splits += 1
+                    elif nr_splits == 1 and line.strip():
+                        ion_numbers[-1] += 1
+                    elif isnan(energies[-1]):
+                        energy_match = energy_pattern.search(line)
+                        if energy_match:
+                            energies[-1] = float(energy_match.group(1))
+                position += len(line)
+        if offsets:
+            ends.append(position)
+
+        return OutcarIndex(array(offsets, dtype=int64), array(ends, dtype=int64), array(energies), array(ion_numbers))
+
+    # Findet in dem Text einer Konfiguration die Energie, Positionen und Kräfte
+    def __parse_config(self, config: str, i: int) -> (float, array, array):
+        # Sucht nach der Zeile, die die Energie enthalten sollte. Falls diese nicht gefunden werden kann, abbruch
+        energy_match = search(ENERGY_PATTERN, config, IGNORECASE)
+        if not energy_match:
+            raise RuntimeError(f'Could not find energy in config {i}')
+        else:
+            energy: float = float(energy_match.group(1))
+
+        return (energy, *self.__parse_vectors(config))
+
+    # Findet in dem Text einer Konfiguration die Positionen und Kräfte
+    def __parse_vectors(self, config: str) -> (array, array):
+        # Teilt anhand der Abtrennungen die aus "---" bestehen und wählt den Teil aus, der Pos + Kräfte enthält
+        vecs_as_string: str = config.split(SPLIT_POS)[1]
+        vecs_as_str_list = list(filter(lambda line: line, vecs_as_string.split('\n')))
+        vecs = array(list(map(lambda line: fromstring(line.strip(), sep='\t'), vecs_as_str_list)))
+
+        positions: array = vecs[:, 0:3]
+        forces: array = vecs[:, 3:]
+
+        if shape(positions) != shape(forces):
+            raise RuntimeError(f'Shape {shape(positions)} of positions does not match shape {shape(forces)} of forces')
+        else:
+            return (positions, forces)
+
+    # private Hilfsfunktion, die den Inhalt mit dem regex pattern durchsucht und die Gruppen des ersten Treffers
+    # als Tupel von str zurückgibt (None falls kein Treffer). Im streaming-Modus wird die Datei über mmap durchsucht.
+    def __search(self, pattern: str):
+        if self.outcar_content is not None:
+            found = search(pattern, self.outcar_content, IGNORECASE)
+            return found.groups() if found else None
+
+        with open(self.filepath, 'rb') as outcar_in, mmap(outcar_in.fileno(), 0, access=ACCESS_READ) as content:
+            found = search(pattern.encode(), content, IGNORECASE)
+            return tuple(group.decode() for group in found.groups()) if found else None
 
     # private Hilfsfunktion die Listen von str in Listen von floats umwandelt
     def __convert_list(self, val_list) -> list:
         return list(map(lambda entry: float(entry.strip()), val_list))
 
-if __name__ == '__main__':
+'''
+Liest die Konfigurationen aus dem binären Cache eines OUTCAR-files (siehe write_cache). Bietet die gleichen Methoden
+wie der Parser, sodass beide ohne Unterschied verwendet werden können. Wirft einen ValueError, falls der Cache
+nicht (mehr) zum OUTCAR-file passt.
+'''
+class CachedParser:
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        source = stat(filepath)
+        with load(filepath + CACHE_SUFFIX) as cache:
+            if list(cache['source']) != [source.st_size, source.st_mtime_ns]:
+                raise ValueError(f'cache of {filepath} is outdated')
+            self.energies = cache['energies']
+            self.positions = cache['positions']
+            self.forces = cache['forces']
+            self.lattice_vectors = cache['lattice_vectors']
+
+    def find_ion_nr(self) -> int:
+        return shape(self.positions)[1]
+
+    def find_lattice_vectors(self) -> array:
+        return self.lattice_vectors
+
+    # Gleiche Semantik von step_size und offset wie Parser.build_configurations
+    def build_configurations(self, step_size: int, offset=0) -> (float, array, array):
+        for k in range(offset, len(self.energies), step_size):
+            yield (float(self.energies[k]), self.positions[k].copy(), self.forces[k].copy())
+
+
+# Liest alle Konfigurationen des Parsers einmal ein und speichert Energien, Positionen, Kräfte und Gittervektoren
+# als binären Cache neben dem OUTCAR-file, zusammen mit Größe und Änderungszeit des OUTCAR-files.
+# Gibt den Pfad des Caches zurück.
+def write_cache(parser: Parser) -> str:
+    source = stat(parser.filepath)
+    energies, positions, forces = zip(*parser.build_configurations(1))
+    cache_path = parser.filepath + CACHE_SUFFIX
+    savez(
+        cache_path,
+        source=array([source.st_size, source.st_mtime_ns], dtype=int64),
+        energies=array(energies),
+        positions=array(positions),
+        forces=array(forces),
+        lattice_vectors=parser.find_lattice_vectors()
+    )
+    return cache_path
+
+
+# Gibt einen CachedParser zurück, falls ein gültiger Cache für das OUTCAR-file existiert, sonst einen Parser.
+# Mit cache=True wird der Cache in diesem Fall erstellt.
+def load_parser(filepath: str, stream=False, index=False, cache=False):
+    try:
+        return CachedParser(filepath)
+    except (OSError, KeyError, ValueError):
+        pass
+
+    parser = Parser(filepath, stream, index)
+    if cache:
+        write_cache(parser)
+        return CachedParser(filepath)
+    return parser
+
+
+if __name__ == '__main__' and len(argv) > 1:
+    # python outcar_parser.py OUTCAR.21 ... erstellt die Caches der angegebenen files
+    for filepath in argv[1:]:
+        print(f'wrote {write_cache(Parser(filepath, stream=True))}')
+
+elif __name__ == '__main__':
     test_in = 'OUTCAR.21'
 
     test_lattice = array([
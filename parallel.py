@@ -0,0 +1,57 @@
+import mmap
+import multiprocessing
+from contextlib import nullcontext
+import numpy as np
+
+# The worker processes are forked, so they inherit the configurations, the kernel and the result arrays
+# without pickling. The results are written into arrays in anonymous shared memory (see shared_array),
+# which the forked processes share with the parent.
+# the task of the running pool, set before the workers are forked
+_task = None
+
+
+def shared_array(shape, dtype=float) -> np.array:
+    '''
+    Returns a zero initialized array in anonymous shared memory. Processes forked by run write into the
+    same memory, so their results are visible in the parent without copying.
+    '''
+    size = int(np.prod(shape))
+    buffer = mmap.mmap(-1, max(1, size * np.dtype(dtype).itemsize))
+    return np.frombuffer(buffer, dtype=dtype, count=size).reshape(shape)
+
+
+def locks(n: int, workers=1) -> list:
+    '''
+    Returns n locks, that the processes forked by run share, e.g. one per block of rows of a shared array, into
+    which all workers add. With workers=1, or without fork, the locks do nothing.
+    '''
+    if workers == 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        return [nullcontext()] * n
+    context = multiprocessing.get_context('fork')
+    return [context.Lock() for _ in range(n)]
+
+
+def run(task, n_items: int, workers=1) -> None:
+    '''
+    Calls task(worker, items) for every worker, where items are the indices range(worker, n_items, workers),
+    so every worker gets an equal share of the items. With more than one worker the calls run in a pool
+    of forked processes; task has to write its results into shared arrays. Without fork (e.g. on Windows),
+    or with workers=1, everything runs in this process.
+    '''
+    workers = max(1, min(workers, n_items))
+    if workers == 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        task(0, range(n_items))
+        return
+
+    global _task
+    _task = (task, n_items, workers)
+    try:
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            pool.map(_run_worker, range(workers), chunksize=1)
+    finally:
+        _task = None
+
+
+def _run_worker(worker):
+    task, n_items, workers = _task
+    task(worker, range(worker, n_items, workers))
@@ -0,0 +1,102 @@
+import argparse
+import json
+from math import pi
+from time import time
+import numpy as np
+import calibration
+import kernel
+from model_file import load_calibration
+
+# Accuracy report of the reduced precision of kernel.Kernel: the kernel and force matrices and the predicted
+# energies and forces of the configurations are compared against the float64 path, and the time of the production
+# prediction (kernel.Predictor, as in the MD) is measured for both.
+# Every quantity gets the maximal and RMS absolute deviation and the maximal deviation relative to the largest
+# absolute value of the float64 result.
+REPORT_QUANTITIES = ('kernel_mat', 'force_submat', 'energy', 'forces')
+REPORT_COLUMNS = ('max_abs', 'rms', 'max_rel')
+
+
+def deviation(low: np.array, exact: np.array) -> (float, float, float):
+    '''
+    Returns the maximal and RMS absolute deviation of low from exact and the maximal one relative to max |exact|.
+    '''
+    diff = np.abs(np.asarray(low, dtype=np.float64) - exact)
+    scale = np.max(np.abs(exact))
+    return (np.max(diff), np.sqrt(np.mean(diff**2)), np.max(diff) / scale if scale > 0 else 0.0)
+
+
+def precision_report(kern_args: list, q: np.array, configurations: list, C_ref: np.array, w: np.array, E_ave: float,
+                     precision='float32', force_mode='broadcast') -> dict:
+    '''
+    Compares the kernel with the given precision against float64 on the initialized configurations and the
+    calibration (C_ref, w, E_ave). Returns a dict with the deviations (see REPORT_COLUMNS) of the REPORT_QUANTITIES
+    and the times per configuration of the prediction with kernel.Predictor as 'time_float64' and 'time_<precision>'.
+    '''
+    exact = kernel.Kernel(*kern_args, force_mode=force_mode)
+    low = kernel.Kernel(*kern_args, force_mode=force_mode, precision=precision)
+
+    # the matrices of all configurations are compared as one, so the relative deviation refers to the largest entry
+    K = [(low.kernel_mat(config.descriptors, C_ref), exact.kernel_mat(config.descriptors, C_ref)) for config in configurations]
+    T = [(low.force_submat(q, config, C_ref), exact.force_submat(q, config, C_ref)) for config in configurations]
+    (E_low, F_low) = low.predict_batch(q, configurations, C_ref, w, E_ave)
+    (E, F) = exact.predict_batch(q, configurations, C_ref, w, E_ave)
+    report = {
+        'kernel_mat': deviation(np.concatenate([k[0] for k in K]), np.concatenate([k[1] for k in K])),
+        'force_submat': deviation(np.concatenate([t[0] for t in T]), np.concatenate([t[1] for t in T])),
+        'energy': deviation(E_low, E),
+        'forces': deviation(F_low, F),
+    }
+
+    for (name, kern) in (('float64', exact), (precision, low)):
+        predictor = kernel.Predictor(kern, q, C_ref, w, E_ave)
+        t_0 = time()
+        for config in configurations:
+            predictor.predict(config)
+        report['time_' + name] = (time() - t_0) / len(configurations)
+    return report
+
+
+def print_report(report: dict, precision='float32') -> None:
+    print(f'{"":>15}' + ''.join(f'{column:>15}' for column in REPORT_COLUMNS))
+    for name in REPORT_QUANTITIES:
+        print(f'{name:>15}' + ''.join(f'{value:>15.3e}' for value in report[name]))
+    print(f'prediction per configuration: {report["time_float64"]:.3e} s (float64), '
+          f'{report["time_" + precision]:.3e} s ({precision})')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compares the prediction with a reduced precision kernel against float64.')
+    parser.add_argument('config', nargs='?', default='user_config.json', help='json-file of the calibration')
+    parser.add_argument('--precision', choices=[p for p in kernel.PRECISIONS if p != 'float64'], default='float32')
+    parser.add_argument('--offset', type=int, default=0, help='offset of the configurations in the outcar-file')
+    # e.g. test_data/c_gaus_10.out, test_data/w_gaus_10.out and test_data/e_gaus_10.out
+    parser.add_argument('--descriptors', default=None, help='text file of the reference points, default: calibration in file_out')
+    parser.add_argument('--weights', default=None)
+    parser.add_argument('--energy', default=None, help='text file of the average energy')
+    args = parser.parse_args(argv)
+
+    with open(args.config, 'r') as u_conf:
+        user_config = json.load(u_conf)
+    qs = np.arange(1, user_config['nr_modi']+1) * pi / user_config['cutoff']
+
+    if args.descriptors is None:
+        model = load_calibration(user_config['file_out'], u_conf=user_config)
+        (C_ref, w, E_ave) = (model['C'], model['w'], model['E_ave'])
+    else:
+        C_ref = np.loadtxt(args.descriptors)
+        w = np.loadtxt(args.weights)
+        E_ave = float(np.atleast_1d(np.loadtxt(args.energy))[0])
+
+    (user_config['N_conf'], user_config['N_ion'], user_config['lattice_vectors'], configurations) = calibration.load_data(user_config, args.offset)
+    C = np.zeros([user_config['N_conf'], user_config['N_ion'], user_config['nr_modi']])
+    calibration.init_configurations(user_config, configurations, qs, C)
+
+    report = precision_report(
+        user_config['kernel'], qs, configurations, C_ref.reshape(-1, len(qs)), w, E_ave, args.precision,
+        user_config.get('force_mode', 'broadcast')
+    )
+    print_report(report, args.precision)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,9 +2,11 @@ import json
 from time import time
 from math import pi
 import numpy as np
-from outcar_parser import Parser
-from configuration import Configuration
+from outcar_parser import load_parser
+from configuration import Configuration, batch_descriptors
 import kernel
+import parallel
+from model_file import load_calibration
 
 
 def load_data(u_conf: dict, stepsize=0) ->  (int, int, np.array, list):
@@ -16,7 +18,13 @@ def load_data(u_conf: dict, stepsize=0) ->  (int, int, np.array, list):
         stepsize = int(input("Stepsize for prediction? (integer): -> "))
 
     # load parser and save nr of ions and lattice vectors
-    parser = Parser(u_conf['file_in'])
+    # uses the binary cache of the outcar file, if there is one
+    parser = load_parser(
+        u_conf['file_in'],
+        stream=u_conf.get('stream', False),
+        index=u_conf.get('index', False),
+        cache=u_conf.get('cache', False)
+    )
     lattice_vectors = parser.find_lattice_vectors()
     lat_consts = np.diag(lattice_vectors.dot(lattice_vectors.T))
 
@@ -38,15 +46,15 @@ def init_configurations(u_conf: dict, configurations: list, q: np.array, C: np.a
     Initializes the nearest neighbors and descriptors. Writes values into the C array.
     Choosen this way, to only have sideeffects and no return.
     '''
-    n_conf = u_conf['N_conf']
-    # calculate the nearest neighbors and the descriptors
+    # calculate the descriptors of all configurations at once, the nearest neighbour tables for the force matrices
+    # are set from the same distances
     t_0 = time()
+    print('calculating descriptors and NN ...', end='\r')
+    positions = np.array([config.positions for config in configurations])
+    batch_descriptors(positions, u_conf['cutoff'], u_conf['lattice_vectors'], q, C, configurations=configurations)
     for (alpha, config) in enumerate(configurations):
-        config.init_nn(u_conf['cutoff'], u_conf['lattice_vectors'])
-        config.init_descriptor(q)
-        C[alpha, :, :] = config.descriptors
-        print(f'calculating NN and descriptors: {alpha+1}/{n_conf}', end='\r')
-    print(f'calculating NN and descriptors: finished after {time()-t_0:.3} s')
+        config.descriptors = C[alpha, :, :]
+    print(f'calculating descriptors and NN: finished after {time()-t_0:.3} s')
 
 
 def predict_linear(u_conf: dict, configurations, C: np.array, q) -> (np.array, np.array, np.array, np.array):
@@ -54,17 +62,20 @@ def predict_linear(u_conf: dict, configurations, C: np.array, q) -> (np.array, n
     Loads the calibration data, initializes the kernel and then builds the linear system with the kernel matrices according to kernel
     '''
     directory = u_conf['file_out']
-    C_cal = np.array(np.loadtxt(directory + '/calibration_C.out'), dtype=float)
+    C_cal = load_calibration(directory, u_conf=u_conf)['C']
 
-    kern = kernel.Kernel(*u_conf['kernel'])
+    kern = kernel.Kernel(
+        *u_conf['kernel'], force_mode=u_conf.get('force_mode', 'broadcast'), precision=u_conf.get('precision', 'float64')
+    )
     n_conf = u_conf['N_conf']
     n_ion = u_conf['N_ion']
     nc_ni = np.shape(C_cal)[0]
+    workers = u_conf.get('workers', 1)
     # will be the super vectors
     E = np.zeros(n_conf)
     # Holds forces flattened
     F = np.zeros(n_conf * n_ion * 3)
-    T = np.zeros((n_conf * n_ion * 3, nc_ni))
+    T = np.zeros((n_conf * n_ion * 3, nc_ni)) if workers == 1 else parallel.shared_array((n_conf * n_ion * 3, nc_ni))
 
     # build the linear system
 
@@ -76,16 +87,22 @@ def predict_linear(u_conf: dict, configurations, C: np.array, q) -> (np.array, n
     K = kern.kernel_mat(descr_new, C_cal)
     K = np.sum(
         K.reshape(n_conf, n_ion, nc_ni),
-        axis=1
+        axis=1, dtype=np.float64
     )
     print(f'Building K: finished after {time()-t_0:.3} s')
 
     t_0 = time()
     for alpha in range(n_conf):
-        print(f'Building T: {alpha+1}/{n_conf}', end='\r')
         E[alpha] = configurations[alpha].energy
         F[alpha*n_ion*3: (alpha+1)*n_ion*3] = configurations[alpha].forces.flatten()
-        T[alpha*n_ion*3:(alpha+1)*n_ion*3] = kern.force_submat(q, configurations[alpha], C_cal)
+
+    def build_T(worker, alphas):
+        for alpha in alphas:
+            if worker == 0:
+                print(f'Building T: {alpha+1}/{n_conf}', end='\r')
+            T[alpha*n_ion*3:(alpha+1)*n_ion*3] = kern.force_submat(q, configurations[alpha], C_cal)
+
+    parallel.run(build_T, n_conf, workers)
     print(f'Building T: finished after {time()-t_0:.3} s')
 
     return (E, F, K, T)
@@ -129,23 +146,25 @@ def main(doprint = False):
     # compute the nn and configurations and fill them in C
     init_configurations(user_config, configurations, qs, C)
 
-    # build the linear system
-    (E, F, K, T) = predict_linear(user_config, configurations, C, qs)
+    # the reference energies and forces
+    E = np.array([config.energy for config in configurations])
+    F = np.concatenate([config.forces.flatten() for config in configurations])
 
-    # make a data directory
+    # load the calibration
     directory = user_config['file_out']
-    w_cal = np.array(np.loadtxt(directory + '/calibration_w.out'), dtype=float)
-    E_ave, _ = np.array(np.loadtxt(directory + '/calibration_E.out'), dtype=float)
+    model = load_calibration(directory, u_conf=user_config)
+    kern = kernel.Kernel(
+        *user_config['kernel'], force_mode=user_config.get('force_mode', 'broadcast'), precision=user_config.get('precision', 'float64')
+    )
 
     t_0 = time()
-    # calculate the weights using ridge regression
-    print('Solving linear system ... ', end='\r')
-    EF = ridge_prediction(np.append(K,T, axis=0),w_cal)
-    print(f'Solving linear system: finished after {time()-t_0:.3} s')
+    # predict energies and forces directly from the weights, without building T
+    print('Predicting energies and forces ... ', end='\r')
+    (E_cal, F_cal) = kern.predict_batch(qs, configurations, model['C'], model['w'], model['E_ave'])
+    print(f'Predicting energies and forces: finished after {time()-t_0:.3} s')
 
-    E_cal = EF[0:user_config['N_conf']] + E_ave
     E_msd = np.mean((E - E_cal)**2)
-    F_cal = EF[user_config['N_conf']:] # .reshape((user_config['N_conf'], user_config['N_ion'], 3))
+    F_cal = F_cal.flatten()
     F_msd = np.mean((F - F_cal)**2)
 
     # show results in compact way
@@ -0,0 +1,57 @@
+import numpy as np
+
+RDF_FILE = 'rdf.out'
+
+
+# Accumulates the radial distribution function g(r) during an MD run from the NN distances of the frames, instead
+# of writing all distances into nn.out and histogramming them afterwards. The histogram has n_bins bins between
+# 0 and rcut. Every block_size frames the histogram of the block is kept, the spread of the block averages gives
+# the error of g(r).
+class RDFAccumulator(object):
+    def __init__(self, rcut: float, n_ion: int, volume: float, n_bins=90, block_size=100):
+        self.n_ion = n_ion
+        self.volume = volume # A^3
+        self.block_size = block_size
+        self.bins = np.linspace(0, rcut, n_bins + 1)
+        # histogram of all frames, of the current block and of the finished blocks
+        self.counts = np.zeros(n_bins)
+        self.frames = 0
+        self.block_counts = np.zeros(n_bins)
+        self.block_frames = 0
+        self.blocks = []
+
+    # adds the NN distances of one frame, each pair only once (as MDSimulation.nn_distances)
+    def accumulate(self, distances: np.array):
+        counts = np.histogram(distances, self.bins)[0]
+        self.counts += counts
+        self.frames += 1
+        self.block_counts += counts
+        self.block_frames += 1
+        if self.block_frames == self.block_size:
+            self.blocks.append(self.normalize(self.block_counts, self.block_frames))
+            self.block_counts = np.zeros_like(self.block_counts)
+            self.block_frames = 0
+
+    def r(self) -> np.array:
+        return (self.bins[1:] + self.bins[:-1]) / 2
+
+    # g(r) of a histogram of the pairs of frames frames: divided by the number of pairs of an ideal gas of the
+    # same density in every shell, 4 pi r^2 dr n_ion (n_ion - 1) / (2 V) per frame (n_ion (n_ion - 1) / 2 pairs)
+    def normalize(self, counts: np.array, frames: int) -> np.array:
+        pairs = self.n_ion * (self.n_ion - 1) / (2 * self.volume)
+        shells = 4/3 * np.pi * (self.bins[1:]**3 - self.bins[:-1]**3)
+        return counts / (shells * pairs * max(frames, 1))
+
+    # g(r) of all frames
+    def g(self) -> np.array:
+        return self.normalize(self.counts, self.frames)
+
+    # standard error of g(r) from the spread of the block averages, nan with less than two blocks
+    def error(self) -> np.array:
+        if len(self.blocks) < 2:
+            return np.full(len(self.counts), np.nan)
+        return np.std(self.blocks, axis=0, ddof=1) / np.sqrt(len(self.blocks))
+
+    # writes the columns r, g(r) and its error into a text file
+    def save(self, path: str):
+        np.savetxt(path, np.transpose([self.r(), self.g(), self.error()]), header='r (A)    g(r)    error of g(r)')
@@ -0,0 +1,57 @@
+import numpy as np
+
+# the methods that can be chosen with the key 'reference_method' in the json-file
+METHODS = ('fps', 'kmeans++', 'cur')
+
+
+def select_reference(descriptors: np.array, M: int, method='fps', seed=0) -> np.array:
+    '''
+    Selects M representative rows of the descriptor matrix (shape (N, nq)) as reference set of a
+    sparse (Nystroem / subset of regressors) model and returns their indices.
+    fps: farthest point sampling, every new point is the one farthest from all chosen ones
+    kmeans++: the seeding of k-means++, points are drawn with probability ~ squared distance to the chosen ones
+    cur: points are drawn with probability ~ their statistical leverage score in the descriptor matrix
+    If M is not smaller than N, all indices are returned.
+    '''
+    N, _ = np.shape(descriptors)
+    if M >= N:
+        return np.arange(N)
+
+    rng = np.random.default_rng(seed)
+    if method == 'fps':
+        return _farthest_points(descriptors, M, rng.integers(N), lambda dist2: np.argmax(dist2))
+    elif method == 'kmeans++':
+        return _farthest_points(descriptors, M, rng.integers(N), lambda dist2: _draw(rng, dist2))
+    elif method == 'cur':
+        # leverage scores = squared row norms of the left singular vectors
+        U, s, _ = np.linalg.svd(descriptors, full_matrices=False)
+        rank = np.sum(s > s[0] * max(np.shape(descriptors)) * np.finfo(float).eps)
+        leverage = np.sum(U[:, :rank]**2, axis=1)
+        # points with leverage score 0 can only be drawn, if there are not enough others
+        leverage = leverage + 1e-12 * np.max(leverage)
+        return np.sort(rng.choice(N, M, replace=False, p=leverage / np.sum(leverage)))
+    raise ValueError(f'reference method {method} is not supported, choose one of {METHODS}')
+
+
+# chooses M points greedily, starting from the point first. choose gets the squared distances of all points to
+# the chosen set (-1 for the chosen points themselves) and returns the index of the next point
+def _farthest_points(descriptors, M, first, choose):
+    chosen = [first]
+    dist2 = np.sum((descriptors - descriptors[first])**2, axis=1)
+    dist2[first] = -1
+    for _ in range(M - 1):
+        new = choose(dist2)
+        chosen.append(new)
+        dist2 = np.minimum(dist2, np.sum((descriptors - descriptors[new])**2, axis=1))
+        dist2[new] = -1
+    return np.sort(chosen)
+
+
+# draws a point, that is not chosen yet, with probability proportional to its squared distance to the chosen set.
+# If only duplicates of chosen points are left, one of them is drawn uniformly.
+def _draw(rng, dist2):
+    weights = np.maximum(dist2, 0)
+    total = np.sum(weights)
+    if total > 0:
+        return rng.choice(len(weights), p=weights / total)
+    return rng.choice(np.flatnonzero(dist2 == 0))
@@ -0,0 +1,223 @@
+import argparse
+import json
+from collections import namedtuple
+from itertools import product
+from math import pi
+from time import time
+import numpy as np
+import calibration
+import kernel
+import parallel
+
+# Hyperparameter sweep over cutoff, nr_modi, sigma and lambda in one process, instead of one calibration.py run per
+# point. What does not change between the points is computed once:
+#   - the configurations are read once, the neighbour lists and descriptors once per cutoff (the descriptors for the
+#     largest nr_modi, since q_k = k pi / cutoff those of fewer modes are their first columns)
+#   - the squared distances |C_i - C_a|^2 of the descriptors to the reference points once per (cutoff, nr_modi),
+#     so another sigma only re-exponentiates them
+#   - the normal equations once per (cutoff, nr_modi, sigma), all lambdas are solved from one eigendecomposition
+#     (see calibration.solve_normal_path)
+# The sigmas (the nr_modis for the linear kernel) of a group run in parallel in forked workers (see parallel.py).
+RESULT_COLUMNS = ('cutoff', 'nr_modi', 'sigma', 'lambda', 'E_rmse_fit', 'F_rmse_fit', 'E_rmse_prediction', 'F_rmse_prediction')
+
+# The normal equations of the energies and forces are kept apart, so that the RMSE of the fit follows from them for
+# every lambda without K and T: |K w - E|^2 = w^T X_E w - 2 w^T y_E + |E|^2 and the same for the forces.
+NormalEquations = namedtuple('NormalEquations', ['X_E', 'y_E', 'E2', 'X_F', 'y_F', 'F2', 'E_ave'])
+
+
+def load_sets(u_conf: dict, cutoffs: list, test_offset=None) -> (np.array, list, list):
+    '''
+    Loads the training configurations (offset 0) and the test configurations in between them (offset test_offset,
+    by default stepsize // 2) once for all points of the sweep. Returns (lattice vectors, training, test).
+    '''
+    # the cutoff is checked against the lattice by load_data, the largest one is enough
+    u_conf = dict(u_conf, cutoff=max(cutoffs))
+    (_, _, lattice, training) = calibration.load_data(u_conf)
+    if test_offset is None:
+        test_offset = u_conf['stepsize'] // 2
+    if test_offset % u_conf['stepsize'] == 0:
+        raise ValueError(f'the test offset {test_offset} gives the training configurations, use a stepsize of at least 2')
+    (_, _, _, test) = calibration.load_data(u_conf, test_offset)
+    return (lattice, training, test)
+
+
+def cutoff_cache(configurations: list, cutoff: float, lattice: np.array, nr_modi: int) -> (list, np.array):
+    '''
+    Returns the neighbour lists and the descriptors (n_conf, n_ion, nr_modi) of the configurations for this cutoff.
+    '''
+    q = np.arange(1, nr_modi+1) * pi / cutoff
+    nn_lists = []
+    C = []
+    for config in configurations:
+        config.init_nn(cutoff, lattice, dense=False)
+        config.init_descriptor(q)
+        nn_lists.append(config.nnpairs)
+        C.append(config.descriptors)
+    return (nn_lists, np.array(C))
+
+
+def use_cache(configurations: list, nn_lists: list, C: np.array, nr_modi: int) -> None:
+    '''
+    Sets the neighbour lists and the descriptors of the first nr_modi modes of the cache in the configurations.
+    '''
+    for (config, nn_list, C_alpha) in zip(configurations, nn_lists, C):
+        config.nnpairs = nn_list
+        config.descriptors = C_alpha[:, :nr_modi]
+
+
+def squared_distances(C: np.array, C_ref: np.array) -> np.array:
+    '''
+    Returns the squared distances (n_conf, n_ion, n_ref) between the descriptors C (n_conf, n_ion, nq) and the
+    reference points C_ref (n_ref, nq).
+    '''
+    n_conf, n_ion, nq = np.shape(C)
+    descr = C.reshape(-1, nq)
+    D2 = np.sum(descr**2, axis=1).reshape(-1, 1) - 2 * descr @ C_ref.T + np.sum(C_ref**2, axis=1).reshape(1, -1)
+    # rounding errors can make the distance of a descriptor to itself slightly negative
+    return np.maximum(D2, 0).reshape(n_conf, n_ion, len(C_ref))
+
+
+def normal_equations(q: np.array, configurations: list, C_ref: np.array, sigma=None, D2=None) -> NormalEquations:
+    '''
+    Builds the normal equations of the energies and the forces one configuration at a time (as build_normal).
+    Without sigma the linear kernel is used, otherwise the Gaussian kernel with the squared distances D2 of the
+    descriptors of the configurations to C_ref.
+    '''
+    n_ref = len(C_ref)
+    E_ave = np.mean([config.energy for config in configurations])
+    X_E = np.zeros((n_ref, n_ref))
+    y_E = np.zeros(n_ref)
+    X_F = np.zeros((n_ref, n_ref))
+    y_F = np.zeros(n_ref)
+    E2 = F2 = 0
+    if sigma is not None:
+        q_sig_C = (-1/(sigma**2) * q).reshape(1, -1) * C_ref
+
+    for (alpha, config) in enumerate(configurations):
+        if sigma is None:
+            K_alpha = np.sum(config.descriptors @ C_ref.T, axis=0)
+            T_alpha = kernel.linear_force_submat(q, config, C_ref)
+        else:
+            kern = np.exp(D2[alpha] * (-1 / (2 * sigma**2)))
+            K_alpha = np.sum(kern, axis=0)
+            T_alpha = kernel.gaussian_force_mat_sparse(q, config, C_ref, sigma, q_sig_Cia=q_sig_C, kern=kern)
+        E = config.energy - E_ave
+        F = config.forces.flatten()
+        X_E += np.outer(K_alpha, K_alpha)
+        y_E += K_alpha * E
+        E2 += E**2
+        X_F += T_alpha.T @ T_alpha
+        y_F += T_alpha.T @ F
+        F2 += F @ F
+    return NormalEquations(X_E, y_E, E2, X_F, y_F, F2, E_ave)
+
+
+def fit_rmse(normal: NormalEquations, w: np.array, n_conf: int, n_ion: int) -> (float, float):
+    '''
+    Returns the energy and force RMSE of the weights w on the configurations of the normal equations.
+    '''
+    E_res = w @ normal.X_E @ w - 2 * w @ normal.y_E + normal.E2
+    F_res = w @ normal.X_F @ w - 2 * w @ normal.y_F + normal.F2
+    return (np.sqrt(max(E_res, 0) / n_conf), np.sqrt(max(F_res, 0) / (n_conf * n_ion * 3)))
+
+
+def evaluate(q: np.array, training: list, test: list, C_ref: np.array, lambdas: list, sigma=None, D2=None) -> np.array:
+    '''
+    Fits the model for every lambda and returns the rows (len(lambdas), 4) of the energy and force RMSE on the
+    training and the test configurations.
+    '''
+    normal = normal_equations(q, training, C_ref, sigma, D2)
+    weights = calibration.solve_normal_path(normal.X_E + normal.X_F, normal.y_E + normal.y_F, lambdas)
+
+    kern = kernel.Kernel('linear') if sigma is None else kernel.Kernel('gaussian', sigma)
+    kern.bind(q, C_ref)
+    n_ion = len(training[0].positions)
+    E_test = np.array([config.energy for config in test])
+    F_test = np.array([config.forces for config in test])
+    rows = np.zeros((len(lambdas), 4))
+    for (k, w) in enumerate(weights):
+        (E, F) = kern.predict_batch(q, test, C_ref, w, normal.E_ave)
+        rows[k] = (
+            *fit_rmse(normal, w, len(training), n_ion),
+            np.sqrt(np.mean((E - E_test)**2)), np.sqrt(np.mean((F - F_test)**2))
+        )
+    return rows
+
+
+def sweep(u_conf: dict, cutoffs: list, nr_modis: list, sigmas: list, lambdas: list, workers=1, test_offset=None) -> np.array:
+    '''
+    Fits the model for every combination of cutoff, nr_modi, sigma and lambda (the kernel type and the reference
+    points are chosen as in u_conf, the sigmas are ignored for the linear kernel) and returns the array of the
+    RESULT_COLUMNS with one row per point, in the order of the loops cutoff, nr_modi, sigma, lambda.
+    '''
+    if u_conf['kernel'][0] == 'linear':
+        sigmas = [None]
+    (lattice, training, test) = load_sets(u_conf, cutoffs, test_offset)
+    n_points = len(cutoffs) * len(nr_modis) * len(sigmas)
+    results = parallel.shared_array((n_points, len(lambdas), len(RESULT_COLUMNS)))
+
+    for (i_cut, cutoff) in enumerate(cutoffs):
+        t_0 = time()
+        caches = [cutoff_cache(configs, cutoff, lattice, max(nr_modis)) for configs in (training, test)]
+        print(f'cutoff {cutoff}: neighbour lists and descriptors finished after {time()-t_0:.3} s')
+
+        # the Gaussian points of one nr_modi share the squared distances, the linear points need none
+        groups = [[i_modi] for i_modi in range(len(nr_modis))] if sigmas[0] is not None else [range(len(nr_modis))]
+        for group in groups:
+            # the reference points and squared distances of the nr_modis in the group
+            references = {}
+            for i_modi in group:
+                C = caches[0][1][:, :, :nr_modis[i_modi]]
+                C_ref = calibration.reference_descriptors(u_conf, C)
+                references[i_modi] = (C_ref, None if sigmas[0] is None else squared_distances(C, C_ref))
+            items = list(product(group, range(len(sigmas))))
+
+            def evaluate_items(worker, indices):
+                for k in indices:
+                    (i_modi, i_sigma) = items[k]
+                    nr_modi = nr_modis[i_modi]
+                    q = np.arange(1, nr_modi+1) * pi / cutoff
+                    for (configs, (nn_lists, C)) in zip((training, test), caches):
+                        use_cache(configs, nn_lists, C, nr_modi)
+                    (C_ref, D2) = references[i_modi]
+                    point = (i_cut * len(nr_modis) + i_modi) * len(sigmas) + i_sigma
+                    sigma = sigmas[i_sigma]
+                    results[point, :, :4] = [[cutoff, nr_modi, np.nan if sigma is None else sigma, lamb] for lamb in lambdas]
+                    results[point, :, 4:] = evaluate(q, training, test, C_ref, lambdas, sigma, D2)
+                    if worker == 0:
+                        print(f'cutoff {cutoff}, nr_modi {nr_modi}, sigma {sigma}: finished after {time()-t_0:.3} s')
+
+            parallel.run(evaluate_items, len(items), workers)
+
+    return np.array(results).reshape(-1, len(RESULT_COLUMNS))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Sweeps the hyperparameters of the calibration in one process.')
+    parser.add_argument('config', nargs='?', default='user_config.json', help='json-file of the calibration')
+    parser.add_argument('--cutoffs', nargs='+', type=float, help='default: cutoff of the json-file')
+    parser.add_argument('--nr-modi', nargs='+', type=int, help='default: nr_modi of the json-file')
+    parser.add_argument('--sigmas', nargs='+', type=float, help='default: sigma of the json-file')
+    parser.add_argument('--lambdas', nargs='+', type=float, help='default: lambda of the json-file')
+    parser.add_argument('--workers', type=int, default=None, help='default: workers of the json-file or 1')
+    parser.add_argument('--test-offset', type=int, default=None, help='offset of the test configurations, default stepsize // 2')
+    parser.add_argument('--output', default='sweep.dat')
+    args = parser.parse_args(argv)
+
+    with open(args.config, 'r') as u_conf:
+        user_config = json.load(u_conf)
+
+    results = sweep(
+        user_config,
+        args.cutoffs or [user_config['cutoff']],
+        args.nr_modi or [user_config['nr_modi']],
+        args.sigmas or user_config['kernel'][1:],
+        args.lambdas or [user_config['lambda']],
+        args.workers or user_config.get('workers', 1),
+        args.test_offset
+    )
+    np.savetxt(args.output, results, header=' '.join(RESULT_COLUMNS))
+
+
+if __name__ == '__main__':
+    main()
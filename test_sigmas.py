@@ -2,20 +2,26 @@ import copy
 import json
 import os
 import sys
+from time import time
 import numpy as np
 import kernel
 import configuration
 import calibration
+import reference
 
 def float_to_str(nr: float):
     return str(nr).replace('.', '')
 
-def test_data(c_path, w_path, e_path, json_path, offset=1, printing=True):
+def test_data(c_path, w_path, e_path, json_path, offset=1, printing=True, index=False):
     descriptors = np.loadtxt(c_path)
     weights = np.loadtxt(w_path)
     e_ave = np.loadtxt(e_path)[0]
     with open(json_path, 'r') as u_conf:
             user_config = json.load(u_conf)
+    # the outcar file is read at many offsets, with index=True (or the key index in the json-file) only the
+    # selected configurations are read via the sidecar index, which is written next to the outcar file
+    if index:
+        user_config['index'] = True
 
     # make a list of the allowed qs
     qs = np.arange(1, user_config['nr_modi']+1) * np.pi / user_config['cutoff']
@@ -36,7 +42,9 @@ def test_data(c_path, w_path, e_path, json_path, offset=1, printing=True):
     nc_old = int(weights.size / 64)
     ni_old = 64
 
-    kern = kernel.Kernel(*user_config['kernel'])
+    kern = kernel.Kernel(
+        *user_config['kernel'], force_mode=user_config.get('force_mode', 'broadcast'), precision=user_config.get('precision', 'float64')
+    )
 
     config.init_nn(user_config['cutoff'], lat)
     config.init_descriptor(qs)
@@ -140,6 +148,50 @@ def test_sigmas(n: int, min_sigma, max_sigma, modi):
     np.savetxt(f'test_data/prediction_{n}_({float_to_str(min_sigma)}-{float_to_str(max_sigma)})_m{modi}_s{stepsize}.dat', np.array([sigmas, meanf_pred, varf_pred, meancos_pred, varcos_pred, e_pred]).T)
 
 
+def rmse(K, T, w, E, F, E_ave):
+    return (np.sqrt(np.mean((K @ w + E_ave - E)**2)), np.sqrt(np.mean((T @ w - F)**2)))
+
+
+def test_references(Ms, method='fps', json_path='user_config.json'):
+    '''
+    Fits the model with M reference points for every M in Ms and reports how the energy and force RMSE
+    on the training configurations and on the configurations in between them change with M.
+    '''
+    with open(json_path, 'r') as u_conf:
+        user_config = json.load(u_conf)
+    qs = np.arange(1, user_config['nr_modi']+1) * np.pi / user_config['cutoff']
+
+    # the test configurations lie in the middle between the training configurations, for stepsize 1 there are none
+    if user_config['stepsize'] < 2:
+        raise ValueError('the test configurations in between the training configurations need a stepsize of at least 2')
+    sets = []
+    for offset in [0, user_config['stepsize'] // 2]:
+        u_conf = dict(user_config)
+        (u_conf['N_conf'], u_conf['N_ion'], u_conf['lattice_vectors'], configurations) = calibration.load_data(u_conf, offset)
+        C = np.zeros([u_conf['N_conf'], u_conf['N_ion'], u_conf['nr_modi']])
+        calibration.init_configurations(u_conf, configurations, qs, C)
+        sets.append((u_conf, configurations, C))
+    descr = sets[0][2].reshape(-1, user_config['nr_modi'])
+
+    results = []
+    for M in Ms:
+        t_0 = time()
+        C_ref = descr[reference.select_reference(descr, M, method)]
+        (E, F, K, T) = calibration.build_linear(*sets[0], qs, C_ref)
+        E_ave = np.mean(E)
+        w = calibration.ridge_regression(np.append(K, T, axis=0), np.append(E - E_ave, F), user_config['lambda'], user_config.get('solver', 'normal'))
+        fit = rmse(K, T, w, E, F, E_ave)
+        (E_test, F_test, K_test, T_test) = calibration.build_linear(*sets[1], qs, C_ref)
+        prediction = rmse(K_test, T_test, w, E_test, F_test, E_ave)
+        results.append([len(C_ref), *fit, *prediction, time() - t_0])
+        print(f'M = {len(C_ref)}: E/F rmse fit {fit[0]:.5f}/{fit[1]:.5f}, prediction {prediction[0]:.5f}/{prediction[1]:.5f}')
+
+    stepsize = user_config['stepsize']
+    np.savetxt(f'test_data/references_{method}_m{user_config["nr_modi"]}_s{stepsize}.dat', np.array(results),
+               header='M E_rmse_fit F_rmse_fit E_rmse_prediction F_rmse_prediction time')
+    return np.array(results)
+
+
 def main():
     arg_in = sys.argv
     if len(arg_in) != 5:
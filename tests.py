@@ -1,9 +1,86 @@
 import unittest
+from unittest import mock
+import json
+import os
+import sys
+import tempfile
+import threading
+from contextlib import redirect_stdout
+from io import StringIO
 from math import exp, sqrt
 import numpy as np
-from outcar_parser import Parser
-from configuration import Configuration
+from outcar_parser import Parser, CachedParser, load_parser, write_cache, SPLIT_CONFIGS, SPLIT_POS
+from configuration import Configuration, VerletList, dist, batch_descriptors, pair_rows
 import kernel
+import calibration
+import cross_validation as cv
+import extract_info
+import model_file
+import parallel
+import precision_report
+import reference
+import sweep
+import test_sigmas
+import trajectory
+import update
+import veloverlet_1000 as md
+from rdf import RDFAccumulator, RDF_FILE
+
+def write_test_outcar(path, energies, positions, forces, a=10.54664):
+    '''
+    Writes an outcar file in the format of OUTCAR.21 with the number of ions, the cubic lattice vectors of the
+    lattice constant a and one block per configuration with its positions and forces (columns of 13.5f and 14.6f)
+    and its free energy TOTEN. energies has the shape (n_conf, ), positions and forces (n_conf, n_ion, 3).
+    '''
+    with open(path, 'w') as outcar_out:
+        outcar_out.write(f'   number of dos      NEDOS =    301   number of ions     NIONS = {np.shape(positions)[1]:6d}\n\n')
+        outcar_out.write('      direct lattice vectors                 reciprocal lattice vectors\n')
+        for d in range(3):
+            row = np.eye(3)[d]
+            outcar_out.write('    ' + ' '.join(f'{a * x:12.9f}' for x in row) + '     '
+                             + ' '.join(f'{x / a:12.9f}' for x in row) + '\n')
+        outcar_out.write('\n')
+        for (energy, position, force) in zip(energies, positions, forces):
+            outcar_out.write(SPLIT_CONFIGS + '\n' + SPLIT_POS + '\n')
+            for (pos, f) in zip(position, force):
+                outcar_out.write('   ' + ''.join(f'{x:13.5f}' for x in pos) + '   ' + ''.join(f'{x:14.6f}' for x in f) + '\n')
+            outcar_out.write(SPLIT_POS + '\n    total drift:      0.000000      0.000000      0.000000\n\n')
+            outcar_out.write(f'  FREE ENERGIE OF THE ION-ELECTRON SYSTEM (eV)\n  free  energy   TOTEN  = {energy:17.8f} eV\n\n')
+
+
+def random_outcar_data(n_conf, n_ion, a=10.54664, seed=0):
+    '''
+    Returns (energies, positions, forces) for write_test_outcar, rounded to the digits of the outcar file, so they
+    survive the round trip exactly: energies uniform in [-306, -305), positions uniform in the cubic cell of the
+    lattice constant a and forces standard normal.
+    '''
+    rng = np.random.default_rng(seed)
+    energies = np.round(-306 + rng.random(n_conf), 8)
+    positions = np.round(rng.random((n_conf, n_ion, 3)) * a, 5)
+    forces = np.round(rng.normal(0, 1, (n_conf, n_ion, 3)), 6)
+    return (energies, positions, forces)
+
+
+def make_training_set(n_conf, n_ion, nr_modi=4, kern=('linear', ''), a=10.54664, seed=0):
+    '''
+    Returns (u_conf, configurations, C, qs) as calibration.main sets them up, for n_conf configurations of n_ion ions
+    with the random energies, positions and forces of random_outcar_data(n_conf, n_ion, a, seed):
+    u_conf has the keys N_conf, N_ion, lattice_vectors (cubic, a), cutoff 4, nr_modi, lambda 1e-3 and kernel; the
+    configurations have their NN tables and descriptors, C (n_conf, n_ion, nr_modi) holds the descriptors and qs the
+    nr_modi q-vectors of the cutoff.
+    '''
+    energies, positions, forces = random_outcar_data(n_conf, n_ion, a, seed)
+    configurations = [Configuration(pos, energy, force) for (energy, pos, force) in zip(energies, positions, forces)]
+    u_conf = {
+        'N_conf': n_conf, 'N_ion': n_ion, 'lattice_vectors': np.eye(3) * a,
+        'cutoff': 4, 'nr_modi': nr_modi, 'lambda': 1e-3, 'kernel': list(kern)
+    }
+    qs = np.arange(1, nr_modi+1) * np.pi / u_conf['cutoff']
+    C = np.zeros((n_conf, n_ion, nr_modi))
+    with redirect_stdout(StringIO()):
+        calibration.init_configurations(u_conf, configurations, qs, C)
+    return (u_conf, configurations, C, qs)
+
 
 class TestParser(unittest.TestCase):
 
@@ -95,16 +172,655 @@ class TestParser(unittest.TestCase):
             self.assertTrue(np.array_equal(ref_pos, pos[0]))
             self.assertTrue(np.array_equal(ref_force, force[0]))
 
+    # tests if the streaming mode gives the same configurations as the in-memory parser
+    def test_streaming(self):
+        energies, positions, forces = random_outcar_data(7, 5)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'OUTCAR.21')
+            write_test_outcar(path, energies, positions, forces)
+
+            parser = Parser(path)
+            streamer = Parser(path, stream=True)
+            self.assertIsNone(streamer.outcar_content)
+            self.assertEqual(streamer.find_ion_nr(), 5)
+            self.assertTrue(np.array_equal(streamer.find_lattice_vectors(), parser.find_lattice_vectors()))
+
+            for (step_size, offset) in [(1, 0), (2, 0), (3, 1), (4, 5), (1000, 0), (10, 6)]:
+                expected = list(parser.build_configurations(step_size, offset))
+                streamed = list(streamer.build_configurations(step_size, offset))
+                self.assertEqual(len(streamed), len(expected))
+                for ((e1, p1, f1), (e2, p2, f2)) in zip(streamed, expected):
+                    self.assertEqual(e1, e2)
+                    self.assertTrue(np.array_equal(p1, p2))
+                    self.assertTrue(np.array_equal(f1, f2))
+
+            (e, p, f), = streamer.build_configurations(1000, 3)
+            self.assertEqual(e, energies[3])
+            self.assertTrue(np.array_equal(p, positions[3]))
+            self.assertTrue(np.array_equal(f, forces[3]))
+
+        with self.assertRaises(FileNotFoundError):
+            Parser('does_not_exist/OUTCAR.21', stream=True)
+
+
+    # tests if the indexed parser reads the same configurations and rebuilds the index if the file changes
+    def test_index(self):
+        energies, positions, forces = random_outcar_data(9, 4, seed=1)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'OUTCAR.21')
+            write_test_outcar(path, energies[:6], positions[:6], forces[:6])
+
+            parser = Parser(path)
+            indexed = Parser(path, index=True)
+            self.assertIsNone(indexed.outcar_content)
+            index = indexed.index()
+            self.assertTrue(os.path.isfile(path + '.idx.npz'))
+            self.assertTrue(np.array_equal(index.energies, energies[:6]))
+            self.assertTrue(np.array_equal(index.ion_numbers, [4] * 6))
+            # the number of ions and the energies are taken from the index
+            self.assertEqual(indexed.find_ion_nr(), 4)
+
+            for (step_size, offset) in [(1, 0), (2, 1), (4, 5), (10, 7)]:
+                expected = list(parser.build_configurations(step_size, offset))
+                read = list(indexed.build_configurations(step_size, offset))
+                self.assertEqual(len(read), len(expected))
+                for ((e1, p1, f1), (e2, p2, f2)) in zip(read, expected):
+                    self.assertEqual(e1, e2)
+                    self.assertTrue(np.array_equal(p1, p2))
+                    self.assertTrue(np.array_equal(f1, f2))
+
+            energy, position, force = indexed.read_configuration(4)
+            self.assertEqual(energy, energies[4])
+            self.assertTrue(np.array_equal(position, positions[4]))
+
+            # a new parser loads the stored index, a changed file invalidates it
+            self.assertEqual(len(Parser(path, index=True).index().offsets), 6)
+            write_test_outcar(path, energies, positions, forces)
+            reindexed = Parser(path, index=True)
+            self.assertEqual(len(reindexed.index().offsets), 9)
+            self.assertTrue(np.array_equal(reindexed.read_configuration(8)[2], forces[8]))
+
+
+    # tests if the binary cache gives the same configurations and is only used while it is up to date
+    def test_cache(self):
+        energies, positions, forces = random_outcar_data(8, 4, seed=2)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'OUTCAR.21')
+            write_test_outcar(path, energies[:5], positions[:5], forces[:5])
+
+            parser = Parser(path)
+            self.assertIsInstance(load_parser(path), Parser)
+            self.assertEqual(write_cache(parser), path + '.cache.npz')
+
+            cached = load_parser(path)
+            self.assertIsInstance(cached, CachedParser)
+            self.assertEqual(cached.find_ion_nr(), parser.find_ion_nr())
+            self.assertTrue(np.array_equal(cached.find_lattice_vectors(), parser.find_lattice_vectors()))
+            for (step_size, offset) in [(1, 0), (2, 1), (3, 4), (10, 6)]:
+                expected = list(parser.build_configurations(step_size, offset))
+                read = list(cached.build_configurations(step_size, offset))
+                self.assertEqual(len(read), len(expected))
+                for ((e1, p1, f1), (e2, p2, f2)) in zip(read, expected):
+                    self.assertEqual(e1, e2)
+                    self.assertTrue(np.array_equal(p1, p2))
+                    self.assertTrue(np.array_equal(f1, f2))
+
+            # a changed outcar file makes the cache invalid, cache=True writes a new one
+            write_test_outcar(path, energies, positions, forces)
+            self.assertIsInstance(load_parser(path), Parser)
+            recached = load_parser(path, cache=True)
+            self.assertIsInstance(recached, CachedParser)
+            self.assertEqual(len(list(recached.build_configurations(1))), 8)
+
+
+class TestConfiguration(unittest.TestCase):
+
+    # builds the nn tables with the original double loop over all pairs, used as reference
+    @staticmethod
+    def brute_force_nn(positions, rcut, lattice):
+        n, dim = np.shape(positions)
+        displace = np.zeros((n, n, dim))
+        distances = np.zeros((n, n))
+        a = lattice.diagonal()
+        for i in range(n):
+            for j in range(i+1, n):
+                rj_ri = dist(positions[i, :], positions[j, :], a)
+                dr = np.sqrt(rj_ri.dot(rj_ri))
+                if dr < rcut:
+                    displace[i, j, :] = rj_ri / dr
+                    displace[j, i, :] = - rj_ri / dr
+                    distances[i, j] = dr
+                    distances[j, i] = dr
+        return (displace, distances)
+
+    # tests if the cell list gives exactly the same tables as the double loop (with and without binning)
+    def test_cell_list_matches_brute_force(self):
+        rng = np.random.default_rng(1)
+        for (n, a) in [(64, 10.54664), (300, 13.5)]:
+            lattice = np.eye(3) * a
+            positions = rng.random((n, 3)) * a
+            config = Configuration(positions)
+            config.init_nn(4, lattice)
+
+            displace, distances = self.brute_force_nn(positions, 4, lattice)
+            self.assertTrue(np.array_equal(config.nndistances, distances))
+            self.assertTrue(np.array_equal(config.nndisplace_norm, displace))
+
+    # tests if the Verlet list gives the same tables and is only rebuilt once the skin is used up
+    def test_verlet_list(self):
+        rng = np.random.default_rng(2)
+        lattice = np.eye(3) * 13.5
+        positions = rng.random((300, 3)) * 13.5
+        nn_list = VerletList(4, 1.0)
+
+        for step in range(5):
+            positions = positions + rng.normal(0, 0.02, positions.shape)
+            config = Configuration(positions)
+            config.init_nn(4, lattice, nn_list)
+            _, distances = self.brute_force_nn(positions, 4, lattice)
+            self.assertTrue(np.array_equal(config.nndistances, distances))
+        self.assertEqual(nn_list.rebuilds, 1)
+
+        positions[0] += 0.6
+        Configuration(positions).init_nn(4, lattice, nn_list)
+        self.assertEqual(nn_list.rebuilds, 2)
+
+        with self.assertRaises(ValueError):
+            Configuration(positions).init_nn(3, lattice, nn_list)
+
+    # tests if the sparse neighbour list gives the same descriptors and force matrices as the dense tables
+    def test_sparse_neighbour_list(self):
+        rng = np.random.default_rng(3)
+        lattice = np.eye(3) * 10.54664
+        positions = rng.random((64, 3)) * 10.54664
+        qs = np.arange(1, 9) * np.pi / 4
+        reference = rng.random((128, 8))
+
+        dense = Configuration(positions)
+        dense.init_nn(4, lattice)
+        dense.init_descriptor(qs)
+        sparse = Configuration(positions)
+        sparse.init_nn(4, lattice, dense=False)
+        sparse.init_descriptor(qs)
+
+        self.assertIsNone(sparse.nndistances)
+        self.assertEqual(sparse.nnpairs.indptr[-1], np.count_nonzero(dense.nndistances))
+        self.assertTrue(np.allclose(sparse.descriptors, dense.descriptors, rtol=0, atol=1e-12))
+        self.assertTrue(np.allclose(
+            kernel.linear_force_submat(qs, sparse, reference),
+            kernel.linear_force_submat(qs, dense, reference),
+            rtol=1e-12, atol=1e-12
+        ))
+        self.assertTrue(np.allclose(
+            kernel.gaussian_force_mat(qs, sparse, reference, 2),
+            kernel.gaussian_force_mat(qs, dense, reference, 2),
+            rtol=1e-12, atol=1e-12
+        ))
+
+
+    # tests if the batched descriptors match the ones of the single configurations, also when chunked
+    def test_batch_descriptors(self):
+        rng = np.random.default_rng(4)
+        lattice = np.eye(3) * 10.54664
+        positions = rng.random((12, 64, 3)) * 10.54664
+        qs = np.arange(1, 9) * np.pi / 4
+
+        C = batch_descriptors(positions, 4, lattice, qs)
+        self.assertEqual(np.shape(C), (12, 64, 8))
+        for (alpha, pos) in enumerate(positions):
+            config = Configuration(pos)
+            config.init_nn(4, lattice)
+            config.init_descriptor(qs)
+            self.assertTrue(np.array_equal(C[alpha], config.descriptors))
+
+        C_chunked = np.zeros((12, 64, 8))
+        batch_descriptors(positions, 4, lattice, qs, C_chunked, chunk_size=64*64*8*5)
+        self.assertTrue(np.array_equal(C, C_chunked))
+
+        # chunks smaller than one configuration are split into rows of central atoms, the neighbour tables of the
+        # configurations are set from the same distances
+        configurations = [Configuration(pos) for pos in positions]
+        C_rows = batch_descriptors(positions, 4, lattice, qs, chunk_size=64*8*10, configurations=configurations)
+        self.assertTrue(np.array_equal(C, C_rows))
+        for (pos, config) in zip(positions, configurations):
+            reference = Configuration(pos)
+            reference.init_nn(4, lattice)
+            self.assertTrue(np.array_equal(config.nndistances, reference.nndistances))
+            self.assertTrue(np.array_equal(config.nndisplace_norm, reference.nndisplace_norm))
+            for (pairs, reference_pairs) in zip(config.nnpairs, reference.nnpairs):
+                self.assertTrue(np.array_equal(pairs, reference_pairs))
+
+
 class TestCalibration(unittest.TestCase):
 
     # Test if the q-vector is build correctly
     def test_build_q(self):
         pass
 
+    # Test if load_data gives the same configurations for all ways of reading the outcar file
+    def test_load_data_sources(self):
+        energies, positions, forces = random_outcar_data(6, 8, seed=3)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'OUTCAR.21')
+            write_test_outcar(path, energies, positions, forces)
+            u_conf = {'file_in': path, 'stepsize': 2, 'cutoff': 4}
+
+            (n_conf, n_ion, lattice, configurations) = calibration.load_data(u_conf, 1)
+            self.assertEqual((n_conf, n_ion), (3, 8))
+            for option in ['stream', 'index', 'cache']:
+                loaded = calibration.load_data(dict(u_conf, **{option: True}), 1)
+                self.assertEqual(loaded[:2], (n_conf, n_ion))
+                self.assertTrue(np.array_equal(loaded[2], lattice))
+                for (config, expected) in zip(loaded[3], configurations):
+                    self.assertEqual(config.energy, expected.energy)
+                    self.assertTrue(np.array_equal(config.positions, expected.positions))
+                    self.assertTrue(np.array_equal(config.forces, expected.forces))
+
     # Test if the program panics if the cutoff is bigger than a/2
     def test_cutoff_too_big(self):
         pass
 
+    # Test if the streamed normal equations match the ones built from the full K and T
+    def test_build_normal(self):
+        for kern in [('linear', ''), ('gaussian', 2)]:
+            u_conf, configurations, C, qs = make_training_set(5, 16, kern=kern, seed=7)
+            with redirect_stdout(StringIO()):
+                (E, F, K, T) = calibration.build_linear(u_conf, configurations, C, qs)
+                (X, y, E_ave, K_sum) = calibration.build_normal(u_conf, configurations, C, qs)
+
+            self.assertEqual(E_ave, np.mean(E))
+            self.assertTrue(np.allclose(K_sum, np.sum(K, axis=0), rtol=1e-12, atol=1e-12))
+            KT = np.append(K, T, axis=0)
+            self.assertTrue(np.allclose(X, KT.T @ KT, rtol=1e-10, atol=1e-10))
+            self.assertTrue(np.allclose(y, KT.T @ np.append(E - E_ave, F), rtol=1e-10, atol=1e-10))
+
+        # the Gram matrix is added in place, also for fewer rows than columns
+        A = np.random.default_rng(7).normal(size=(3, 10))
+        X = np.eye(10)
+        calibration.add_gram(X, A)
+        self.assertTrue(np.allclose(X, np.eye(10) + A.T @ A, rtol=1e-14, atol=1e-14))
+        # the blocks of rows can be added in any order, under the locks of a shared X
+        X_locked = np.eye(10)
+        calibration.add_gram(X_locked, A, parallel.locks(2, workers=2), first=3)
+        self.assertTrue(np.allclose(X_locked, X, rtol=1e-14, atol=1e-14))
+
+        # streaming only builds the normal equations, qr and svd need K and T
+        calibration.check_config({'assembly': 'streaming', 'solver': 'cholesky'})
+        for solver in ['qr', 'svd']:
+            with self.assertRaises(ValueError):
+                calibration.check_config({'assembly': 'streaming', 'solver': solver})
+        with self.assertRaises(ValueError):
+            calibration.check_config({'solver': 'lu'})
+
+    # Test if the parallel assembly gives the same linear system as the serial one
+    def test_parallel_assembly(self):
+        for kern in [('linear', ''), ('gaussian', 2)]:
+            u_conf, configurations, C, qs = make_training_set(5, 16, kern=kern, seed=10)
+            with redirect_stdout(StringIO()):
+                (E, F, K, T) = calibration.build_linear(u_conf, configurations, C, qs)
+                (X, y, E_ave, K_sum) = calibration.build_normal(u_conf, configurations, C, qs)
+                u_conf['workers'] = 3
+                (E_par, F_par, K_par, T_par) = calibration.build_linear(u_conf, configurations, C, qs)
+                (X_par, y_par, E_ave_par, K_sum_par) = calibration.build_normal(u_conf, configurations, C, qs)
+
+            self.assertTrue(np.array_equal(T, T_par))
+            self.assertTrue(np.array_equal(F, F_par))
+            self.assertEqual(E_ave, E_ave_par)
+            self.assertTrue(np.allclose(X, X_par, rtol=1e-12, atol=1e-12))
+            self.assertTrue(np.allclose(y, y_par, rtol=1e-12, atol=1e-12))
+            self.assertTrue(np.allclose(K_sum, K_sum_par, rtol=1e-12, atol=1e-12))
+
+        # the rows of T are distributed over the configured number of workers
+        with mock.patch('parallel.run', wraps=parallel.run) as run, redirect_stdout(StringIO()):
+            calibration.build_linear(u_conf, configurations, C, qs)
+        self.assertEqual(run.call_args.args[2], 3)
+
+        # every item runs once, in forked processes, and writes into memory that the parent sees
+        pids = parallel.shared_array(12, dtype=np.int64)
+        owners = parallel.shared_array(12, dtype=np.int64)
+
+        def task(worker, items):
+            for i in items:
+                pids[i] = os.getpid()
+                owners[i] += worker + 1
+
+        parallel.run(task, 12, workers=3)
+        self.assertTrue(np.all(pids > 0))
+        self.assertNotIn(os.getpid(), pids)
+        self.assertTrue(np.array_equal(owners, np.arange(12) % 3 + 1))
+
+    # Test if the reference selection gives distinct points and the linear system uses them as columns
+    def test_reference_selection(self):
+        rng = np.random.default_rng(8)
+        descr = rng.random((300, 4))
+        descr[100:150] = descr[0]
+        for method in reference.METHODS:
+            indices = reference.select_reference(descr, 40, method)
+            self.assertEqual(len(np.unique(indices)), 40)
+            self.assertTrue(np.array_equal(reference.select_reference(descr, 400, method), np.arange(300)))
+        with self.assertRaises(ValueError):
+            reference.select_reference(descr, 40, 'random')
+
+        # farthest point sampling never takes a duplicate while there are distinct points left, and a larger set
+        # extends a smaller one
+        indices = reference.select_reference(descr, 250, 'fps')
+        self.assertEqual(len(np.unique(descr[indices], axis=0)), 250)
+        self.assertTrue(set(reference.select_reference(descr, 40, 'fps')) <= set(indices))
+
+        # the report of the error against M: with all descriptors as reference points the fit is the full calibration
+        energies, positions, forces = random_outcar_data(8, 8, seed=18)
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            outcar = os.path.join(tmp, 'OUTCAR.21')
+            write_test_outcar(outcar, energies, positions, forces)
+            u_report = {'file_in': outcar, 'stepsize': 2, 'cutoff': 4, 'nr_modi': 4, 'lambda': 1e-3, 'kernel': ['gaussian', 2]}
+            json_path = os.path.join(tmp, 'user_config.json')
+            with open(json_path, 'w') as json_out:
+                json.dump(u_report, json_out)
+            os.makedirs(os.path.join(tmp, 'test_data'))
+            try:
+                os.chdir(tmp)
+                with redirect_stdout(StringIO()):
+                    results = test_sigmas.test_references([8, 16, 1000], json_path=json_path)
+            finally:
+                os.chdir(cwd)
+            self.assertTrue(os.path.isfile(os.path.join(tmp, 'test_data', 'references_fps_m4_s2.dat')))
+
+            (u_report['N_conf'], u_report['N_ion'], u_report['lattice_vectors'], full) = calibration.load_data(u_report)
+            C_full = np.zeros([4, 8, 4])
+            with redirect_stdout(StringIO()):
+                calibration.init_configurations(u_report, full, np.arange(1, 5) * np.pi / 4, C_full)
+                (E, F, K, T) = calibration.build_linear(u_report, full, C_full, np.arange(1, 5) * np.pi / 4)
+        self.assertTrue(np.array_equal(results[:, 0], [8, 16, 4 * 8]))
+        w = calibration.ridge_regression(np.append(K, T, axis=0), np.append(E - np.mean(E), F), 1e-3)
+        self.assertTrue(np.allclose(results[-1, 1:3], test_sigmas.rmse(K, T, w, E, F, np.mean(E))))
+
+        u_conf, configurations, C, qs = make_training_set(4, 16, kern=('gaussian', 2), seed=9)
+        with redirect_stdout(StringIO()):
+            C_ref = calibration.reference_descriptors(dict(u_conf, n_reference=10), C)
+            C_all = calibration.reference_descriptors(u_conf, C)
+        self.assertEqual(np.shape(C_ref), (10, 4))
+        self.assertTrue(np.array_equal(C_all, C.reshape(-1, 4)))
+        with redirect_stdout(StringIO()):
+            (E, F, K, T) = calibration.build_linear(u_conf, configurations, C, qs, C_ref)
+            (E_all, F_all, K_all, T_all) = calibration.build_linear(u_conf, configurations, C, qs)
+        indices = [np.flatnonzero((C.reshape(-1, 4) == row).all(axis=1))[0] for row in C_ref]
+        self.assertEqual(np.shape(K), (4, 10))
+        self.assertEqual(np.shape(T), (4 * 16 * 3, 10))
+        self.assertTrue(np.allclose(K, K_all[:, indices]))
+        self.assertTrue(np.allclose(T, T_all[:, indices]))
+
+    # Test if all solvers give the weights of the normal equations and the svd path matches single solves
+    def test_solvers(self):
+        rng = np.random.default_rng(6)
+        K = rng.normal(size=(400, 120))
+        E = rng.normal(size=400)
+        expected = calibration.ridge_regression(K, E, 1e-2)
+        for solver in calibration.SOLVERS:
+            self.assertTrue(np.allclose(calibration.ridge_regression(K, E, 1e-2, solver), expected, rtol=1e-10, atol=1e-12))
+        with self.assertRaises(ValueError):
+            calibration.ridge_regression(K, E, 1e-2, 'lu')
+
+        lambdas = [1e-6, 1e-2, 10]
+        for solver in ['svd', 'cholesky']:
+            path = calibration.ridge_path(K, E, lambdas, solver)
+            self.assertEqual(np.shape(path), (3, 120))
+            for (lamb, w) in zip(lambdas, path):
+                self.assertTrue(np.allclose(w, calibration.ridge_regression(K, E, lamb), rtol=1e-8, atol=1e-10))
+
+        X = K.T @ K
+        path = calibration.solve_normal_path(X, K.T @ E, lambdas)
+        for (lamb, w) in zip(lambdas, path):
+            self.assertTrue(np.allclose(w, calibration.solve_normal(X, K.T @ E, lamb), rtol=1e-8, atol=1e-10))
+
+        # the updated Cholesky factor is the factor of the matrix with the added rows
+        W = rng.normal(size=(120, 7))
+        L = calibration.cholesky_update(calibration.cholesky_factor(X, 1e-2), W)
+        self.assertTrue(np.allclose(L, np.tril(L)))
+        self.assertTrue(np.allclose(L, calibration.cholesky_factor(X + W @ W.T, 1e-2)))
+
+        L = np.tril(rng.normal(size=(600, 600))) + 30 * np.eye(600)
+        b = rng.normal(size=(600, 2))
+        self.assertTrue(np.allclose(L @ calibration.solve_triangular(L, b), b))
+        self.assertTrue(np.allclose(L.T @ calibration.solve_triangular(L.T, b, lower=False), b))
+
+    # Test if every point of the sweep gives the RMSE of a separate calibration with these parameters
+    def test_sweep(self):
+        energies, positions, forces = random_outcar_data(8, 8, seed=12)
+        with tempfile.TemporaryDirectory() as tmp:
+            outcar = os.path.join(tmp, 'OUTCAR.21')
+            write_test_outcar(outcar, energies, positions, forces)
+            for kern in [['gaussian', 2], ['linear']]:
+                u_conf = {'file_in': outcar, 'stepsize': 2, 'cutoff': 4, 'nr_modi': 4, 'lambda': 1e-3, 'kernel': kern}
+                with redirect_stdout(StringIO()):
+                    results = sweep.sweep(u_conf, [3, 4], [2, 4], [1, 2], [1e-6, 1e-2], workers=2)
+                # with stepsize 1 the test configurations would be the training configurations
+                with self.assertRaises(ValueError):
+                    sweep.load_sets(dict(u_conf, stepsize=1), [4])
+                n_sigma = 2 if kern[0] == 'gaussian' else 1
+                self.assertEqual(np.shape(results), (2 * 2 * n_sigma * 2, len(sweep.RESULT_COLUMNS)))
+
+                for (cutoff, nr_modi, sigma, lamb, *rmse) in results:
+                    point = dict(u_conf, cutoff=cutoff, nr_modi=int(nr_modi), kernel=kern if np.isnan(sigma) else ['gaussian', sigma])
+                    qs = np.arange(1, point['nr_modi']+1) * np.pi / cutoff
+                    systems = []
+                    C_ref = None
+                    for offset in [0, 1]:
+                        (point['N_conf'], point['N_ion'], point['lattice_vectors'], configurations) = calibration.load_data(point, offset)
+                        C = np.zeros([point['N_conf'], point['N_ion'], point['nr_modi']])
+                        with redirect_stdout(StringIO()):
+                            calibration.init_configurations(point, configurations, qs, C)
+                            systems.append(calibration.build_linear(point, configurations, C, qs, C_ref))
+                        # the test configurations are predicted with the training descriptors as reference points
+                        C_ref = C.reshape(-1, point['nr_modi'])
+                    ((E, F, K, T), (E_test, F_test, K_test, T_test)) = systems
+                    E_ave = np.mean(E)
+                    w = calibration.ridge_regression(np.append(K, T, axis=0), np.append(E - E_ave, F), lamb)
+                    expected = [
+                        np.sqrt(np.mean((K @ w + E_ave - E)**2)), np.sqrt(np.mean((T @ w - F)**2)),
+                        np.sqrt(np.mean((K_test @ w + E_ave - E_test)**2)), np.sqrt(np.mean((T_test @ w - F_test)**2))
+                    ]
+                    self.assertTrue(np.allclose(rmse, expected, rtol=1e-5, atol=1e-8))
+
+            # the neighbour lists and descriptors are built once per cutoff, the squared distances once per nr_modi
+            # and the lambdas of a sigma are solved together
+            u_conf = {'file_in': outcar, 'stepsize': 2, 'cutoff': 4, 'nr_modi': 4, 'lambda': 1e-3, 'kernel': ['gaussian', 2]}
+            with mock.patch('sweep.cutoff_cache', wraps=sweep.cutoff_cache) as cutoff_cache, \
+                    mock.patch('sweep.squared_distances', wraps=sweep.squared_distances) as squared_distances, \
+                    mock.patch('calibration.solve_normal_path', wraps=calibration.solve_normal_path) as solve, \
+                    redirect_stdout(StringIO()):
+                sweep.sweep(u_conf, [3, 4], [2, 4], [1, 2, 3], [1e-6, 1e-4, 1e-2])
+        # training and test set of every cutoff, with all modes of the largest nr_modi
+        self.assertEqual([(c.args[1], c.args[3]) for c in cutoff_cache.call_args_list], [(3, 4), (3, 4), (4, 4), (4, 4)])
+        self.assertEqual(squared_distances.call_count, 2 * 2)
+        self.assertEqual(solve.call_count, 2 * 2 * 3)
+        self.assertTrue(all(c.args[2] == [1e-6, 1e-4, 1e-2] for c in solve.call_args_list))
+
+    # Test if the leave-out residuals are those of a separate fit without the fold
+    def test_cross_validation(self):
+        self.assertEqual([list(f) for f in cv.folds(5, 2)], [[0, 1, 2], [3, 4]])
+        self.assertEqual([list(f) for f in cv.folds(5, 2, 'interleaved')], [[0, 2, 4], [1, 3]])
+        with self.assertRaises(ValueError):
+            cv.folds(5, 6)
+
+        lambdas = [1e-6, 1e-2]
+        for kern in [('linear', ''), ('gaussian', 2)]:
+            u_conf, configurations, C, qs = make_training_set(6, 8, kern=kern, seed=13)
+            with redirect_stdout(StringIO()):
+                (E, F, K, T) = calibration.build_linear(u_conf, configurations, C, qs)
+            validation = cv.CrossValidation(E, F, K, T)
+            A = np.append(K, T, axis=0)
+            # the folds of two configurations have more rows (50) than reference points (48), a single configuration less
+            for fold in cv.folds(6, 3, 'interleaved') + [np.array([4])]:
+                rows = cv.fold_rows(fold, 6, 8)
+                train = np.delete(np.arange(len(A)), rows)
+                b = np.append(E - np.mean(np.delete(E, fold)), F)
+                residuals = validation.residuals(fold, lambdas)
+                for (lamb, res) in zip(lambdas, residuals):
+                    w = calibration.ridge_regression(A[train], b[train], lamb)
+                    # X is badly conditioned for the small lambda, both solutions agree to about 1e-7 relative
+                    self.assertTrue(np.allclose(res, b[rows] - A[rows] @ w, rtol=1e-5, atol=1e-5))
+                # the downdated normal equations give the same residuals
+                cv.COND_LIMIT, limit = 0, cv.COND_LIMIT
+                try:
+                    self.assertTrue(np.allclose(validation.residuals(fold, lambdas), residuals, rtol=1e-5, atol=1e-5))
+                finally:
+                    cv.COND_LIMIT = limit
+
+            with redirect_stdout(StringIO()):
+                for method in cv.METHODS:
+                    results = cv.cross_validate(u_conf, configurations, C, qs, 3, lambdas, method=method)
+                    self.assertEqual(np.shape(results), (2, 3, 2))
+                    self.assertTrue(np.all(results > 0))
+
+        # refit predicts with the kernel of the fit, also with another precision and force mode
+        u_low = dict(u_conf, precision='float32', force_mode='contracted')
+        with mock.patch('kernel.Kernel', wraps=kernel.Kernel) as kernels, redirect_stdout(StringIO()):
+            cv.cross_validate(u_low, configurations, C, qs, 3, lambdas, method='refit')
+        self.assertTrue(kernels.call_args_list)
+        for call in kernels.call_args_list:
+            self.assertEqual((call.kwargs['precision'], call.kwargs['force_mode']), ('float32', 'contracted'))
+
+        # the last point of the learning curve is the fit to all configurations
+        (E_test, F_test, K_test, T_test) = (E[:2], F[:2 * 8 * 3], K[:2], T[:2 * 8 * 3])
+        curve = cv.learning_curve(E, F, K, T, E_test, F_test, K_test, T_test, [6, 2, 4], 1e-2)
+        self.assertTrue(np.array_equal(curve[:, 0], [2, 4, 6]))
+        w = calibration.ridge_regression(A, np.append(E - np.mean(E), F), 1e-2)
+        self.assertTrue(np.allclose(curve[-1, 1:], [
+            np.sqrt(np.mean((K_test @ w + np.mean(E) - E_test)**2)), np.sqrt(np.mean((T_test @ w - F_test)**2))
+        ]))
+
+
+class TestModelFile(unittest.TestCase):
+
+    # tests if arrays and parameters survive the round trip through the model file
+    def test_round_trip(self):
+        arrays = {'w': np.arange(7.0), 'C': np.arange(24.0).reshape(8, 3), 'q': np.float32([1, 2, 3])}
+        params = {'kernel': ['gaussian', 16], 'sigma': 16, 'E_ave': -306.5}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'test.model')
+            model_file.save_model(path, arrays, params)
+
+            for mmap in [True, False]:
+                model = model_file.load_model(path, mmap)
+                self.assertEqual(model['kernel'], ['gaussian', 16])
+                self.assertEqual(model['E_ave'], -306.5)
+                for (name, values) in arrays.items():
+                    self.assertEqual(model[name].dtype, values.dtype)
+                    self.assertTrue(np.array_equal(model[name], values))
+            self.assertIsInstance(model_file.load_model(path)['C'], np.memmap)
+            del model
+
+            # saving again replaces the file, a memory map of the old one still reads the old arrays
+            mapped = model_file.load_model(path)
+            model_file.save_model(path, {'w': np.zeros(3)}, params)
+            self.assertTrue(np.array_equal(mapped['C'], arrays['C']))
+            self.assertEqual(np.shape(model_file.load_model(path)['w']), (3, ))
+            self.assertEqual(os.listdir(tmp), ['test.model'])
+            del mapped
+
+            with open(path, 'r+b') as model_out:
+                model_out.seek(8)
+                model_out.write(b'\xff')
+            with self.assertRaises(ValueError):
+                model_file.load_model(path)
+
+    # tests if a calibration run writes the model file and the text files with the same content
+    def test_calibration_output(self):
+        energies, positions, forces = random_outcar_data(6, 8, seed=4)
+        with tempfile.TemporaryDirectory() as tmp:
+            outcar = os.path.join(tmp, 'OUTCAR.21')
+            write_test_outcar(outcar, energies, positions, forces)
+            u_conf = {
+                'file_in': outcar, 'file_out': os.path.join(tmp, 'out'), 'stepsize': 1,
+                'cutoff': 4, 'nr_modi': 4, 'lambda': 1e-3, 'kernel': ['gaussian', 2]
+            }
+            config_path = os.path.join(tmp, 'user_config.json')
+            with open(config_path, 'w') as json_out:
+                json.dump(u_conf, json_out)
+
+            saved_argv, saved_stdout = sys.argv, sys.stdout
+            try:
+                sys.argv = ['calibration.py', config_path]
+                sys.stdout = StringIO()
+                calibration.main()
+            finally:
+                sys.argv, sys.stdout = saved_argv, saved_stdout
+
+            model = model_file.load_calibration(u_conf['file_out'])
+            self.assertEqual(model['kernel'], ['gaussian', 2])
+            self.assertEqual(np.shape(model['C']), (6 * 8, 4))
+            self.assertTrue(np.array_equal(model['C'], np.loadtxt(u_conf['file_out'] + '/calibration_C.out')))
+            self.assertTrue(np.array_equal(model['w'], np.loadtxt(u_conf['file_out'] + '/calibration_w.out')))
+            self.assertEqual(model['E_ave'], np.loadtxt(u_conf['file_out'] + '/calibration_E.out')[0])
+            del model
+            # a json-file, that does not match the calibration, is rejected
+            model_file.load_calibration(u_conf['file_out'], u_conf=u_conf)
+            for wrong in [{'kernel': ['gaussian', 3]}, {'cutoff': 3.5}, {'nr_modi': 5}]:
+                with self.assertRaises(ValueError):
+                    model_file.load_calibration(u_conf['file_out'], u_conf=dict(u_conf, **wrong))
+
+            # without the model file, the text files are loaded
+            os.remove(os.path.join(u_conf['file_out'], model_file.MODEL_FILE))
+            model = model_file.load_calibration(u_conf['file_out'])
+            self.assertEqual(np.shape(model['w']), (6 * 8, ))
+
+    # tests if updating a calibration with new configurations gives the calibration of all configurations
+    def test_update(self):
+        energies, positions, forces = random_outcar_data(7, 8, seed=14)
+        # the Gaussian calibration updates the Cholesky factor, the linear one factorizes again
+        saved_ratio = update.CHOLESKY_UPDATE_RATIO
+        for (kern, assembly, ratio) in [(['gaussian', 2], 'dense', 0), (['linear'], 'streaming', 10**6)]:
+            update.CHOLESKY_UPDATE_RATIO = ratio
+            with tempfile.TemporaryDirectory() as tmp:
+                outcars = [os.path.join(tmp, 'OUTCAR.21'), os.path.join(tmp, 'OUTCAR.22')]
+                write_test_outcar(outcars[0], energies[:4], positions[:4], forces[:4])
+                write_test_outcar(outcars[1], energies[4:], positions[4:], forces[4:])
+                u_conf = {
+                    'file_in': outcars[0], 'file_out': os.path.join(tmp, 'out'), 'stepsize': 1, 'cutoff': 4,
+                    'nr_modi': 4, 'lambda': 1e-3, 'kernel': kern, 'assembly': assembly, 'updatable': True
+                }
+                config_path = os.path.join(tmp, 'user_config.json')
+                with open(config_path, 'w') as json_out:
+                    json.dump(u_conf, json_out)
+
+                saved_argv = sys.argv
+                try:
+                    sys.argv = ['calibration.py', config_path]
+                    with redirect_stdout(StringIO()):
+                        calibration.main()
+                finally:
+                    sys.argv = saved_argv
+                with redirect_stdout(StringIO()):
+                    old = model_file.load_calibration(u_conf['file_out'])
+                    C_ref = np.array(old['C'])
+                    update.main([config_path, '--file-in', outcars[1]])
+                    # the model file is replaced, not rewritten under the memory map of the old one
+                    self.assertTrue(np.array_equal(old['C'], C_ref))
+                    self.assertFalse([name for name in os.listdir(u_conf['file_out']) if name.endswith('.tmp')])
+
+                    # the calibration of all configurations with the reference points of the first one
+                    write_test_outcar(outcars[0], energies, positions, forces)
+                    u_all = dict(u_conf)
+                    qs = np.arange(1, 5) * np.pi / 4
+                    (u_all['N_conf'], u_all['N_ion'], u_all['lattice_vectors'], configurations) = calibration.load_data(u_all)
+                    C = np.zeros([7, 8, 4])
+                    calibration.init_configurations(u_all, configurations, qs, C)
+                    (E, F, K, T) = calibration.build_linear(u_all, configurations, C, qs, C_ref)
+                w = calibration.ridge_regression(np.append(K, T, axis=0), np.append(E - np.mean(E), F), 1e-3)
+
+                model = model_file.load_calibration(u_conf['file_out'], mmap=False)
+                self.assertEqual(model['n_conf'], 7)
+                self.assertAlmostEqual(model['E_ave'], np.mean(E))
+                self.assertTrue(np.allclose(model['w'], w, rtol=1e-6, atol=1e-8))
+                self.assertTrue(np.allclose(model['w'], np.loadtxt(u_conf['file_out'] + '/calibration_w.out')))
+
+                # a calibration without the sums cannot be updated
+                os.remove(os.path.join(u_conf['file_out'], model_file.MODEL_FILE))
+                with self.assertRaises(ValueError), redirect_stdout(StringIO()):
+                    update.main([config_path, '--file-in', outcars[1]])
+        update.CHOLESKY_UPDATE_RATIO = saved_ratio
+
 
 class TestKernel(unittest.TestCase):
     # Tests if the shape and value of the kernel-fcts is the expected
@@ -125,6 +841,111 @@ class TestKernel(unittest.TestCase):
         with self.assertRaises(ValueError):
             kernel.Kernel('gaussian')
 
+    # tests if the contracted Gaussian force matrix gives the same result as the broadcasting one
+    def test_gaussian_force_mat_contracted(self):
+        rng = np.random.default_rng(5)
+        lattice = np.eye(3) * 10.54664
+        qs = np.arange(1, 9) * np.pi / 4
+        config = Configuration(rng.random((64, 3)) * 10.54664)
+        config.init_nn(4, lattice)
+        config.init_descriptor(qs)
+        reference = rng.random((200, 8)) * 3
+
+        for sigma in [0.5, 2, 16]:
+            broadcast = kernel.gaussian_force_mat(qs, config, reference, sigma)
+            contracted = kernel.gaussian_force_mat_contracted(qs, config, reference, sigma)
+            self.assertEqual(np.shape(contracted), (64 * 3, 200))
+            self.assertTrue(np.allclose(contracted, broadcast, rtol=1e-12, atol=1e-14))
+
+        kern = kernel.Kernel('gaussian', 2, force_mode='contracted')
+        self.assertTrue(np.allclose(
+            kern.force_submat(qs, config, reference),
+            kernel.gaussian_force_mat(qs, config, reference, 2),
+            rtol=1e-12, atol=1e-14
+        ))
+        with self.assertRaises(ValueError):
+            kernel.Kernel('gaussian', 2, force_mode='unknown')
+
+    # tests if the batched prediction gives the same energies and forces as T @ w for every configuration
+    def test_predict_batch(self):
+        rng = np.random.default_rng(6)
+        lattice = np.eye(3) * 10.54664
+        qs = np.arange(1, 9) * np.pi / 4
+        configurations = []
+        for _ in range(5):
+            config = Configuration(rng.random((64, 3)) * 10.54664)
+            config.init_nn(4, lattice)
+            config.init_descriptor(qs)
+            configurations.append(config)
+        reference = rng.random((200, 8)) * 3
+        weights = rng.normal(size=200)
+
+        for kern in [kernel.Kernel('linear'), kernel.Kernel('gaussian', 2)]:
+            (E, F) = kern.predict_batch(qs, configurations, reference, weights, -3.5)
+            self.assertEqual(np.shape(E), (5, ))
+            self.assertEqual(np.shape(F), (5, 64, 3))
+            for (alpha, config) in enumerate(configurations):
+                (E_alpha, F_alpha) = kern.predict(qs, config, reference, weights, -3.5)
+                self.assertAlmostEqual(E[alpha], E_alpha, 9)
+                self.assertTrue(np.allclose(F[alpha], F_alpha, rtol=1e-10, atol=1e-10))
+
+    # tests if a kernel bound to the reference descriptors gives the same results as an unbound one
+    def test_bind(self):
+        rng = np.random.default_rng(7)
+        lattice = np.eye(3) * 10.54664
+        qs = np.arange(1, 9) * np.pi / 4
+        config = Configuration(rng.random((64, 3)) * 10.54664)
+        config.init_nn(4, lattice)
+        config.init_descriptor(qs)
+        reference = rng.random((200, 8)) * 3
+        weights = rng.normal(size=200)
+
+        for (mode, args) in [('linear', ()), ('gaussian', (2, )), ('gaussian', (0.5, ))]:
+            for force_mode in kernel.GAUSSIAN_FORCE_MODES:
+                unbound = kernel.Kernel(mode, *args, force_mode=force_mode)
+                bound = kernel.Kernel(mode, *args, force_mode=force_mode)
+                bound.bind(qs, reference, weights)
+                self.assertTrue(np.allclose(
+                    bound.kernel_mat(config.descriptors, reference),
+                    unbound.kernel_mat(config.descriptors, reference),
+                    rtol=1e-12, atol=1e-14
+                ))
+                self.assertTrue(np.allclose(
+                    bound.force_submat(qs, config, reference),
+                    unbound.force_submat(qs, config, reference),
+                    rtol=1e-12, atol=1e-14
+                ))
+                (E_bound, F_bound) = bound.predict_batch(qs, [config], reference, weights, 0)
+                (E, F) = unbound.predict_batch(qs, [config], reference, weights, 0)
+                self.assertAlmostEqual(E_bound[0], E[0], 9)
+                self.assertTrue(np.allclose(F_bound, F, rtol=1e-12, atol=1e-12))
+
+            # other descriptors than the bound ones do not use the cache
+            other = reference[::2].copy()
+            self.assertIsNot(bound.cached_reference(qs, other, weights[::2]), bound.reference)
+            self.assertTrue(np.allclose(
+                bound.force_submat(qs, config, other), unbound.force_submat(qs, config, other), rtol=1e-12, atol=1e-14
+            ))
+
+    # tests if the production predictor gives the same energy and forces as Kernel.predict
+    def test_predictor(self):
+        rng = np.random.default_rng(8)
+        lattice = np.eye(3) * 10.54664
+        qs = np.arange(1, 9) * np.pi / 4
+        config = Configuration(rng.random((64, 3)) * 10.54664)
+        config.init_nn(4, lattice, dense=False)
+        config.init_descriptor(qs)
+        reference = rng.random((200, 8)) * 3
+        weights = rng.normal(size=200)
+
+        for kern in [kernel.Kernel('linear'), kernel.Kernel('gaussian', 2)]:
+            (E, F) = kern.predict(qs, config, reference, weights, 1.25)
+            predictor = kernel.Predictor(kern, qs, reference, weights, 1.25)
+            (E_pred, F_pred) = predictor.predict(config)
+            self.assertAlmostEqual(E_pred, E, 9)
+            self.assertEqual(np.shape(F_pred), (64, 3))
+            self.assertTrue(np.allclose(F_pred, F, rtol=1e-10, atol=1e-10))
+
     # tests if the value of the matrix element is the expected
     def test_linear_energy_matrix_element(self):
         kern = kernel.Kernel('linear')
@@ -145,6 +966,114 @@ class TestKernel(unittest.TestCase):
         fifty_el = np.sum(kern.kernel_mat(descr1, five), axis=0)
         self.assertEqual(fifty_el, 50)
 
+    # tests the float32 kernel against float64 and that the sums are accumulated in float64
+    def test_precision(self):
+        rng = np.random.default_rng(16)
+        lattice = np.eye(3) * 10.54664
+        qs = np.arange(1, 9) * np.pi / 4
+        configurations = []
+        for dense in [True, False]:
+            config = Configuration(rng.random((64, 3)) * 10.54664)
+            config.init_nn(4, lattice, dense=dense)
+            config.init_descriptor(qs)
+            configurations.append(config)
+        reference = rng.random((200, 8)) * 3
+        weights = rng.normal(size=200)
+
+        for (mode, args) in [('linear', ()), ('gaussian', (2, ))]:
+            for force_mode in kernel.GAUSSIAN_FORCE_MODES:
+                exact = kernel.Kernel(mode, *args, force_mode=force_mode)
+                low = kernel.Kernel(mode, *args, force_mode=force_mode, precision='float32')
+                for config in configurations:
+                    K = low.kernel_mat(config.descriptors, reference)
+                    T = low.force_submat(qs, config, reference)
+                    self.assertEqual(K.dtype, np.float32)
+                    self.assertEqual(T.dtype, np.float32)
+                    K_exact = exact.kernel_mat(config.descriptors, reference)
+                    T_exact = exact.force_submat(qs, config, reference)
+                    self.assertLess(np.max(np.abs(K - K_exact)), 1e-5 * np.max(np.abs(K_exact)))
+                    self.assertLess(np.max(np.abs(T - T_exact)), 1e-5 * np.max(np.abs(T_exact)))
+                # a bound kernel uses the converted reference
+                low.bind(qs, reference, weights)
+                self.assertEqual(low.force_submat(qs, configurations[0], reference).dtype, np.float32)
+
+            (E, F) = kernel.Predictor(exact, qs, reference, weights, -300).predict(configurations[1])
+            (E_low, F_low) = kernel.Predictor(low, qs, reference, weights, -300).predict(configurations[1])
+            self.assertEqual(F_low.dtype, np.float64)
+            self.assertAlmostEqual(E_low, E, 4)
+            self.assertLess(np.max(np.abs(F_low - F)), 1e-5 * np.max(np.abs(F)))
+
+            report = precision_report.precision_report([mode, *args], qs, configurations, reference, weights, -300)
+            for name in precision_report.REPORT_QUANTITIES:
+                self.assertLess(report[name][2], 1e-5)
+            self.assertIn('time_float32', report)
+
+        # the normal equations are accumulated in float64
+        u_conf, configurations, C, qs = make_training_set(3, 8, kern=('gaussian', 2), seed=16)
+        with redirect_stdout(StringIO()):
+            (X, y, _, _) = calibration.build_normal(u_conf, configurations, C, qs)
+            (X_low, y_low, _, _) = calibration.build_normal(dict(u_conf, precision='float32'), configurations, C, qs)
+        self.assertEqual(X_low.dtype, np.float64)
+        self.assertLess(np.max(np.abs(X_low - X)), 1e-5 * np.max(np.abs(X)))
+
+        # the force submatrices take half the memory, the energies of K are summed and the weights solved in float64
+        T_exact = kernel.Kernel('gaussian', 2).force_submat(qs, configurations[0], C[0])
+        T_low = kernel.Kernel('gaussian', 2, precision='float32').force_submat(qs, configurations[0], C[0])
+        self.assertEqual(T_low.nbytes * 2, T_exact.nbytes)
+        with redirect_stdout(StringIO()):
+            (E, F, K, T) = calibration.build_linear(dict(u_conf, precision='float32'), configurations, C, qs)
+        self.assertEqual(K.dtype, np.float64)
+        w = calibration.ridge_regression(np.append(K, T, axis=0), np.append(E - np.mean(E), F), 1e-3)
+        self.assertEqual(w.dtype, np.float64)
+        with self.assertRaises(ValueError):
+            kernel.Kernel('linear', precision='float16')
+
+    # tests the predictive variance against k^T (X + lamb I)^-1 k
+    def test_uncertainty(self):
+        rng = np.random.default_rng(15)
+        V = np.linalg.qr(rng.normal(size=(200, 200)))[0]
+        X = (V * 0.5**np.arange(200)) @ V.T
+        (s, V_low) = kernel.low_rank_eigh(X, 20)
+        self.assertTrue(np.allclose(s, np.linalg.eigh(X)[0][-20:], rtol=1e-8))
+        self.assertTrue(np.allclose(np.abs(V_low.T @ V[:, :20][:, ::-1]), np.eye(20), atol=1e-6))
+
+        for mode in [('linear', ''), ('gaussian', 2)]:
+            u_conf, configurations, C, qs = make_training_set(6, 8, kern=mode, seed=15)
+            with redirect_stdout(StringIO()):
+                (E, F, K, T) = calibration.build_linear(u_conf, configurations, C, qs)
+            A = np.append(K, T, axis=0)
+            C_ref = C.reshape(-1, 4)
+            kern = kernel.Kernel(*mode)
+            # descriptors of the training data and far away from it
+            descriptors = np.append(C_ref[:8], C_ref[:8] * 3 + 5, axis=0)
+            k = kern.kernel_mat(descriptors, C_ref)
+            exact = np.sum(k * np.linalg.solve(A.T @ A + 1e-3 * np.eye(48), k.T).T, axis=1)
+            if mode[0] == 'gaussian':
+                K_ref = kern.kernel_mat(C_ref, C_ref)
+                exact += 1 - np.sum(k * (np.linalg.pinv(K_ref, rcond=kernel.NYSTROEM_CUTOFF, hermitian=True) @ k.T).T, axis=1)
+
+            full = kernel.Uncertainty(kern, qs, C_ref, A.T @ A, 1e-3, rank=48).variance(descriptors)
+            self.assertTrue(np.allclose(full, exact, rtol=1e-6, atol=1e-8))
+            # far away from the training data the variance is larger (X of the linear kernel has the rank nq = 4), the
+            # Gaussian rank keeps the eigenvalues of X above about lambda
+            rank = 3 if mode[0] == 'linear' else 20
+            low = kernel.Uncertainty.from_model(kern, qs, {'C': C_ref, 'X': A.T @ A, 'lambda': 1e-3}, rank).variance(descriptors)
+            self.assertGreater(np.min(low[8:]), np.max(low[:8]))
+
+        # with many eigenvalues outside of the kept rank the low rank variance is an upper bound of the exact one
+        C_ref = rng.normal(size=(200, 4))
+        descriptors = rng.normal(size=(20, 4))
+        X = (V * np.logspace(3, -5, 200)) @ V.T
+        k = descriptors @ C_ref.T
+        exact = np.sum(k * np.linalg.solve(X + 1e-3 * np.eye(200), k.T).T, axis=1)
+        kern = kernel.Kernel('linear')
+        low = kernel.Uncertainty(kern, qs, C_ref, X, 1e-3, rank=10).variance(descriptors)
+        self.assertTrue(np.all(low >= exact * (1 - 1e-8)))
+        full = kernel.Uncertainty(kern, qs, C_ref, X, 1e-3, rank=200).variance(descriptors)
+        self.assertTrue(np.allclose(full, exact, rtol=1e-6))
+        with self.assertRaises(ValueError):
+            kernel.Uncertainty.from_model(kern, qs, {'C': C_ref, 'lambda': 1e-3})
+
     # tests the correct shape of the energy matrix in the linear case
     def test_linear_energy_matrix_shape(self):
         desc1 = np.ones((50, 5))
@@ -315,3 +1244,365 @@ class TestKernel(unittest.TestCase):
         F_reg = kern.force_submat(qs, config, descriptors) @ weights
         print('\n', f'Gaussian difference: {Fx_finite - F_reg[0]}')
         self.assertAlmostEqual(Fx_finite, F_reg[0], 7)
+
+
+def make_predictor(mode=('gaussian', 2), nr_modi=4, n_ref=100, seed=0):
+    '''
+    Returns a kernel.Predictor of the kernel mode with n_ref random reference descriptors (uniform in [0, 3) for nr_modi
+    q-vectors of the cutoff 4), small random weights (normal, 0.01) and E_ave = -300. It is no fit to any data, but its
+    forces are the exact derivatives of its energy, which is all the MD tests need.
+    '''
+    rng = np.random.default_rng(seed)
+    qs = np.arange(1, nr_modi+1) * np.pi / 4
+    kern = kernel.Kernel(*mode)
+    return kernel.Predictor(kern, qs, rng.random((n_ref, nr_modi)) * 3, rng.normal(0, 0.01, n_ref), -300)
+
+
+class TestMD(unittest.TestCase):
+    # tests if one step of the simulation is the Velocity-Verlet step with the forces of Kernel.predict
+    def test_step(self):
+        predictor = make_predictor()
+        (lattice, positions, velocities) = md.random_state(1000, 32, 10, rng=np.random.default_rng(1))
+        sim = md.MDSimulation(predictor, 4, lattice, positions, velocities, dt=0.5)
+        ref = predictor.reference
+
+        def predict(x):
+            config = Configuration(x)
+            config.init_nn(4, lattice)
+            config.init_descriptor(predictor.qs)
+            return predictor.kernel.predict(predictor.qs, config, ref.descriptors, ref.weights, predictor.E_ave)
+
+        (E0, F0) = predict(positions)
+        self.assertAlmostEqual(sim.energy, E0, 9)
+        x1 = (positions + velocities * 0.5 + F0 / (2 * sim.mass_ev) * 0.5**2) % 10
+        (E1, F1) = predict(x1)
+        v1 = velocities + (F0 + F1) / (2 * sim.mass_ev) * 0.5
+
+        sim.step()
+        self.assertEqual(sim.steps, 1)
+        self.assertTrue(np.allclose(sim.positions, x1, rtol=1e-12, atol=1e-12))
+        self.assertTrue(np.allclose(sim.velocities, v1, rtol=1e-12, atol=1e-12))
+        self.assertTrue(np.allclose(sim.forces, F1, rtol=1e-10, atol=1e-10))
+        self.assertAlmostEqual(sim.energy, E1, 9)
+        # the configuration shares the positions of the simulation
+        self.assertIs(sim.config.positions, sim.positions)
+
+    # tests if the monitor flags and writes the frames with a high variance
+    def test_uncertainty_monitor(self):
+        predictor = make_predictor()
+        ref = predictor.reference
+        rng = np.random.default_rng(2)
+        uncertainty = kernel.Uncertainty(predictor.kernel, predictor.qs, ref.descriptors, np.eye(100) * 50, 1e-3, rank=10)
+        (lattice, positions, velocities) = md.random_state(1000, 32, 10, rng=rng)
+        sim = md.MDSimulation(predictor, 4, lattice, positions, velocities, dt=0.5)
+        with tempfile.TemporaryDirectory() as tmp:
+            monitor = md.UncertaintyMonitor(uncertainty, 0, interval=5, directory=tmp)
+            never = md.UncertaintyMonitor(uncertainty, np.inf, interval=1)
+            sim.hooks += [monitor, never]
+            sim.run(10)
+            self.assertEqual([step for (step, _, _) in monitor.flagged], [5, 10])
+            self.assertEqual(never.flagged, [])
+            (_, variance, atom) = monitor.flagged[-1]
+            self.assertAlmostEqual(variance, uncertainty.variance(sim.config.descriptors)[atom])
+            (lat, pos, vel) = md.read_contcar(os.path.join(tmp, 'CONTCAR_0000010'))
+            self.assertTrue(np.allclose(lat, lattice))
+            self.assertTrue(np.allclose(pos, sim.positions, rtol=1e-12, atol=1e-12))
+            self.assertTrue(np.allclose(vel, sim.velocities, rtol=1e-12, atol=1e-15))
+
+    # tests if main runs the uncertainty monitor with the model of the predictor and needs an updatable calibration,
+    # and if it writes g(r) instead of nn.out with the key rdf
+    def test_main_uncertainty(self):
+        energies, positions, forces = random_outcar_data(4, 16, seed=17)
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            outcar = os.path.join(tmp, 'OUTCAR.21')
+            write_test_outcar(outcar, energies, positions, forces)
+            u_conf = {
+                'file_in': outcar, 'file_out': os.path.join(tmp, 'out'), 'stepsize': 1, 'cutoff': 4, 'nr_modi': 4,
+                'lambda': 1e-3, 'kernel': ['gaussian', 2], 'uncertainty': {'threshold': 0, 'interval': 5, 'rank': 20}
+            }
+            config_path = os.path.join(tmp, 'user_config.json')
+            saved_argv = sys.argv
+            try:
+                os.chdir(tmp)
+                sim = md.MDSimulation(make_predictor(), 4, *md.random_state(300, 16, 10.54664, rng=np.random.default_rng(6)))
+                md.write_contcar('CONTCAR', sim)
+                for updatable in [False, True]:
+                    with open(config_path, 'w') as json_out:
+                        json.dump(dict(u_conf, updatable=updatable), json_out)
+                    sys.argv = ['calibration.py', config_path]
+                    with redirect_stdout(StringIO()):
+                        calibration.main()
+                    if not updatable:
+                        with self.assertRaises(ValueError):
+                            md.main(steps=10, config_path=config_path)
+                        self.assertFalse(os.path.exists(os.path.join(tmp, 'out', 'vv.out')))
+                md.main(steps=10, config_path=config_path)
+
+                # with rdf the same run accumulates g(r) from the NN distances of the predictor instead of writing nn.out
+                distances = np.loadtxt(os.path.join(tmp, 'out', 'nn.out'))
+                os.remove(os.path.join(tmp, 'out', 'nn.out'))
+                u_rdf = dict(u_conf, updatable=True, rdf=True, rdf_bins=8)
+                del u_rdf['uncertainty']
+                with open(config_path, 'w') as json_out:
+                    json.dump(u_rdf, json_out)
+                md.main(steps=10, config_path=config_path)
+            finally:
+                sys.argv = saved_argv
+                os.chdir(cwd)
+            flagged = np.loadtxt(os.path.join(tmp, 'out', 'uncertain.out'))
+            self.assertTrue(np.array_equal(flagged[:, 0], [5, 10]))
+            self.assertTrue(os.path.isfile(os.path.join(tmp, 'out', 'uncertain', 'CONTCAR_0000010')))
+
+            self.assertFalse(os.path.exists(os.path.join(tmp, 'out', 'nn.out')))
+            (r, g, _) = np.loadtxt(os.path.join(tmp, 'out', RDF_FILE)).T
+            expected = RDFAccumulator(4, 16, 10.54664**3, n_bins=8)
+            expected.accumulate(distances)
+            self.assertTrue(np.allclose(r, expected.r()))
+            self.assertTrue(np.allclose(g, expected.g(), rtol=1e-6))
+
+    # tests if the integration is time reversible and the thermostat sets the temperature
+    def test_run(self):
+        predictor = make_predictor()
+        (lattice, positions, velocities) = md.random_state(300, 32, 10, rng=np.random.default_rng(2))
+        sim = md.MDSimulation(predictor, 4, lattice, positions, velocities, dt=0.5)
+        sim.run(40)
+        sim.velocities *= -1
+        sim.run(40)
+        self.assertTrue(np.allclose(dist(sim.positions, positions, 10), 0, atol=1e-9))
+        self.assertTrue(np.allclose(sim.velocities, -velocities, atol=1e-12))
+
+        md.equilibrate(sim, 600, steps=20)
+        self.assertAlmostEqual(sim.temperature(), 600, 6)
+        self.assertIsNone(sim.thermostat)
+
+        nn_file = StringIO()
+        md.nn_write(sim, nn_file)
+        distances = np.array(nn_file.getvalue().split(), dtype=float)
+        self.assertEqual(len(distances), sim.config.nnpairs.indptr[-1] // 2)
+        self.assertTrue(np.all(distances < 4))
+
+    # tests if the deprecated module-level functions run the MDSimulation of the calibration
+    def test_legacy_interface(self):
+        predictor = make_predictor()
+        saved = md._legacy_predictor
+        md._legacy_predictor = (predictor, {'cutoff': 4})
+        try:
+            with self.assertWarns(DeprecationWarning):
+                sim = md.data_input_rand(300)
+            self.assertIs(sim.predictor, predictor)
+            single = md.MDSimulation(predictor, 4, sim.lattice, sim.positions, sim.velocities, dt=0.5)
+            nn_file = StringIO()
+            with self.assertWarns(DeprecationWarning):
+                self.assertIs(md.veloverlet_10(0.5, sim, nn_file), sim)
+            single.run(10)
+            self.assertTrue(np.array_equal(sim.positions, single.positions))
+            self.assertEqual(len(nn_file.getvalue().split()), len(sim.nn_distances()))
+
+            config = Configuration(np.array(sim.positions))
+            with self.assertWarns(DeprecationWarning):
+                md.predict_forces(config, sim.lattice)
+            self.assertAlmostEqual(config.energy, sim.energy, 9)
+            self.assertTrue(np.allclose(config.forces, sim.forces, rtol=1e-10, atol=1e-12))
+        finally:
+            md._legacy_predictor = saved
+
+        # equilibrate keeps the positional dt of the former interface
+        md.equilibrate(single, 600, 0.25, False, steps=10)
+        self.assertEqual(single.dt, 0.25)
+
+    # tests if the replicas of an ensemble follow the same trajectories as single simulations
+    def test_ensemble(self):
+        predictor = make_predictor()
+        states = [md.random_state(T, 32, 10, rng=np.random.default_rng(seed)) for (seed, T) in enumerate([300, 900, 1500])]
+        ensemble = md.Ensemble([md.MDSimulation(predictor, 4, *state, dt=0.5) for state in states])
+        singles = [md.MDSimulation(predictor, 4, *state, dt=0.5) for state in states]
+
+        ensemble.equilibrate([300, 900, 1500], steps=20)
+        for (sim, T) in zip(singles, [300, 900, 1500]):
+            md.equilibrate(sim, T, steps=20)
+        ensemble.run(5)
+        for sim in singles:
+            sim.run(5)
+
+        for (replica, sim) in zip(ensemble.simulations, singles):
+            self.assertEqual(replica.steps, 25)
+            self.assertAlmostEqual(replica.energy, sim.energy, 9)
+            self.assertTrue(np.allclose(replica.positions, sim.positions, rtol=1e-12, atol=1e-12))
+            self.assertTrue(np.allclose(replica.forces, sim.forces, rtol=1e-10, atol=1e-12))
+        self.assertAlmostEqual(ensemble.simulations[1].temperature(), singles[1].temperature(), 6)
+
+        # every step is one evaluation of the predictor on the stacked descriptors of all replicas
+        with mock.patch.object(predictor, 'energy_forces', wraps=predictor.energy_forces) as energy_forces:
+            ensemble.run(3)
+        self.assertEqual(energy_forces.call_count, 3)
+        self.assertEqual(np.shape(energy_forces.call_args.args[0]), (3 * 32, 4))
+
+        with self.assertRaises(ValueError):
+            md.Ensemble([singles[0], md.MDSimulation(make_predictor(), 4, *states[0])])
+
+    # tests if the binary trajectory holds all frames and converts into the legacy text files
+    def test_trajectory(self):
+        predictor = make_predictor()
+        sim = md.MDSimulation(predictor, 4, *md.random_state(300, 32, 10, rng=np.random.default_rng(3)), dt=0.5)
+        vv_file = StringIO()
+        nn_file = StringIO()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, trajectory.TRAJECTORY_FILE)
+            with trajectory.TrajectoryWriter(path, chunk_size=3, queue_size=1) as writer:
+                writer.append(sim, nn=False)
+                md.veloverlet_write(sim, 0, vv_file)
+                for i in range(7):
+                    sim.run(2)
+                    writer.append(sim)
+                    md.nn_write(sim, nn_file)
+                    md.veloverlet_write(sim, i+1, vv_file)
+
+            self.assertEqual(len(list(trajectory.iter_chunks(path))), 3)
+            traj = trajectory.read_trajectory(path)
+            self.assertTrue(np.array_equal(traj['step'], np.arange(0, 16, 2)))
+            self.assertTrue(np.array_equal(traj['positions'][-1], sim.positions))
+            self.assertTrue(np.array_equal(traj['forces'][-1], sim.forces))
+            self.assertEqual(traj['nn_counts'][0], 0)
+            self.assertTrue(np.array_equal(traj['nn_distances'][-traj['nn_counts'][-1]:], sim.nn_distances()))
+
+            trajectory.to_legacy(path, os.path.join(directory, 'vv.out'), os.path.join(directory, 'nn.out'))
+            with open(os.path.join(directory, 'vv.out'), newline='') as vv_in:
+                self.assertEqual(vv_in.read(), vv_file.getvalue())
+            with open(os.path.join(directory, 'nn.out'), newline='') as nn_in:
+                self.assertEqual(nn_in.read(), nn_file.getvalue())
+
+    # tests if the chunks are written by the background thread and the simulation only waits, when the queue is full
+    def test_trajectory_writer(self):
+        sim = md.MDSimulation(make_predictor(), 4, *md.random_state(300, 32, 10, rng=np.random.default_rng(5)), dt=0.5)
+        release = threading.Event()
+        writing_threads = set()
+
+        class StalledFile(object):
+            def __init__(self, traj_out):
+                self.traj_out = traj_out
+
+            def write(self, data):
+                writing_threads.add(threading.get_ident())
+                release.wait()
+                return self.traj_out.write(data)
+
+            def __getattr__(self, name):
+                return getattr(self.traj_out, name)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, trajectory.TRAJECTORY_FILE)
+            writer = trajectory.TrajectoryWriter(path, chunk_size=1, queue_size=2)
+            writer.traj_out = StalledFile(writer.traj_out)
+            # the thread takes the first chunk and stalls on the disk, two more chunks fit into the queue
+            for _ in range(3):
+                writer.append(sim)
+            self.assertTrue(writer.queue.full())
+            appending = threading.Thread(target=writer.append, args=(sim, ))
+            appending.start()
+            appending.join(0.2)
+            self.assertTrue(appending.is_alive())
+
+            release.set()
+            appending.join()
+            writer.close()
+            self.assertEqual(writing_threads, {writer.thread.ident})
+            self.assertEqual(len(trajectory.read_trajectory(path)['step']), 4)
+
+        # an error of the writing thread is raised in the simulation
+        with tempfile.TemporaryDirectory() as directory:
+            writer = trajectory.TrajectoryWriter(os.path.join(directory, trajectory.TRAJECTORY_FILE), chunk_size=1)
+            traj_out = writer.traj_out
+            writer.traj_out = mock.Mock(closed=False, write=mock.Mock(side_effect=OSError('disk full')))
+            writer.append(sim)
+            with self.assertRaises(OSError):
+                writer.close()
+            traj_out.close()
+
+    # tests if g(r) of an ideal gas is 1 and the blocks are averaged correctly
+    def test_rdf(self):
+        rng = np.random.default_rng(4)
+        rdf = RDFAccumulator(4, 200, 10**3, n_bins=8, block_size=5)
+        frames = []
+        for _ in range(23):
+            config = Configuration(rng.random((200, 3)) * 10)
+            config.init_nn(4, np.eye(3) * 10, dense=False)
+            indptr, neighbours, r, _ = config.nnpairs
+            frames.append(r[pair_rows(indptr) < neighbours])
+            rdf.accumulate(frames[-1])
+
+        self.assertEqual(len(rdf.blocks), 4)
+        self.assertTrue(np.allclose(rdf.g()[2:], 1, atol=0.1))
+        self.assertTrue(np.all(rdf.error()[2:] > 0))
+        counts = np.histogram(np.concatenate(frames), np.linspace(0, 4, 9))[0]
+        self.assertTrue(np.allclose(rdf.g(), rdf.normalize(counts, 23)))
+        self.assertTrue(np.allclose(np.mean(rdf.blocks, axis=0), rdf.normalize(counts - rdf.block_counts, 20)))
+
+        # two ions have a single pair: one count in the first shell is V / shell volume
+        pair = RDFAccumulator(1, 2, 8.0, n_bins=1)
+        pair.accumulate(np.array([0.5]))
+        self.assertTrue(np.allclose(pair.g(), 8.0 / (4/3 * np.pi)))
+
+    # tests if the observables extracted from vv.out and the binary trajectory agree with the simulation
+    def test_extract_info(self):
+        predictor = make_predictor()
+        sim = md.MDSimulation(predictor, 4, *md.random_state(300, 32, 10, rng=np.random.default_rng(5)), dt=1)
+        vv_file = StringIO()
+        positions = []
+        temperatures = []
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, trajectory.TRAJECTORY_FILE)
+            with trajectory.TrajectoryWriter(path, chunk_size=4) as writer:
+                for i in range(9):
+                    writer.append(sim)
+                    md.veloverlet_write(sim, i, vv_file)
+                    positions.append(np.array(sim.positions))
+                    temperatures.append(sim.temperature())
+                    sim.run(5)
+            with open(os.path.join(directory, 'vv.out'), 'w') as vv_out:
+                vv_out.write(vv_file.getvalue())
+
+            fields = ['frame', 'temperature', 'com_drift', 'positions']
+            (names, binary) = extract_info.extract(extract_info.iter_binary_chunks(path), fields, [2, 7], 'xz', 10)
+            (_, text) = extract_info.extract(
+                extract_info.iter_text_chunks(os.path.join(directory, 'vv.out'), chunk_size=2), fields, [2, 7], 'xz', 10
+            )
+            extract_info.main([directory, '--fields', *fields, '--ions', '2', '7', '--components', 'xz', '--lattice', '10'])
+            csv = np.loadtxt(os.path.join(directory, 'vv_extracted.csv'), delimiter=';', skiprows=1)
+
+        positions = np.array(positions)
+        self.assertEqual(names[:6], ['frame', 'temperature', 'com_drift_x', 'com_drift_y', 'com_drift_z', 'positions_2_x'])
+        self.assertEqual(np.shape(binary), (9, 9))
+        self.assertTrue(np.array_equal(binary[:, 0], np.arange(9)))
+        self.assertTrue(np.allclose(binary[:, 1], temperatures))
+        self.assertTrue(np.array_equal(binary[:, 5:], positions[:, [1, 6]][:, :, [0, 2]].reshape(9, 4)))
+        # the ions move less than 10 A, so the unwrapped drift of the center of mass is (nearly) zero
+        self.assertTrue(np.allclose(binary[:, 2:5], 0, atol=1e-3))
+        self.assertTrue(np.allclose(text, binary, rtol=1e-6, atol=1e-6))
+        self.assertTrue(np.allclose(csv, binary, rtol=1e-6, atol=1e-6))
+
+        # vv.out is read in chunks of chunk_size frames
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'vv.out'), 'w') as vv_out:
+                vv_out.write(vv_file.getvalue())
+            chunks = extract_info.iter_text_chunks(os.path.join(directory, 'vv.out'), chunk_size=2)
+            self.assertEqual([len(chunk['frame']) for chunk in chunks], [2, 2, 2, 2, 1])
+
+        # the extraction is one pass over the chunks, an ion crossing the boundary between two chunks is unwrapped
+        # the same way as within one chunk
+        rng = np.random.default_rng(6)
+        steps = np.cumsum(rng.normal(scale=0.5, size=(6, 3, 3)), axis=0)
+        frames = {
+            'frame': np.arange(6), 'temperature': rng.random(6), 'kinetic_energy': rng.random(6),
+            'potential_energy': rng.random(6), 'positions': np.mod(9.5 + steps, 10), 'velocities': rng.random((6, 3, 3)),
+            'forces': rng.random((6, 3, 3))
+        }
+        split = iter([{field: values[:3] for field, values in frames.items()}, {field: values[3:] for field, values in frames.items()}])
+        (names, columns) = extract_info.extract(split, list(extract_info.FIELDS), [1, 3], 'xyz', 10)
+        self.assertEqual(next(split, None), None)
+        (_, whole) = extract_info.extract([frames], list(extract_info.FIELDS), [1, 3], 'xyz', 10)
+        self.assertTrue(np.allclose(columns, whole, rtol=1e-12, atol=1e-12))
+        drift = columns[:, names.index('com_drift_x'):names.index('com_drift_z') + 1]
+        self.assertTrue(np.allclose(drift, np.mean(steps - steps[0], axis=1), rtol=1e-12, atol=1e-12))
+        total = columns[:, names.index('total_energy')]
+        self.assertTrue(np.allclose(total, frames['kinetic_energy'] + frames['potential_energy']))
@@ -0,0 +1,163 @@
+import os
+from queue import Queue
+from sys import argv
+from threading import Thread
+import numpy as np
+
+# Binary trajectory of an MD run: the file starts with the header array [VERSION, n_ion, dim], followed by chunks
+# of frames. Every chunk is the sequence of .npy arrays in CHUNK_FIELDS, the first axis of each is the frame
+# (the NN distances of all frames of a chunk are concatenated, nn_counts holds their number per frame).
+TRAJECTORY_FILE = 'trajectory.bin'
+VERSION = 1
+CHUNK_FIELDS = ('step', 'energy', 'kinetic_energy', 'temperature', 'positions', 'velocities', 'forces', 'nn_counts', 'nn_distances')
+
+
+# Writes the frames of an MD run into a binary trajectory file. The frames are collected in chunks of chunk_size
+# frames, full chunks are written by a background thread. The queue of chunks is bounded by queue_size, so the
+# simulation only waits, if the disk is slower than the simulation for a longer time.
+class TrajectoryWriter(object):
+    def __init__(self, path: str, chunk_size=100, queue_size=4):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.frames = []
+        self.queue = Queue(queue_size)
+        self.error = None
+        self.traj_out = open(path, 'wb')
+        self.header_written = False
+        self.thread = Thread(target=self.__write_chunks, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # appends the current step of the simulation (anything with positions, velocities, forces, energy, steps,
+    # temperature(), kinetic_energy() and nn_distances()). With nn=False no NN distances are stored for this frame.
+    def append(self, sim, nn=True):
+        if self.error is not None:
+            raise self.error
+        self.frames.append((
+            sim.steps, sim.energy, sim.kinetic_energy(), sim.temperature(), np.array(sim.positions),
+            np.array(sim.velocities), np.array(sim.forces), sim.nn_distances() if nn else np.zeros(0)
+        ))
+        if len(self.frames) >= self.chunk_size:
+            self.flush()
+
+    # hands the collected frames to the writing thread
+    def flush(self):
+        if not self.frames:
+            return
+        (steps, energies, E_kin, T, positions, velocities, forces, distances) = zip(*self.frames)
+        chunk = (
+            np.array(steps), np.array(energies, dtype=float), np.array(E_kin), np.array(T), np.array(positions),
+            np.array(velocities), np.array(forces), np.array([len(r) for r in distances]), np.concatenate(distances)
+        )
+        self.frames = []
+        self.queue.put(chunk)
+
+    # writes the remaining frames and waits until the thread has written everything
+    def close(self):
+        if self.traj_out.closed:
+            return
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.traj_out.close()
+        if self.error is not None:
+            raise self.error
+
+    def __write_chunks(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                if not self.header_written:
+                    _, n_ion, dim = np.shape(chunk[4])
+                    np.save(self.traj_out, np.array([VERSION, n_ion, dim]))
+                    self.header_written = True
+                for values in chunk:
+                    np.save(self.traj_out, values)
+            except Exception as error:
+                self.error = error
+
+
+# Yields the chunks of a binary trajectory file one at a time as dicts field -> array
+def iter_chunks(path: str):
+    size = os.stat(path).st_size
+    with open(path, 'rb') as traj_in:
+        if size == 0:
+            return
+        version, _, _ = np.load(traj_in)
+        if version != VERSION:
+            raise ValueError(f'trajectory version {version} is not supported (expected {VERSION})')
+        while traj_in.tell() < size:
+            yield {field: np.load(traj_in) for field in CHUNK_FIELDS}
+
+
+# Reads the whole binary trajectory file into one dict field -> array, the nn_distances of all frames are concatenated
+def read_trajectory(path: str) -> dict:
+    chunks = list(iter_chunks(path))
+    if not chunks:
+        return {}
+    return {field: np.concatenate([chunk[field] for chunk in chunks]) for field in CHUNK_FIELDS}
+
+
+# the text of one block of the legacy vv.out file
+def vv_block(i, temperature, E_kin, E_pot, positions, velocities, forces) -> str:
+    n, dim = np.shape(positions)
+    mean_vel = np.sqrt(np.mean(velocities**2)*dim)
+    return (
+        "***** Iteration block (" + str(i) + ") ***** \r\n" + "\r\n"
+
+        + "temperature (K): " + "\r\n" + "     " + str(temperature) + "\r\n"
+        + "kinetic energy (eV): " + "\r\n" + "     " + str(E_kin) + "\r\n"
+        + "potential energy (eV): " + "\r\n" + "     " + str(E_pot) + "\r\n"
+        + "total energy (eV): " + "\r\n" + "     " + str(E_kin + E_pot) + "\r\n" + "\r\n"
+
+        + "--------------- POSITIONS --------------- \r\n"
+        + str(positions) + "\r\n" + "\r\n"
+        + "center of mass: " + "\r\n"
+        + "".join("     " + str(np.mean(positions[:,d])) for d in range(dim))
+        + "\r\n" + "\r\n"
+
+        + "--------------- VELOCITIES --------------- \r\n"
+        + str(velocities) + "\r\n" + "\r\n"
+        + "mean speed: " + "\r\n" + "     " + str(mean_vel) + "\r\n"
+        + "mean squared velocity: " + "\r\n" + "     " + str(mean_vel**2) + "\r\n" + "\r\n"
+
+        + "--------------- FORCES --------------- \r\n"
+        + str(forces) + "\r\n" + "\r\n"
+        + "mean force: " + "\r\n" + "     " + str(np.sqrt(np.mean(forces**2)*dim)) + "\r\n" + "\r\n"
+    )
+
+
+# the text of the NN distances of one block of the legacy nn.out file
+def nn_block(distances) -> str:
+    return ''.join(str(r) + "\r\n" for r in distances)
+
+
+# Converts a binary trajectory file into the legacy text files vv.out and nn.out. The i-th frame becomes the
+# iteration block i.
+def to_legacy(path: str, vv_path: str, nn_path: str) -> None:
+    with open(vv_path, 'w') as vv_file, open(nn_path, 'w') as nn_file:
+        i = 0
+        for chunk in iter_chunks(path):
+            offsets = np.cumsum(np.append(0, chunk['nn_counts']))
+            for k in range(len(chunk['step'])):
+                vv_file.write(vv_block(
+                    i, chunk['temperature'][k], chunk['kinetic_energy'][k], chunk['energy'][k],
+                    chunk['positions'][k], chunk['velocities'][k], chunk['forces'][k]
+                ))
+                nn_file.write(nn_block(chunk['nn_distances'][offsets[k]:offsets[k+1]]))
+                i += 1
+
+
+if __name__ == '__main__':
+    # converts the trajectory of every given directory into vv.out and nn.out
+    for directory in argv[1:]:
+        to_legacy(os.path.join(directory, TRAJECTORY_FILE), os.path.join(directory, 'vv.out'), os.path.join(directory, 'nn.out'))
@@ -0,0 +1,86 @@
+import argparse
+import json
+from time import time
+import numpy as np
+import calibration
+from model_file import load_calibration, save_calibration
+
+# Online update of a calibration with new configurations, e.g. a few new DFT frames per iteration of an active
+# learning loop. The calibration has to be saved with the key 'updatable' in the json-file, then its model file
+# holds the sums of the normal equations (see calibration.accumulators). The reference points C stay the same, so
+# the new configurations only add rows U to K and T: X and y grow by U^T U and U^T [E; F] and the Cholesky factor of
+# X + lamb I by a rank-r update (see calibration.cholesky_update), instead of building and factorizing everything
+# again. Only the new configurations are read and initialized.
+# The rank-r update of the Cholesky factor costs O(N^2 r) in N vector operations, a new factorization O(N^3 / 3)
+# in blocked matrix operations. The update is only used for r < N / CHOLESKY_UPDATE_RATIO, where it was faster
+# (measured for N = 2000 and 4000).
+CHOLESKY_UPDATE_RATIO = 100
+
+
+def update_calibration(directory: str, u_conf: dict, configurations: list, C: np.array, q: np.array) -> dict:
+    '''
+    Adds the configurations (initialized, with the descriptors C) to the updatable calibration in the directory,
+    replaces its model file (atomically, see model_file.save_model) and returns the updated sums of the normal equations.
+    '''
+    model = load_calibration(directory, mmap=False, u_conf=u_conf)
+    if not model.get('updatable', False):
+        raise ValueError(f'the calibration in {directory} was not saved with the key updatable')
+    if not np.allclose(model['q'], q) or list(model['kernel']) != list(u_conf['kernel']):
+        raise ValueError('the kernel and the q-vector have to be the same as in the calibration')
+
+    # the rows of the new configurations in K and T, with the reference points of the calibration as columns
+    C_ref = model['C']
+    (E, F, K, T) = calibration.build_linear(u_conf, configurations, C, q, C_ref)
+    U = np.append(K, T, axis=0)
+
+    t_0 = time()
+    print('Updating the normal equations ...', end='\r')
+    sums = {
+        'X': model['X'] + U.T @ U,
+        'y': model['y'] + U.T @ np.append(E, F),
+        'K_sum': model['K_sum'] + np.sum(K, axis=0),
+        'E_sum': model['E_sum'] + np.sum(E),
+        'n_conf': model['n_conf'] + len(E),
+    }
+    lamb = model['lambda']
+    if 'L' in model and CHOLESKY_UPDATE_RATIO * len(U) < len(C_ref):
+        sums['L'] = calibration.cholesky_update(model['L'], U.T)
+    else:
+        # no factor to update, or so many new rows that a new factorization is cheaper
+        sums = calibration.accumulators(sums['X'], sums['y'], sums['K_sum'], sums['E_sum'], sums['n_conf'], lamb)
+
+    E_ave = sums['E_sum'] / sums['n_conf']
+    y = sums['y'] - E_ave * sums['K_sum']
+    if sums['L'] is not None:
+        w = calibration.cholesky_solve(sums['L'], y)
+    else:
+        w = calibration.solve_normal(sums['X'], y, lamb)
+    print(f'Updating the normal equations: finished after {time()-t_0:.3} s')
+
+    save_calibration(directory, model, C_ref, w, E_ave, q, text=u_conf.get('text_output', True), sums=sums)
+    return sums
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Adds new configurations to an updatable calibration.')
+    parser.add_argument('config', nargs='?', default='user_config.json', help='json-file of the calibration')
+    parser.add_argument('--file-in', required=True, help='outcar-file with the new configurations')
+    parser.add_argument('--stepsize', type=int, default=1)
+    parser.add_argument('--offset', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    with open(args.config, 'r') as u_conf:
+        user_config = json.load(u_conf)
+    user_config.update(file_in=args.file_in, stepsize=args.stepsize)
+    qs = np.arange(1, user_config['nr_modi']+1) * np.pi / user_config['cutoff']
+
+    (user_config['N_conf'], user_config['N_ion'], user_config['lattice_vectors'], configurations) = calibration.load_data(user_config, args.offset)
+    C = np.zeros([user_config['N_conf'], user_config['N_ion'], user_config['nr_modi']])
+    calibration.init_configurations(user_config, configurations, qs, C)
+
+    sums = update_calibration(user_config['file_out'], user_config, configurations, C, qs)
+    print(f'{user_config["file_out"]}: calibration of {sums["n_conf"]} configurations')
+
+
+if __name__ == '__main__':
+    main()
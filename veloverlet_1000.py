@@ -1,232 +1,445 @@
 import json
+import os
+import warnings
 from time import time
+from contextlib import nullcontext
 from re import search, IGNORECASE
-from copy import deepcopy
-from statistics import pvariance
 import numpy as np
-from configuration import Configuration
+from configuration import Configuration, VerletList, pair_rows, stack_neighbour_lists
 import kernel
+from model_file import load_calibration
+from trajectory import TrajectoryWriter, TRAJECTORY_FILE, vv_block, nn_block
+from rdf import RDFAccumulator, RDF_FILE
 
-# load the global parameters used in the machine-learning calibration
+# physical constants and default parameters of the molecular dynamics
 
 m_Si = 28.085 * 1.66 * 10**(-27) # kg
 kB = 1.38 * 10**(-33) # A^2 kg fs^-2 K^-1
 eV = 1.602177 * 10**(-19) # J/eV
 
-a = 10.546640000 # lattice constant in A - MUST BE SMALLER THAN THE LATTICE CONSTANT OF THE CONCAR FILE (when using a VASP simulation for the initial state)
+a = 10.546640000 # default lattice constant in A for random starting conditions
 mass = m_Si # We have Silicon
-mass_ev = mass * 10**(2*15-2*10) / eV # eV fs^2 A^-2
-
-with open('user_config.json', 'r') as user_conf:
-    u_conf = json.load(user_conf)
-
-directory = u_conf['file_out']
-q = np.arange(1, u_conf['nr_modi']+1) * np.pi / u_conf['cutoff']
-C_cal = np.array(np.loadtxt(directory + '/calibration_C.out'), dtype=float)
-w_cal = np.array(np.loadtxt(directory + '/calibration_w.out'), dtype=float)
-E_ave, _ = np.array(np.loadtxt(directory + '/calibration_E.out'), dtype=float)
-kern = kernel.Kernel(*u_conf['kernel'])
-
-# predicts the forces using the available machine-learned calibration
-def predict_forces(config: Configuration):
-    config.init_nn(u_conf['cutoff'], u_conf['lattice_vectors'])
-    config.init_descriptor(q)
-    N_ion, dim = np.shape(config.positions)
-
-    # build the linear system
-    # The first argument is the current configuration, the second one is the reference configuration
-    K = kern.kernel_mat(config.descriptors, C_cal)
-    K = np.sum(K, axis=0)[np.newaxis, :]
-    T = kern.force_submat(q, config, C_cal)
-
-    # solve the linear system
-    ##### ##### Reference: Equation (22) ##### #####
-    EF = np.matmul(np.append(K,T, axis=0),w_cal)
-
-    config.energy = EF[0] + E_ave
-    config.forces = EF[1:].reshape(N_ion, dim)
-
-    return config
-
-
-# Randomly determines the starting conditions (positions, velocities) for the molecular dynamics simulation
-def data_input_rand(T):
+skin = 0.5 # Verlet skin in A - cutoff + skin MUST BE SMALLER THAN HALF THE LATTICE CONSTANT
+
+
+# loads the calibration of the directory given in the user config (or takes the already loaded model) and returns
+# the predictor for energy and forces and the q-vector
+def load_predictor(u_conf: dict, model=None) -> (kernel.Predictor, np.array):
+    q = np.arange(1, u_conf['nr_modi']+1) * np.pi / u_conf['cutoff']
+    # the model file is memory mapped, so parallel MD runs share one copy of C_cal
+    if model is None:
+        model = load_calibration(u_conf['file_out'], u_conf=u_conf)
+    kern = kernel.Kernel(
+        *u_conf['kernel'], force_mode=u_conf.get('force_mode', 'broadcast'), precision=u_conf.get('precision', 'float64')
+    )
+    # the terms, that only depend on the calibration, are computed once for the whole run
+    return (kernel.Predictor(kern, q, model['C'], model['w'], model['E_ave']), q)
+
+
+# Velocity-Verlet molecular dynamics of one configuration in an orthorhombic cell with the machine-learned forces.
+# Positions, velocities and forces are held in preallocated arrays and updated in place; the Configuration self.config
+# shares the positions array and holds the neighbour list and descriptors of the current step.
+class MDSimulation(object):
+    def __init__(self, predictor: kernel.Predictor, cutoff: float, lattice: np.array, positions: np.array,
+                 velocities: np.array, dt=1, mass=mass, thermostat=None, skin=skin):
+        self.predictor = predictor
+        self.cutoff = cutoff
+        self.lattice = np.array(lattice, dtype=float)
+        self.dt = dt # fs
+        self.mass = mass # kg
+        self.mass_ev = mass * 10**(2*15-2*10) / eV # eV fs^2 A^-2
+        # called with the simulation after every step, e.g. VelocityRescaling
+        self.thermostat = thermostat
+        # further callables, that are called with the simulation after every step (after the thermostat),
+        # e.g. UncertaintyMonitor
+        self.hooks = []
+
+        self.positions = np.array(positions, dtype=float) # A
+        self.velocities = np.array(velocities, dtype=float) # A/fs
+        self.forces = np.zeros_like(self.positions) # eV/A
+        self.energy = None # eV
+        self.steps = 0
+
+        # neighbour candidates are only searched again once an ion has moved more than skin/2
+        self.verlet_list = VerletList(cutoff, skin)
+        self.config = Configuration(self.positions)
+        self.update_forces()
+
+    # neighbour list and descriptors of the current positions
+    def init_descriptors(self):
+        self.config.init_nn(self.cutoff, self.lattice, self.verlet_list, dense=False)
+        self.config.init_descriptor(self.predictor.qs)
+
+    # predicts energy and forces of the current positions using the machine-learned calibration
+    def update_forces(self):
+        self.init_descriptors()
+        ##### ##### Reference: Equation (22) ##### #####
+        (self.energy, self.forces[:]) = self.predictor.predict(self.config)
+
+    # half a time step of the velocities with the current forces
+    ##### ##### Reference: Equation (28) ##### #####
+    def kick(self):
+        self.velocities += self.forces * (self.dt / (2 * self.mass_ev))
+
+    # a full time step of the positions with the (half-kicked) velocities, with periodic boundary conditions
+    ##### ##### Reference: Equation (27) ##### #####
+    def drift(self):
+        self.positions += self.velocities * self.dt
+        np.mod(self.positions, self.lattice.diagonal(), out=self.positions)
+
+    # one Velocity-Verlet step: x1 = x0 + v0 dt + F0/(2m) dt^2, v1 = v0 + (F0 + F1)/(2m) dt
+    def step(self):
+        self.kick()
+        self.drift()
+        self.update_forces()
+        self.finish_step()
+
+    # the second half kick with the new forces and the thermostat
+    def finish_step(self):
+        self.kick()
+        self.steps += 1
+        if self.thermostat is not None:
+            self.thermostat(self)
+        for hook in self.hooks:
+            hook(self)
+
+    def run(self, steps: int):
+        for _ in range(steps):
+            self.step()
+
+    def temperature(self) -> float:
+        n, _ = np.shape(self.positions)
+        return (self.mass * np.sum(self.velocities**2)) / (3 * kB * (n-1))
+
+    def kinetic_energy(self) -> float:
+        return 1/2 * self.mass_ev * np.sum(self.velocities**2)
+
+    # the NN distances < Rcut of the current step, each pair only once
+    def nn_distances(self) -> np.array:
+        indptr, neighbours, r, _ = self.config.nnpairs
+        return r[pair_rows(indptr) < neighbours]
+
+
+# Several independent simulations (replicas), e.g. at different temperatures, that are advanced in lockstep.
+# All replicas use the same predictor; in every step the descriptors of all replicas are stacked, so that one
+# kernel evaluation against the calibration serves all of them instead of one small one per replica.
+class Ensemble(object):
+    def __init__(self, simulations: list):
+        self.simulations = simulations
+        self.predictor = simulations[0].predictor
+        if any(sim.predictor is not self.predictor for sim in simulations):
+            raise ValueError('all replicas of an ensemble have to use the same predictor')
+        # the first atom of every replica in the stacked arrays
+        self.offsets = np.cumsum([0] + [len(sim.positions) for sim in simulations])
+
+    # R replicas with random starting conditions for the given temperatures
+    @classmethod
+    def from_temperatures(cls, predictor: kernel.Predictor, cutoff: float, temperatures: list, n_ion=64, a_lat=a,
+                          dt=1, mass=mass, rng=np.random):
+        return cls([
+            MDSimulation(predictor, cutoff, *random_state(T, n_ion, a_lat, mass, rng), dt=dt, mass=mass)
+            for T in temperatures
+        ])
+
+    # predicts energies and forces of all replicas with one evaluation of the predictor
+    def update_forces(self):
+        for sim in self.simulations:
+            sim.init_descriptors()
+        descriptors = np.concatenate([sim.config.descriptors for sim in self.simulations])
+        nnpairs = stack_neighbour_lists([sim.config.nnpairs for sim in self.simulations])
+        ##### ##### Reference: Equation (22) ##### #####
+        (E_atoms, forces) = self.predictor.energy_forces(descriptors, nnpairs)
+        energies = np.add.reduceat(E_atoms, self.offsets[:-1]) + self.predictor.E_ave
+        for (k, sim) in enumerate(self.simulations):
+            sim.energy = energies[k]
+            sim.forces[:] = forces[self.offsets[k]:self.offsets[k+1]]
+
+    def step(self):
+        for sim in self.simulations:
+            sim.kick()
+            sim.drift()
+        self.update_forces()
+        for sim in self.simulations:
+            sim.finish_step()
+
+    def run(self, steps: int):
+        for _ in range(steps):
+            self.step()
+
+    # equilibrates every replica to its temperature by rescaling the velocities every 10 steps
+    def equilibrate(self, temperatures: list, steps=1000, doprint=False):
+        run_rescaled(self, self.simulations, temperatures, steps, doprint)
+
+
+# Thermostat, that rescales the velocities to the temperature T every interval steps
+class VelocityRescaling(object):
+    def __init__(self, T, interval=10):
+        self.T = T # K
+        self.interval = interval
+
+    def __call__(self, sim: MDSimulation):
+        if sim.steps % self.interval:
+            return
+        n, _ = np.shape(sim.velocities)
+        ##### ##### Reference: Equation (35) ##### #####
+        sig_theo = np.sqrt((n-1)/n * kB/sim.mass * self.T) # theoretical variance
+        sig_real = np.sqrt(np.mean(sim.velocities**2)) # sample variance with known mean 0
+        sim.velocities *= sig_theo/sig_real # Normal distribution scales as: sig*N(0,x) = N(0,sig*x)
+
+
+# Flags the steps of an MD run, in which the predictive variance (see kernel.Uncertainty) of an atom is above the
+# threshold, checked every interval steps. The flagged steps are kept in flagged as (step, variance, atom); with a
+# directory their frames are also written as CONTCAR files, e.g. as start of new DFT calculations.
+class UncertaintyMonitor(object):
+    def __init__(self, uncertainty: kernel.Uncertainty, threshold: float, interval=10, directory=None):
+        self.uncertainty = uncertainty
+        self.threshold = threshold
+        self.interval = interval
+        self.directory = directory
+        self.flagged = []
+
+    def __call__(self, sim: MDSimulation):
+        if sim.steps % self.interval:
+            return
+        variance = self.uncertainty.variance(sim.config.descriptors)
+        atom = np.argmax(variance)
+        if variance[atom] <= self.threshold:
+            return
+        self.flagged.append((sim.steps, variance[atom], atom))
+        if self.directory is not None:
+            write_contcar(
+                f'{self.directory}/CONTCAR_{sim.steps:07d}', sim,
+                f'step {sim.steps}: variance {variance[atom]:.5g} of atom {atom}'
+            )
+
+
+# Randomly determines the starting conditions (positions, velocities) of n_ion ions in a cubic cell with lattice
+# constant a_lat for the temperature T. Returns (lattice, positions, velocities).
+def random_state(T, n_ion=64, a_lat=a, mass=mass, rng=np.random) -> (np.array, np.array, np.array):
     # [T] = K
 
     # random positions, uniform distribution within lattice
-    u_conf['lattice_vectors'] = np.eye(3) * a
-    positions = np.random.rand(64,3) * a
+    lattice = np.eye(3) * a_lat
+    positions = rng.random((n_ion, 3)) * a_lat
 
     # random velocities, gaussian distribution at temperature T (= boltzmann distribution for speed)
     ##### ##### Reference: Equation (35) ##### #####
-    sigma_xyz = np.sqrt(63/64 * kB/mass * T) # A/fs
-    velocities = np.random.normal(0, sigma_xyz, (64,3))
-    for i in range(0,3):
-        velocities[:,i] = velocities[:,i] - np.mean(velocities[:,i])
-
-    #print("E_kin should:", 3/2 * kB * T * 63)
-    #print("E_kin is:", 1/2 * mass * np.sum(velocities**2))
+    sigma_xyz = np.sqrt((n_ion-1)/n_ion * kB/mass * T) # A/fs
+    velocities = rng.normal(0, sigma_xyz, (n_ion, 3))
+    velocities -= np.mean(velocities, axis=0)
 
-    # create the configuration object from the data
-    config_0 = Configuration(positions, None, None, None, None, None, velocities)
-    config_0 = predict_forces(config_0)
+    return (lattice, positions, velocities)
 
-    return config_0
 
+# Reads the starting conditions (positions, velocities) for the molecular dynamics simulation from a CONTCAR file.
+# Returns (lattice, positions, velocities).
+def read_contcar(filename='CONTCAR') -> (np.array, np.array, np.array):
 
-# Reads the starting conditions (positions, velocities) for the molecular dynamics simulation from a CONTCAR file
-def data_input_contcar():
-
-    filename = "CONTCAR"
     if not search(r'contcar', filename, IGNORECASE):
-        raise ValueError(f'no contcar file')
+        raise ValueError('no contcar file')
 
     with open(filename, 'r') as contcar_in:
         contcar_content = contcar_in.readlines()
 
-    a = float(contcar_content[1]) # overwrite default lattice constant
-    u_conf['lattice_vectors'] = np.eye(3) * a
+    a_lat = float(contcar_content[1])
+    lattice = np.eye(3) * a_lat
 
     dim = len(contcar_content[2].split()) # dimensions in space (usu. 3)
     Ni = int(contcar_content[3+dim]) # number of ions
 
     positions = contcar_content[5+dim : 5+dim+Ni]
     velocities = contcar_content[6+dim+Ni : 6+dim+2*Ni]
-    for i in range(len(positions)):
-        positions[i] = positions[i].split()
-        velocities[i] = velocities[i].split()
-    positions = np.array(positions, dtype=float) * a
-    velocities = np.array(velocities, dtype=float) # === Muss velocities eventuell auch mit a multipliziert werden? Denke nicht weil Größenordnung passt
-
-    config_0 = Configuration(positions, None, None, None, None, None, velocities)
-    config_0 = predict_forces(config_0)
-
-    return config_0
-
-
-# equilibrates the system for given temperature T
-def equilibrate(config, T, dt=0.01, doprint=False):
-
-    # number Velocity-Verlet steps to equilibrate (only in tenths)
+    positions = np.array([line.split() for line in positions], dtype=float) * a_lat
+    velocities = np.array([line.split() for line in velocities], dtype=float) # === Muss velocities eventuell auch mit a multipliziert werden? Denke nicht weil Größenordnung passt
+
+    return (lattice, positions, velocities)
+
+
+# Writes positions and velocities of the simulation in the format of read_contcar (direct coordinates in a cubic cell)
+def write_contcar(filename: str, sim: MDSimulation, comment='') -> None:
+    a_lat = sim.lattice[0, 0]
+    n, dim = np.shape(sim.positions)
+    with open(filename, 'w') as contcar_out:
+        contcar_out.write(comment + '\n' + f'   {a_lat:.16f}\n')
+        for row in np.eye(dim):
+            contcar_out.write(''.join(f'{x:22.16f}' for x in row) + '\n')
+        contcar_out.write('   Si\n' + f'{n:6d}\n' + 'Direct\n')
+        for pos in sim.positions / a_lat:
+            contcar_out.write(''.join(f'{x:20.16f}' for x in pos) + '\n')
+        contcar_out.write('\n')
+        for vel in sim.velocities:
+            contcar_out.write(''.join(f'{x:20.16f}' for x in vel) + '\n')
+
+
+# equilibrates the system for given temperature T by rescaling the velocities every 10 steps. dt and doprint keep
+# the positions of the former equilibrate(config, T, dt, doprint), dt=None keeps the time step of the simulation.
+def equilibrate(sim: MDSimulation, T, dt=None, doprint=False, steps=1000) -> MDSimulation:
+
+    if dt is not None:
+        sim.dt = dt
+    run_rescaled(sim, [sim], [T], steps, doprint)
+    return sim
+
+
+# runs an MDSimulation or Ensemble (runner) with the velocities of its simulations rescaled to the temperatures every
+# 10 steps, the thermostats of the simulations are restored afterwards
+def run_rescaled(runner, simulations: list, temperatures: list, steps: int, doprint=False):
+    thermostats = [sim.thermostat for sim in simulations]
+    for (sim, T) in zip(simulations, temperatures):
+        sim.thermostat = VelocityRescaling(T, 10)
+    try:
+        run_blocks(runner, steps, doprint=doprint, label='Equilibration')
+    finally:
+        for (sim, thermostat) in zip(simulations, thermostats):
+            sim.thermostat = thermostat
+
+
+# append the NN distances < Rcut of the current step to an already open (!) file
+def nn_write(sim: MDSimulation, nn_file):
+    # each distance will be written only once. this is ok, if scaling is done that way too
+    nn_file.write(nn_block(sim.nn_distances()))
+
+
+# Write the simulation's parameter to an already open (!) file
+def veloverlet_write(sim: MDSimulation, i, vv_file):
+    vv_file.write(vv_block(
+        i, sim.temperature(), sim.kinetic_energy(), sim.energy, sim.positions, sim.velocities, sim.forces
+    ))
+
+
+# do #steps timesteps of an MDSimulation or Ensemble in blocks of 10 to minimize correlations and call output(i)
+# after the i-th block
+def run_blocks(sim, steps: int, output=None, doprint=False, label='Molecular dynamics'):
     t_0 = time()
-
-    steps = 1000
     for i in range(steps//10):
         if doprint:
-            print(f'Equilibration in progress: {(i*1000)//steps} %', end='\r')
-
-        config = veloverlet_10(dt, config)
-        
-        ##### ##### Reference: Equation (35) ##### #####
-        sig_theo = np.sqrt(63/64 * kB/mass * T) # theoretical variance
-        sig_real = np.sqrt(pvariance(config.velocities.flatten(), 0)) # sample variance with known mean 0
-        factor = sig_theo/sig_real # Normal distribution scales as: sig*N(0,x) = N(0,sig*x)
-        config.velocities = config.velocities.reshape(np.shape(config.positions)) * factor
+            print(f'{label} in progress: {(i*1000)//steps} %', end='\r')
+        sim.run(10)
+        if output is not None:
+            output(i+1)
 
     if doprint:
-        print(f'Equilibration: finished after {time()-t_0:.3} s')
-
-    return config
+        print(f'{label}: finished after {time()-t_0:.3} s')
 
 
-# perform 10 velocity-verlet time steps, then write the NN-distances into an already open (!) file
-def veloverlet_10(dt, config0, nn_file=None):
+# ----- former module-level interface -----
+# The functions below keep the interface of the module before MDSimulation for existing scripts. They load the
+# calibration of user_config.json on first use (not at import) and return an MDSimulation, which has the attributes
+# positions, velocities, forces and energy of the former Configuration. New code should use MDSimulation directly.
+_legacy_predictor = None
 
-    # perform 10 steps at once to minimize correlations (now for testing purposes only 1 step)
-    for i in range(10):
-        # Velocity-Verlet algorithm: positions
-        ##### ##### Reference: Equation (27) ##### #####
-        pos1 = config0.positions + config0.velocities * dt + config0.forces/(2*mass_ev) * dt**2
-        pos1 = (pos1 % a + a) % a # periodic boundary conditions 
-        # print(pos1)
-        config1 = Configuration(pos1)
-        # Machine learned: forces
-        config1 = predict_forces(config1)
-        # Velocity-Verlet algorithm: velocities
-        ##### ##### Reference: Equation (28) ##### #####
-        config1.velocities = config0.velocities + (config0.forces + config1.forces)/(2*mass_ev) * dt
 
-        #print(id(config0), id(config1))
-        config0 = deepcopy(config1)
-        #print(id(config0.forces), id(config1.forces))
-        #print(config0.forces)
+def _legacy(name: str, replacement: str) -> (kernel.Predictor, dict):
+    global _legacy_predictor
+    warnings.warn(f'{name} is deprecated, use {replacement}', DeprecationWarning, stacklevel=3)
+    if _legacy_predictor is None:
+        with open('user_config.json', 'r') as user_conf:
+            u_conf = json.load(user_conf)
+        _legacy_predictor = (load_predictor(u_conf)[0], u_conf)
+    return _legacy_predictor
 
-    if not(nn_file is None):
-        # append NN distances < Rcut to nn_dist output-file
-        for i in range(np.shape(config0.nndistances)[0]):
-            for j in range(i+1, np.shape(config0.nndistances)[1]): # each distance will be written only once. this is ok, if scaling is done that way too
-                if config0.nndistances[i,j] != 0:
-                    nn_file.write(str(config0.nndistances[i,j]) + "\r\n")
 
-    return config0
-
-
-# Write the configuration's parameter to an already open (!) file
-def veloverlet_write(config, i, vv_file):
+# predicts energy and forces of the configuration in the cell lattice (default: cubic with the lattice constant a)
+def predict_forces(config: Configuration, lattice=None) -> Configuration:
+    (predictor, u_conf) = _legacy('predict_forces', 'kernel.Predictor.predict')
+    config.init_nn(u_conf['cutoff'], np.eye(3) * a if lattice is None else lattice)
+    config.init_descriptor(predictor.qs)
+    (config.energy, config.forces) = predictor.predict(config)
+    return config
 
-    n, dim = np.shape(config.positions)
-    T = (mass * np.sum(config.velocities**2)) / (3 * kB * (n-1))
-    E_kin = 1/2 * mass_ev * np.sum(config.velocities**2)
-    E_pot = config.energy
-    mean_vel = np.sqrt(np.mean(config.velocities**2)*dim)
 
-    vv_file.write("***** Iteration block (" + str(i) + ") ***** \r\n" + "\r\n")
+# random starting conditions for the temperature T, see random_state
+def data_input_rand(T) -> MDSimulation:
+    (predictor, u_conf) = _legacy('data_input_rand', 'MDSimulation(predictor, cutoff, *random_state(T))')
+    return MDSimulation(predictor, u_conf['cutoff'], *random_state(T))
 
-    vv_file.write("temperature (K): " + "\r\n" + "     " + str(T) + "\r\n")
-    vv_file.write("kinetic energy (eV): " + "\r\n" + "     " + str(E_kin) + "\r\n")
-    vv_file.write("potential energy (eV): " + "\r\n" + "     " + str(E_pot) + "\r\n")
-    vv_file.write("total energy (eV): " + "\r\n" + "     " + str(E_kin + E_pot) + "\r\n" + "\r\n")
 
-    vv_file.write("--------------- POSITIONS --------------- \r\n")
-    vv_file.write(str(config.positions) + "\r\n" + "\r\n")
-    vv_file.write("center of mass: " + "\r\n")
-    for d in range(dim):
-        vv_file.write("     " + str(np.mean(config.positions[:,d])))
-    vv_file.write("\r\n" + "\r\n")
+# starting conditions of the file CONTCAR, see read_contcar
+def data_input_contcar() -> MDSimulation:
+    (predictor, u_conf) = _legacy('data_input_contcar', "MDSimulation(predictor, cutoff, *read_contcar('CONTCAR'))")
+    return MDSimulation(predictor, u_conf['cutoff'], *read_contcar('CONTCAR'))
 
-    vv_file.write("--------------- VELOCITIES --------------- \r\n")
-    vv_file.write(str(config.velocities) + "\r\n" + "\r\n")
-    vv_file.write("mean speed: " + "\r\n" + "     " + str(mean_vel) + "\r\n")
-    vv_file.write("mean squared velocity: " + "\r\n" + "     " + str(mean_vel**2) + "\r\n" + "\r\n")
 
-    vv_file.write("--------------- FORCES --------------- \r\n")
-    vv_file.write(str(config.forces) + "\r\n" + "\r\n")
-    vv_file.write("mean force: " + "\r\n" + "     " + str(np.sqrt(np.mean(config.forces**2)*dim)) + "\r\n" + "\r\n")
+# 10 Velocity-Verlet steps of the simulation, then the NN distances are written into an already open (!) file
+def veloverlet_10(dt, sim: MDSimulation, nn_file=None) -> MDSimulation:
+    warnings.warn('veloverlet_10 is deprecated, use MDSimulation.run(10) and nn_write', DeprecationWarning, stacklevel=2)
+    sim.dt = dt
+    sim.run(10)
+    if nn_file is not None:
+        nn_write(sim, nn_file)
+    return sim
 
-    return
 
+def main(dt=1, steps=1000, doprint=False, config_path='user_config.json'):
 
-def main(dt=1, steps=1000, doprint=False):
+    # load the global parameters used in the machine-learning calibration
+    with open(config_path, 'r') as user_conf:
+        u_conf = json.load(user_conf)
+    directory = u_conf['file_out']
+    # the model file is loaded (and checked against the json-file) once for the predictor and the uncertainty
+    model = load_calibration(directory, u_conf=u_conf)
+    (predictor, _) = load_predictor(u_conf, model)
 
     # initialize the starting configuration
 
     ##### For random configuration: #####
     #T = 1720 # targeted temperature for random velocities and equilibration in Kelvin, same T as in CONTCAR
-    #config_0 = data_input_rand(T)
-    #config_0 = equilibrate(config_0, T, dt, doprint)
+    #sim = MDSimulation(predictor, u_conf['cutoff'], *random_state(T), dt=dt)
+    #sim = equilibrate(sim, T, doprint=doprint)
 
     ##### Read in configuration: #####
-    config_0 = data_input_contcar()
-
-    # create (or overwrite if it exists) the nn_dist.out and vv.out file
-    nn_file = open(directory + '/nn.out', 'w')
-    vv_file = open(directory + '/vv.out', 'w')
-    veloverlet_write(config_0, 0, vv_file)
-
-    # do #steps timesteps of size dt, print results if wished
-    t_0 = time()
-    for i in range(steps//10):
-        if doprint:
-            print(f'Molecular dynamics in progress: {(i*1000)//steps} %', end='\r')
-        config_0 = veloverlet_10(dt, config_0, nn_file)
-        veloverlet_write(config_0, i+1, vv_file)
-
-    if doprint:
-        print(f'Molecular dynamics: finished after {time()-t_0:.3} s')
-
-    # close the nn_dist.out file as the simulation is finished
-    nn_file.close()
-    vv_file.close()
+    sim = MDSimulation(predictor, u_conf['cutoff'], *read_contcar('CONTCAR'), dt=dt)
+
+    # with 'rdf': true g(r) is accumulated during the run and written into rdf.out instead of the NN distances
+    rdf = None
+    if u_conf.get('rdf', False):
+        rdf = RDFAccumulator(
+            u_conf['cutoff'], len(sim.positions), np.linalg.det(sim.lattice), u_conf.get('rdf_bins', 90), u_conf.get('rdf_block', 100)
+        )
+
+    # with 'uncertainty' the frames, in which the predictive variance of an atom exceeds the threshold, are written
+    # as CONTCAR files into the folder uncertain, the list of them into uncertain.out
+    monitor = None
+    if 'uncertainty' in u_conf:
+        options = u_conf['uncertainty']
+        if not model.get('updatable', False):
+            raise ValueError(f'the key uncertainty needs the normal matrix X, calibrate {directory} with the key updatable')
+        uncertainty = kernel.Uncertainty.from_model(predictor.kernel, predictor.qs, model, options.get('rank', 256))
+        os.makedirs(directory + '/uncertain', exist_ok=True)
+        monitor = UncertaintyMonitor(uncertainty, options['threshold'], options.get('interval', 10), directory + '/uncertain')
+        sim.hooks.append(monitor)
+
+    # with 'trajectory': 'binary' the frames are written into a binary trajectory file by a background thread,
+    # trajectory.to_legacy converts it into vv.out and nn.out
+    if u_conf.get('trajectory', 'text') == 'binary':
+        with TrajectoryWriter(directory + '/' + TRAJECTORY_FILE) as writer:
+            writer.append(sim, nn=False)
+
+            def write_frame(i):
+                writer.append(sim, nn=rdf is None)
+                if rdf is not None:
+                    rdf.accumulate(sim.nn_distances())
+
+            run_blocks(sim, steps, write_frame, doprint)
+    else:
+        # create (or overwrite if it exists) the nn.out and vv.out file, nn.out only without rdf
+        with open(directory + '/vv.out', 'w') as vv_file, \
+                (open(directory + '/nn.out', 'w') if rdf is None else nullcontext()) as nn_file:
+            veloverlet_write(sim, 0, vv_file)
+
+            def write_block(i):
+                if rdf is None:
+                    nn_write(sim, nn_file)
+                else:
+                    rdf.accumulate(sim.nn_distances())
+                veloverlet_write(sim, i, vv_file)
+
+            run_blocks(sim, steps, write_block, doprint)
+
+    if rdf is not None:
+        rdf.save(directory + '/' + RDF_FILE)
+    if monitor is not None:
+        np.savetxt(directory + '/uncertain.out', np.reshape(monitor.flagged, (-1, 3)), header='step variance atom')
 
 
 if __name__ == '__main__':
@@ -234,4 +447,3 @@ if __name__ == '__main__':
     steps = 10000
     doprint = True
     main(dt, steps, doprint)
-